@@ -19,32 +19,67 @@ to your personal OpenRouter API key.  See the README for more details.
 
 from __future__ import annotations
 
+import asyncio
+import gzip
+import hashlib
+import io
+import json
+import math
+import sqlite3
+import mmap
 import os
+import queue
+import random
+import socket
+import threading
+import time
+import weakref
+import zlib
+from array import array
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass, field, replace
+from functools import lru_cache, partial
 from io import BytesIO
-from typing import Dict, Any, Optional, TypedDict
+from itertools import chain, repeat
+from typing import Annotated, Dict, Any, Iterable, Iterator, Mapping, NamedTuple, Optional, TypedDict, Union
 import tempfile
 import zipfile
 import xml.etree.ElementTree as ET
 from datetime import datetime
+from email.utils import parsedate_to_datetime
 import re
 
-from pydantic import Field, SecretStr
+import httpx
+import numpy as np
+import openai
+from pydantic import Field, PrivateAttr, SecretStr
 
 from langchain_openai import ChatOpenAI
+from langchain_core.messages import AIMessage
+from langchain_core.messages.ai import add_usage
+from langchain_core.runnables import RunnableConfig, RunnableLambda
 from langchain_core.utils.utils import secret_from_env
-from langgraph.graph import StateGraph
+from langgraph.graph import START, StateGraph
+from langgraph.types import Send
 
 try:
     # PyPDF2 is used for extracting text from PDFs.  If it isn't installed
     # streamlit will inform the user via dependency resolution in
     # requirements.txt.
-    from PyPDF2 import PdfReader
+    from PyPDF2 import PageObject, PdfReader
 except ImportError as e:
     raise ImportError(
         "PyPDF2 is required for PDF parsing. Please install it via 'pip install PyPDF2'."
     ) from e
 
 
+DEFAULT_OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+
 class ChatOpenRouter(ChatOpenAI):
     """A thin wrapper around LangChain's ChatOpenAI class to target the
     OpenRouter endpoint instead of the default OpenAI API.  It reads
@@ -61,6 +96,10 @@ class ChatOpenRouter(ChatOpenAI):
         alias="api_key", default_factory=secret_from_env("OPENROUTER_API_KEY", default=None)
     )
 
+    # (model_name, temperature, kwargs) of a client from get_chat_client,
+    # used to find its counterpart on another event loop
+    _shared_spec: Optional[tuple] = PrivateAttr(default=None)
+
     @property
     def lc_secrets(self) -> Dict[str, str]:
         """Expose environment variable mapping for LangChain.
@@ -85,7 +124,9 @@ class ChatOpenRouter(ChatOpenAI):
             the `OPENROUTER_API_KEY` environment variable.
         **kwargs : Any
             Additional keyword arguments passed to the underlying
-            ChatOpenAI class (e.g. model_name, temperature).
+            ChatOpenAI class (e.g. model_name, temperature).  ``base_url``
+            defaults to the ``OPENROUTER_BASE_URL`` environment variable,
+            or ``DEFAULT_OPENROUTER_BASE_URL`` when that is unset.
         """
 
         # Fall back to environment variable if the caller didn't supply a key
@@ -96,336 +137,4190 @@ class ChatOpenRouter(ChatOpenAI):
                 "to ChatOpenRouter."
             )
 
+        # OPENROUTER_BASE_URL points the client elsewhere, e.g. at
+        # mock_openrouter_server.py for offline benchmarks
+        kwargs.setdefault("base_url", os.environ.get("OPENROUTER_BASE_URL") or DEFAULT_OPENROUTER_BASE_URL)
         super().__init__(
-            base_url="https://openrouter.ai/api/v1",
             openai_api_key=openai_api_key,
             **kwargs,
         )
 
 
-def extract_pdf_text(file_data: bytes) -> str:
-    """Extract all text from a PDF given its binary data.
+# Documents shorter than this are extracted serially: spinning up a process
+# pool and re-parsing the PDF in every worker costs more than it saves.
+PARALLEL_MIN_PAGES = 64
 
-    This helper function uses PyPDF2 to iterate over every page in a PDF and
-    concatenate the extracted text into a single string.  It gracefully
-    handles encrypted PDFs by attempting to decrypt with an empty password.
+# Typical characters of text on a page of lecture notes or a course pack.
+# Only used to judge whether a character budget is large enough to be worth
+# extracting in parallel.
+CHARS_PER_PAGE_ESTIMATE = 2000
 
-    Parameters
-    ----------
-    file_data : bytes
-        Raw binary content of the PDF file.
 
-    Returns
-    -------
-    str
-        Concatenated text from all pages of the PDF.  Pages for which text
-        extraction fails (for example due to scanning) will simply be
-        skipped.
+# Anything the extraction helpers accept as a PDF: raw bytes, any object
+# supporting the buffer protocol (bytearray, memoryview, mmap, ...) or a path
+# to a file on disk, which is memory-mapped rather than read.
+PdfSource = Union[bytes, bytearray, memoryview, str, "os.PathLike[str]"]
+
+
+class _BufferStream(io.RawIOBase):
+    """Read-only, seekable binary stream over a buffer, without copying it.
+
+    ``BytesIO(memoryview)`` copies the whole buffer up front.  This stream
+    only copies the slices PyPDF2 actually reads.
+    """
+
+    def __init__(self, view: memoryview) -> None:
+        super().__init__()
+        self._view = view.cast("B") if view.format != "B" or view.ndim != 1 else view
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        else:
+            pos = len(self._view) + offset
+        self._pos = max(pos, 0)
+        return self._pos
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        start = min(self._pos, len(self._view))
+        end = len(self._view) if size is None or size < 0 else min(start + size, len(self._view))
+        self._pos = end
+        return self._view[start:end].tobytes()
+
+    def readinto(self, buffer: Any) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+
+def _is_path(source: PdfSource) -> bool:
+    return isinstance(source, (str, os.PathLike))
+
+
+@contextmanager
+def _pdf_stream(source: PdfSource) -> Iterator[Any]:
+    """Open ``source`` as a seekable binary stream without copying its bytes.
+
+    Paths are memory-mapped, so the kernel pages the file in on demand and
+    the data is shared with any other process reading the same file.
+    ``bytes`` are wrapped in ``BytesIO``, which shares rather than copies an
+    immutable buffer.  Other buffers are read through :class:`_BufferStream`.
+    """
+
+    if _is_path(source):
+        with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+        return
+    if isinstance(source, bytes):
+        yield BytesIO(source)
+        return
+    with memoryview(source) as view:
+        if isinstance(view.obj, bytes) and view.contiguous and view.nbytes == len(view.obj):
+            # A view over a whole bytes object: BytesIO can share it directly
+            yield BytesIO(view.obj)
+        else:
+            yield _BufferStream(view)
+
+
+def _open_pdf_reader(stream: Any) -> PdfReader:
+    """Open a PDF and, if it is encrypted, decrypt it once up front.
+
+    Some PDFs are encrypted even though they have no user password.
+    Decrypting derives the document key, which is comparatively expensive,
+    so it is done here exactly once rather than before every page.
     """
 
-    # Use BytesIO so PyPDF2 can treat the incoming bytes like a file
-    reader = PdfReader(BytesIO(file_data))
-    text: list[str] = []
-    for i, page in enumerate(reader.pages):
+    reader = PdfReader(stream)
+    if reader.is_encrypted:
         try:
-            # Some PDFs require decryption even if not password protected
-            if reader.is_encrypted:
-                reader.decrypt("")
-            page_text = page.extract_text()
-            if page_text:
-                text.append(page_text)
+            reader.decrypt("")
         except Exception:
-            # Skip pages that can't be read
-            continue
-    return "\n\n".join(text)
+            # Leave the reader as is; pages that can't be read are skipped
+            pass
+    return reader
 
 
-class ProcessState(TypedDict, total=False):
-    """State type for the LangGraph workflow.
+class _PageRecord(NamedTuple):
+    """Outcome of extracting a single page."""
 
-    Fields
-    ------
-    pdf_text : str
-        The full textual content extracted from the uploaded PDF.
-    questions : str
-        User‑provided questions or assignment instructions.
-    clarifications : Optional[str]
-        Clarifications supplied by the user after the analysis phase.
-    analysis : Optional[str]
-        The output of the analysis phase (summary, topics, ambiguities).
-    assignment : Optional[str]
-        The final generated assignment.
+    index: int
+    text: str
+    seconds: float
+    timed_out: bool = False
+    image_only: bool = False
+
+
+def _call_with_timeout(func: Any, timeout: float) -> Any:
+    """Run ``func()`` in a daemon thread and wait at most ``timeout`` seconds.
+
+    Raises ``TimeoutError`` if the call has not finished in time.  Python
+    threads cannot be interrupted, so the call keeps running in the
+    background until it returns; being a daemon it never blocks interpreter
+    exit.  Exceptions raised by ``func`` are re-raised in the caller.
     """
 
-    pdf_text: str
-    questions: str
-    clarifications: Optional[str]
-    analysis: Optional[str]
-    assignment: Optional[str]
+    outcome: Dict[str, Any] = {}
 
+    def target() -> None:
+        try:
+            outcome["value"] = func()
+        except BaseException as e:  # re-raised in the calling thread
+            outcome["error"] = e
 
-def _analysis_node(state: ProcessState, *, llm: ChatOpenRouter) -> ProcessState:
-    """Perform an analysis of the provided PDF and questions.
+    worker = threading.Thread(target=target, name="pdf-page-watchdog", daemon=True)
+    worker.start()
+    worker.join(timeout)
+    if worker.is_alive():
+        raise TimeoutError(f"page extraction exceeded {timeout:g}s")
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["value"]
 
-    This node instructs the LLM to summarise the document, identify key
-    topics and instructions, and surface any ambiguities or potential
-    clarifications required from the user.  The result is stored on the
-    state's `analysis` field.
 
-    Parameters
-    ----------
-    state : ProcessState
-        The current state passed through the LangGraph workflow.
-    llm : ChatOpenRouter
-        The language model used to perform analysis.
+# ``BT`` as a whole token: delimiters such as ``/`` may follow it directly
+# (``BT/F1 12 Tf`` from compact writers)
+_TEXT_OBJECT_OPERATOR = re.compile(rb"(?<![A-Za-z0-9])BT(?![A-Za-z0-9])")
 
-    Returns
-    -------
-    ProcessState
-        Updated state with an `analysis` field containing the model's
-        response.
+
+def _has_fonts(resources: Any, depth: int = 0) -> bool:
+    """Return whether a resource dictionary (or a Form XObject in it) declares fonts."""
+
+    if not resources or depth > 4:
+        return False
+    resources = resources.get_object()
+    if resources.get("/Font"):
+        return True
+    xobjects = resources.get("/XObject")
+    if not xobjects:
+        return False
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        if xobject.get("/Subtype") == "/Form" and _has_fonts(xobject.get("/Resources"), depth + 1):
+            return True
+    return False
+
+
+def _is_image_only(page: PageObject) -> bool:
+    """Cheaply decide whether a page has no text layer at all.
+
+    Text can only be drawn with a font, so a page whose resources (and
+    Form XObjects) declare no fonts is image-only, e.g. a scan.  Pages that
+    do declare fonts but whose content stream never opens a text object
+    (``BT``) are image-only as well.  Any doubt, including errors while
+    inspecting the page, answers ``False`` so the page is extracted as
+    usual.
     """
 
-    pdf_text = state.get("pdf_text", "")
-    questions = state.get("questions", "")
-    clarifications = state.get("clarifications", "") or ""
+    try:
+        resources = page.get("/Resources")
+        if not _has_fonts(resources):
+            return True
+        xobjects = resources.get_object().get("/XObject")
+        if xobjects:
+            # Text may live inside a Form XObject; let extraction decide
+            return False
+        contents = page.get_contents()
+        return contents is None or not _TEXT_OBJECT_OPERATOR.search(contents.get_data())
+    except Exception:
+        return False
 
-    # System prompt instructs the model how to behave during the analysis phase
-    system_prompt = (
-        "You are a specialized AI academic assistant designed to analyse uploaded "
-        "documents and instructions in order to prepare high‑quality assignments. "
-        "During this analysis step you must carefully read the provided PDF "
-        "content and any user questions or instructions. Extract and summarise "
-        "the key topics, definitions, and explicit instructions found in the "
-        "document. Also identify any ambiguous or unclear instructions that "
-        "require clarification. Your output should be structured as follows:\n\n"
-        "1. Summary: A concise summary of the document.\n"
-        "2. Key Topics: A bulleted list of the main topics and subtopics found in the document.\n"
-        "3. Explicit Instructions: Any explicit assignment instructions extracted verbatim from the document.\n"
-        "4. Ambiguities: A list of questions for the user about parts of the document or instructions that are unclear or ambiguous.\n\n"
-        "If there are no ambiguities, write 'None' under the Ambiguities section."
-    )
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {
-            "role": "user",
-            "content": (
-                f"Document Content:\n{pdf_text}\n\n"
-                f"User Questions/Instructions:\n{questions}\n"
-                f"Existing Clarifications (if any):\n{clarifications}"
-            ),
-        },
-    ]
+def _extract_page(reader: PdfReader, index: int) -> Optional[str]:
+    """Return the text of page ``index``, or ``None`` if it has no text layer.
 
-    # Invoke the model and capture the analysis text
-    response = llm.invoke(messages)
-    analysis_text = response.content.strip() if hasattr(response, "content") else str(response)
-    state["analysis"] = analysis_text
-    return state
+    Parsing the page, the image-only check and the extraction all happen
+    here so that the per-page watchdog covers every one of them.
+    """
 
+    # Pages are only parsed when indexed, so pages outside the requested
+    # range are never touched.
+    page = reader.pages[index]
+    if _is_image_only(page):
+        return None
+    return page.extract_text()
 
-def _assignment_node(state: ProcessState, *, llm: ChatOpenRouter) -> ProcessState:
-    """Generate the final assignment based on PDF, questions and clarifications.
 
-    This node calls the LLM with instructions to build a structured academic
-    assignment suitable for university submission.  It pulls the PDF text,
-    user questions and any clarifications from the state.  The resulting
-    assignment is stored on the state's `assignment` field.
+def _iter_page_records(
+    file_data: PdfSource,
+    start: int = 0,
+    stop: Optional[int] = None,
+    char_budget: Optional[int] = None,
+    page_timeout: Optional[float] = None,
+) -> Iterator[_PageRecord]:
+    """Yield a :class:`_PageRecord` for every page attempted in the range.
+
+    This is the engine behind :func:`iter_pdf_pages` and
+    :func:`extract_pdf_pages`; see those for the parameters.  With a
+    ``page_timeout`` each page is parsed and extracted under a watchdog.  A
+    page that overruns is recorded as timed out and the rest of the
+    document is read through a freshly opened reader, since the abandoned
+    thread may still be using the old one.  Pages without a text layer (see
+    :func:`_is_image_only`) are recorded without running extraction at all.
+    """
+
+    with ExitStack() as stack:
+        reader = _open_pdf_reader(stack.enter_context(_pdf_stream(file_data)))
+        num_pages = len(reader.pages)
+        stop = num_pages if stop is None else min(stop, num_pages)
+        remaining = char_budget
+        for i in range(max(start, 0), stop):
+            if remaining is not None and remaining <= 0:
+                return
+            started = time.perf_counter()
+            try:
+                if page_timeout is None:
+                    page_text = _extract_page(reader, i)
+                else:
+                    page_text = _call_with_timeout(partial(_extract_page, reader, i), page_timeout)
+            except TimeoutError:
+                yield _PageRecord(i, "", time.perf_counter() - started, timed_out=True)
+                reader = _open_pdf_reader(stack.enter_context(_pdf_stream(file_data)))
+                continue
+            except Exception:
+                # Skip pages that can't be read
+                page_text = ""
+            if page_text is None:
+                yield _PageRecord(i, "", time.perf_counter() - started, image_only=True)
+                continue
+            page_text = page_text or ""
+            if remaining is not None:
+                page_text = page_text[:remaining]
+                remaining -= len(page_text)
+            yield _PageRecord(i, page_text, time.perf_counter() - started)
+
+
+def iter_pdf_pages(
+    file_data: PdfSource,
+    *,
+    start: int = 0,
+    stop: Optional[int] = None,
+    char_budget: Optional[int] = None,
+    page_timeout: Optional[float] = None,
+) -> Iterator[tuple[int, str]]:
+    """Lazily yield ``(page_index, text)`` for the pages of a PDF.
+
+    Pages are parsed one at a time as the caller consumes the generator, so
+    a caller that stops early never pays for the rest of the document.
+    Pages without extractable text (or that fail to parse) are skipped.
 
     Parameters
     ----------
-    state : ProcessState
-        The current state passed through the LangGraph workflow.
-    llm : ChatOpenRouter
-        The language model used to generate the assignment.
+    file_data : PdfSource
+        Raw binary content of the PDF file, any buffer-protocol object
+        holding it, or a path to the file.
+    start : int, optional
+        Index of the first page to read.  Defaults to ``0``.
+    stop : Optional[int], optional
+        Index one past the last page to read.  Defaults to the end of the
+        document.
+    char_budget : Optional[int], optional
+        Maximum number of characters to yield in total.  The page that
+        crosses the budget is truncated and iteration stops there.  ``None``
+        means no limit.
+    page_timeout : Optional[float], optional
+        Maximum number of seconds to spend extracting any single page.
+        Pages that take longer are skipped.  ``None`` (the default) means
+        no limit.
+
+    Yields
+    ------
+    tuple[int, str]
+        The zero-based page index and the text extracted from that page.
+    """
+
+    for record in _iter_page_records(file_data, start, stop, char_budget, page_timeout):
+        if record.text:
+            yield record.index, record.text
+
+
+def _extract_page_range(
+    file_data: PdfSource, start: int, stop: int, page_timeout: Optional[float] = None
+) -> list[_PageRecord]:
+    """Extract pages ``start`` (inclusive) to ``stop`` (exclusive).
+
+    This is the unit of work for the parallel extraction path.  It lives at
+    module level so it can be pickled and shipped to a worker process,
+    where it re-opens (and memory-maps) the PDF file.
 
     Returns
     -------
-    ProcessState
-        Updated state with an `assignment` field containing the model's
-        generated assignment.
+    list[_PageRecord]
+        One record per page in the range, in page order.
     """
 
-    pdf_text = state.get("pdf_text", "")
-    questions = state.get("questions", "")
-    clarifications = state.get("clarifications", "") or ""
+    return list(_iter_page_records(file_data, start, stop, page_timeout=page_timeout))
 
-    system_prompt = (
-        "You are a specialized AI academic assistant designed to generate high‑quality "
-        "assignments based on provided documents and user instructions.  Use the "
-        "content extracted from the PDF and any clarifications to create a well‑"
-        "structured assignment suitable for university submission.  Your response "
-        "must adhere to the following format:\n\n"
-        "# Introduction\nProvide a brief overview of the topic and its significance.\n\n"
-        "# Body\nOrganise the main body into logical sections with headings.  Provide "
-        "detailed explanations, analysis and relevant examples derived from the "
-        "source material.\n\n"
-        "# Conclusion\nSummarise the key points discussed and offer any conclusions or "
-        "recommendations based on the analysed content.\n\n"
-        "# References\nIf applicable, list all sources referenced.  Use any citation details "
-        "available in the document (e.g. authors, titles, publication dates) or, "
-        "if none are present, leave this section empty.\n\n"
-        "Ensure the assignment is coherent, logically organised and free from "
-        "plagiarism.  Write in formal academic language."
-    )
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {
-            "role": "user",
-            "content": (
-                f"Document Content:\n{pdf_text}\n\n"
-                f"User Questions/Instructions:\n{questions}\n\n"
-                f"Clarifications (if provided):\n{clarifications}"
-            ),
-        },
-    ]
+def _split_page_range(start: int, stop: int, parts: int) -> list[tuple[int, int]]:
+    """Split ``range(start, stop)`` into at most ``parts`` contiguous ranges."""
 
-    response = llm.invoke(messages)
-    assignment_text = response.content.strip() if hasattr(response, "content") else str(response)
-    state["assignment"] = assignment_text
-    return state
+    num_pages = stop - start
+    parts = max(1, min(parts, num_pages))
+    size, extra = divmod(num_pages, parts)
+    ranges: list[tuple[int, int]] = []
+    for i in range(parts):
+        range_stop = start + size + (1 if i < extra else 0)
+        ranges.append((start, range_stop))
+        start = range_stop
+    return ranges
 
 
-def _build_analysis_graph(llm: ChatOpenRouter):
-    """Build a simple LangGraph for the analysis phase.
+def _trim_records(records: Iterable[_PageRecord], char_budget: Optional[int]) -> Iterator[_PageRecord]:
+    """Cut page records (in page order) down to ``char_budget`` characters.
 
-    The graph consists of a single node (`analysis`) that processes the
-    document and instructions and populates the `analysis` field of the
-    state.
+    Applies the budget exactly as :func:`_iter_page_records` does while
+    reading, so trimming a parallel extraction gives the serial result.
+    """
 
-    Parameters
-    ----------
-    llm : ChatOpenRouter
-        A configured language model instance.
+    remaining = char_budget
+    for record in records:
+        if remaining is None:
+            yield record
+            continue
+        if remaining <= 0:
+            return
+        if record.text:
+            record = record._replace(text=record.text[:remaining])
+            remaining -= len(record.text)
+        yield record
 
-    Returns
-    -------
-    langgraph.graph.Graph
-        A compiled graph ready to be invoked.
+
+@contextmanager
+def _pdf_file_path(source: PdfSource) -> Iterator[str]:
+    """Yield a path to ``source`` on disk, spilling in-memory data to a temp file.
+
+    Worker processes then memory-map one shared file instead of each
+    receiving a pickled copy of the whole document.
     """
 
-    builder = StateGraph(ProcessState)
-    # Use a lambda to curry the llm into the node
-    builder.add_node("analysis", lambda state: _analysis_node(state, llm=llm))
-    builder.set_entry_point("analysis")
-    return builder.compile()
+    if _is_path(source):
+        yield os.fspath(source)
+        return
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(source)
+        yield path
+    finally:
+        os.remove(path)
 
 
-def _build_assignment_graph(llm: ChatOpenRouter):
-    """Build a simple LangGraph for the assignment generation phase.
+# Separator placed between pages when they are joined into a single string
+PAGE_SEPARATOR = "\n\n"
 
-    This graph has a single node (`assignment`) that takes the state (with
-    pdf_text, questions and optional clarifications) and writes the generated
-    assignment into the `assignment` field.
 
-    Parameters
+@dataclass(frozen=True)
+class PdfExtractionResult:
+    """Extracted PDF text together with a compact index of page boundaries.
+
+    ``text`` is the page texts joined with :data:`PAGE_SEPARATOR`, exactly as
+    :func:`extract_pdf_text` returns it.  The three parallel arrays describe
+    the pages that produced text (empty pages are omitted): the original
+    zero-based page number, the offset of the page's first character in
+    ``text`` and its length.  Slicing a page back out is therefore O(1), and
+    mapping a character offset to its page is a binary search.
+
+    Attributes
     ----------
-    llm : ChatOpenRouter
-        A configured language model instance.
+    text : str
+        The concatenated document text.
+    page_numbers : array
+        Zero-based PDF page index of each extracted page.
+    page_offsets : array
+        Start offset of each extracted page within ``text``.
+    page_lengths : array
+        Number of characters of each extracted page.
+    page_seconds : Dict[int, float]
+        Wall-clock extraction time of every page that was attempted, keyed
+        by page index.  Empty for results served from a cache.
+    skipped_pages : tuple[int, ...]
+        Pages abandoned because they exceeded the per-page time budget.
+    image_only_pages : tuple[int, ...]
+        Pages without a text layer (typically scans), which were skipped
+        without attempting extraction.
+    """
 
-    Returns
-    -------
-    langgraph.graph.Graph
-        A compiled graph ready to be invoked.
+    text: str
+    page_numbers: array = field(default_factory=lambda: array("I"))
+    page_offsets: array = field(default_factory=lambda: array("I"))
+    page_lengths: array = field(default_factory=lambda: array("I"))
+    page_seconds: Dict[int, float] = field(default_factory=dict, compare=False)
+    skipped_pages: tuple[int, ...] = ()
+    image_only_pages: tuple[int, ...] = ()
+
+    @classmethod
+    def from_pages(cls, pages: Iterable[tuple[int, str]]) -> "PdfExtractionResult":
+        """Build a result from ``(page_index, text)`` pairs in page order."""
+
+        page_numbers, page_offsets, page_lengths = array("I"), array("I"), array("I")
+        texts: list[str] = []
+        offset = 0
+        for page_index, page_text in pages:
+            if texts:
+                offset += len(PAGE_SEPARATOR)
+            page_numbers.append(page_index)
+            page_offsets.append(offset)
+            page_lengths.append(len(page_text))
+            texts.append(page_text)
+            offset += len(page_text)
+        return cls(PAGE_SEPARATOR.join(texts), page_numbers, page_offsets, page_lengths)
+
+    @classmethod
+    def _from_records(cls, records: Iterable[_PageRecord]) -> "PdfExtractionResult":
+        records = list(records)
+        result = cls.from_pages((r.index, r.text) for r in records if r.text)
+        return replace(
+            result,
+            page_seconds={r.index: r.seconds for r in records},
+            skipped_pages=tuple(r.index for r in records if r.timed_out),
+            image_only_pages=tuple(r.index for r in records if r.image_only),
+        )
+
+    def __len__(self) -> int:
+        return len(self.page_numbers)
+
+    @property
+    def looks_scanned(self) -> bool:
+        """Whether at least half of the pages have no text layer at all.
+
+        Such documents are usually scans; sending their (near-empty) text
+        to the model is a wasted call.
+        """
+
+        pages = len(self.page_numbers) + len(self.skipped_pages) + len(self.image_only_pages)
+        return bool(self.image_only_pages) and len(self.image_only_pages) * 2 >= pages
+
+    def page_text(self, i: int) -> str:
+        """Return the text of the ``i``-th extracted page."""
+
+        start = self.page_offsets[i]
+        return self.text[start : start + self.page_lengths[i]]
+
+    def pages(self) -> Iterator[tuple[int, str]]:
+        """Yield ``(page_index, text)`` for every extracted page."""
+
+        for i, page_index in enumerate(self.page_numbers):
+            yield page_index, self.page_text(i)
+
+    def slowest_pages(self, n: int = 5) -> list[tuple[int, float]]:
+        """Return the ``n`` slowest ``(page_index, seconds)`` pairs, slowest first."""
+
+        return sorted(self.page_seconds.items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def page_at(self, offset: int) -> int:
+        """Return the PDF page index containing character ``offset`` of ``text``.
+
+        Offsets that fall on a separator are attributed to the preceding page.
+        """
+
+        if not self.page_numbers:
+            raise IndexError("extraction result has no pages")
+        i = max(bisect_right(self.page_offsets, offset) - 1, 0)
+        return self.page_numbers[i]
+
+
+def _user_cache_dir(*parts: str) -> str:
+    """Return (and create) a private per-user cache directory.
+
+    The base is ``$XDG_CACHE_HOME`` or ``~/.cache``, never a shared
+    location such as ``/tmp`` where another local user could pre-create
+    the directory and plant entries.  Directories are created with mode
+    ``0o700``.
     """
 
-    builder = StateGraph(ProcessState)
-    builder.add_node("assignment", lambda state: _assignment_node(state, llm=llm))
-    builder.set_entry_point("assignment")
-    return builder.compile()
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    path = os.path.join(base, "ai_academic_assistant", *parts)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
 
 
-def run_analysis(pdf_text: str, questions: str, *, model_name: str = "z-ai/glm-4.5-air:free", temperature: float = 0.0) -> str:
-    """Run the analysis phase and return the analysis output.
+class PdfTextCache:
+    """Content-addressed on-disk cache for extracted PDF text.
 
-    This helper function wraps the analysis graph, instantiates the LLM and
-    invokes the graph with the provided PDF text and user questions.
+    Entries are keyed by the SHA-256 of the PDF bytes and stored as
+    zlib-compressed JSON files (text plus page index), one per document.  When the total size on
+    disk exceeds ``max_bytes`` the least recently used entries are evicted;
+    a file's modification time doubles as its last-access time.  The cache
+    is safe to share between threads and, because writes are atomic
+    renames, between processes using the same directory.
 
     Parameters
     ----------
-    pdf_text : str
-        The full text extracted from a PDF.
-    questions : str
-        User‑provided questions or assignment instructions.
-    model_name : str, optional
-        The model identifier to use on OpenRouter.  Defaults to
-        ``"openai/gpt-3.5-turbo"`` which is widely available.  You can choose
-        any other model supported by OpenRouter, e.g. ``"anthropic/claude-3-7-sonnet"``.
-    temperature : float, optional
-        Sampling temperature for the LLM.  Defaults to 0.0 for deterministic
-        output.
-
-    Returns
-    -------
-    str
-        The analysis output containing summary, key topics, explicit
-        instructions and any detected ambiguities.
+    directory : Optional[str], optional
+        Where cache files are stored.  Defaults to ``PDF_TEXT_CACHE_DIR``
+        from the environment or a folder in the per-user cache directory
+        (see :func:`_user_cache_dir`).
+    max_bytes : int, optional
+        Size cap for the compressed entries.  Defaults to 256 MiB.
     """
 
-    llm = ChatOpenRouter(model_name=model_name, temperature=temperature)
-    graph = _build_analysis_graph(llm)
-    initial_state: ProcessState = {
-        "pdf_text": pdf_text,
-        "questions": questions,
-        "clarifications": None,
-        "analysis": None,
-        "assignment": None,
-    }
-    result_state = graph.invoke(initial_state)
-    return result_state.get("analysis", "") or ""
+    _SUFFIX = ".pages.z"
 
+    def __init__(self, directory: Optional[str] = None, *, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.directory = directory or os.environ.get("PDF_TEXT_CACHE_DIR") or _user_cache_dir("pdf_text")
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
 
-def run_assignment(
-    pdf_text: str,
-    questions: str,
-    clarifications: Optional[str] = None,
-    *,
-    model_name: str = "z-ai/glm-4.5-air:free",
-    temperature: float = 0.0,
+    @staticmethod
+    def key_for(file_data: PdfSource) -> str:
+        """Return the cache key (hex SHA-256 digest) for some PDF data or file."""
+
+        if _is_path(file_data):
+            with open(file_data, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return hashlib.sha256(mapped).hexdigest()
+        return hashlib.sha256(file_data).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self._SUFFIX)
+
+    def get(self, key: str) -> Optional[PdfExtractionResult]:
+        """Return the cached extraction for ``key`` or ``None`` on a miss."""
+
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                entry = json.loads(zlib.decompress(f.read()))
+            # Touch the entry so LRU eviction sees it as recently used
+            os.utime(path, None)
+            result = replace(
+                PdfExtractionResult.from_pages(zip(entry["pages"], entry["texts"])),
+                image_only_pages=tuple(entry.get("image_only", ())),
+            )
+        except (OSError, zlib.error, ValueError, KeyError, TypeError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: PdfExtractionResult) -> None:
+        """Store ``result`` under ``key`` and evict old entries if needed."""
+
+        entry = {
+            "pages": list(result.page_numbers),
+            "texts": [page_text for _, page_text in result.pages()],
+            "image_only": list(result.image_only_pages),
+        }
+        data = zlib.compress(json.dumps(entry, ensure_ascii=False).encode("utf-8"), 6)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            # Caching is best effort; never fail an extraction because of it
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self._evict()
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self._SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = sorted(self._entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+
+    def clear(self) -> None:
+        """Remove every entry and reset the hit/miss counters."""
+
+        with self._lock:
+            for _, _, path in self._entries():
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the current number and size of entries."""
+
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
+
+
+_default_pdf_text_cache: Optional[PdfTextCache] = None
+
+
+def get_pdf_text_cache() -> PdfTextCache:
+    """Return the process-wide :class:`PdfTextCache`, creating it on first use."""
+
+    global _default_pdf_text_cache
+    if _default_pdf_text_cache is None:
+        _default_pdf_text_cache = PdfTextCache()
+    return _default_pdf_text_cache
+
+
+def _extraction_cache_key(
+    file_data: PdfSource, start: int = 0, stop: Optional[int] = None, char_budget: Optional[int] = None
 ) -> str:
-    """Run the assignment generation phase and return the assignment output.
+    key = PdfTextCache.key_for(file_data)
+    if (start, stop, char_budget) != (0, None, None):
+        key = f"{key}-{start}-{stop}-{char_budget}"
+    return key
+
 
-    This helper function wraps the assignment graph, instantiates the LLM and
-    invokes the graph with the provided PDF text, questions and optional
-    clarifications.
+def extract_pdf_pages(
+    file_data: PdfSource,
+    *,
+    workers: Optional[int] = None,
+    parallel_min_pages: int = PARALLEL_MIN_PAGES,
+    start: int = 0,
+    stop: Optional[int] = None,
+    char_budget: Optional[int] = None,
+    page_timeout: Optional[float] = None,
+    cache: Optional[PdfTextCache] = None,
+) -> PdfExtractionResult:
+    """Extract all text from a PDF together with its page boundaries.
+
+    This helper function uses PyPDF2 to iterate over every page in a PDF and
+    concatenate the extracted text into a single string, recording where
+    each page starts so callers can map text back to pages.  It gracefully
+    handles encrypted PDFs by attempting to decrypt with an empty password.
+
+    Large documents are split into contiguous page ranges which are
+    extracted concurrently in a process pool.  The result is identical to
+    the serial path and pages are always returned in document order.
 
     Parameters
     ----------
-    pdf_text : str
-        The full text extracted from a PDF.
-    questions : str
-        User‑provided questions or assignment instructions.
-    clarifications : Optional[str], optional
-        Additional clarifications provided by the user after reviewing the
-        analysis.  Defaults to ``None``.
-    model_name : str, optional
-        The model identifier to use on OpenRouter.  Defaults to
-        ``"openai/gpt-3.5-turbo"``.
-    temperature : float, optional
-        Sampling temperature for the LLM.  Defaults to 0.0 for deterministic
-        output.
+    file_data : PdfSource
+        Raw binary content of the PDF file, any buffer-protocol object
+        holding it (e.g. ``memoryview``), or a path to the file.  Paths are
+        memory-mapped and buffers are read in place, so the document is
+        never copied as a whole.
+    workers : Optional[int], optional
+        Number of worker processes used for parallel extraction.  Defaults
+        to the number of CPUs.  Pass ``1`` to force serial extraction.
+    parallel_min_pages : int, optional
+        Documents with fewer pages than this are always extracted serially
+        because pool start-up would dominate.  Defaults to
+        ``PARALLEL_MIN_PAGES``.
+    start : int, optional
+        Index of the first page to extract.  Defaults to ``0``.
+    stop : Optional[int], optional
+        Index one past the last page to extract.  Defaults to the end of
+        the document.  Pages outside ``start``/``stop`` are never parsed.
+    char_budget : Optional[int], optional
+        Stop reading once this many characters of page text have been
+        extracted (see :func:`iter_pdf_pages`).  A budget worth fewer than
+        ``parallel_min_pages`` pages (see ``CHARS_PER_PAGE_ESTIMATE``) is
+        read serially and stops early; a larger one is extracted in
+        parallel and trimmed to the same text afterwards.
+    page_timeout : Optional[float], optional
+        Per-page time budget in seconds.  Pathological pages that exceed it
+        are skipped and listed in ``skipped_pages`` instead of stalling the
+        whole extraction.  ``None`` (the default) means no limit.
+    cache : Optional[PdfTextCache], optional
+        If given, the result is looked up in and stored to this cache so
+        repeated uploads of the same file skip PyPDF2 entirely.  Results
+        with skipped pages are not cached.
 
     Returns
     -------
-    str
-        A complete academic assignment conforming to the structure defined in
-        the system prompt.
+    PdfExtractionResult
+        Concatenated text from all pages of the PDF plus the page offset
+        index.  Pages for which text extraction fails (for example due to
+        scanning) will simply be skipped.
     """
 
-    llm = ChatOpenRouter(model_name=model_name, temperature=temperature)
-    graph = _build_assignment_graph(llm)
-    initial_state: ProcessState = {
-        "pdf_text": pdf_text,
-        "questions": questions,
-        "clarifications": clarifications,
+    if cache is not None:
+        key = _extraction_cache_key(file_data, start, stop, char_budget)
+        result = cache.get(key)
+        if result is None:
+            result = extract_pdf_pages(
+                file_data,
+                workers=workers,
+                parallel_min_pages=parallel_min_pages,
+                start=start,
+                stop=stop,
+                char_budget=char_budget,
+                page_timeout=page_timeout,
+            )
+            if not result.skipped_pages:
+                cache.put(key, result)
+        return result
+
+    workers = workers or os.cpu_count() or 1
+    # A small budget stops after the first few pages, so it is not worth
+    # starting a pool for; a large one would read most of the document anyway.
+    small_budget = char_budget is not None and char_budget < parallel_min_pages * CHARS_PER_PAGE_ESTIMATE
+    if workers > 1 and not small_budget:
+        with _pdf_stream(file_data) as stream:
+            num_pages = len(PdfReader(stream).pages)
+        start = max(start, 0)
+        stop = num_pages if stop is None else min(stop, num_pages)
+        if stop - start >= max(parallel_min_pages, 2):
+            # Over-split a little so that one slow range doesn't leave the
+            # other workers idle at the end.
+            ranges = _split_page_range(start, stop, workers * 2)
+            try:
+                with _pdf_file_path(file_data) as path, ProcessPoolExecutor(
+                    max_workers=min(workers, len(ranges))
+                ) as pool:
+                    chunks = pool.map(
+                        _extract_page_range,
+                        repeat(path),
+                        [range_start for range_start, _ in ranges],
+                        [range_stop for _, range_stop in ranges],
+                        repeat(page_timeout),
+                    )
+                    return PdfExtractionResult._from_records(
+                        _trim_records((record for chunk in chunks for record in chunk), char_budget)
+                    )
+            except (OSError, BrokenProcessPool):
+                # Process pools are unavailable in some sandboxed hosts; the
+                # serial path below always works.
+                pass
+
+    return PdfExtractionResult._from_records(
+        _iter_page_records(file_data, start, stop, char_budget, page_timeout)
+    )
+
+
+def extract_pdf_text(
+    file_data: PdfSource,
+    *,
+    workers: Optional[int] = None,
+    parallel_min_pages: int = PARALLEL_MIN_PAGES,
+    start: int = 0,
+    stop: Optional[int] = None,
+    char_budget: Optional[int] = None,
+    page_timeout: Optional[float] = None,
+    cache: Optional[PdfTextCache] = None,
+) -> str:
+    """Extract all text from a PDF given its binary data.
+
+    Convenience wrapper around :func:`extract_pdf_pages` for callers that
+    only need the text.  All parameters are passed through unchanged.
+
+    Returns
+    -------
+    str
+        Concatenated text from all pages of the PDF, separated by blank
+        lines.  Pages for which text extraction fails (for example due to
+        scanning) will simply be skipped.
+    """
+
+    return extract_pdf_pages(
+        file_data,
+        workers=workers,
+        parallel_min_pages=parallel_min_pages,
+        start=start,
+        stop=stop,
+        char_budget=char_budget,
+        page_timeout=page_timeout,
+        cache=cache,
+    ).text
+
+
+# -----------------------------------------------------------------------------
+# Text normalisation
+# -----------------------------------------------------------------------------
+
+# Rough average for English prose with GPT-style tokenisers; good enough for
+# budgeting and reporting, not for billing.
+CHARS_PER_TOKEN = 4
+
+_PAGE_NUMBER_LINE = re.compile(r"^(?:page\s*)?\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?$", re.IGNORECASE)
+_HYPHENATED_BREAK = re.compile(r"(\w)-[ \t]*\n[ \t]*([a-z])")
+_SPACE_RUN = re.compile(r"[ \t\f\v\u00a0]+")
+_BLANK_LINE_RUN = re.compile(r"\n{3,}")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of LLM tokens in ``text`` from its length."""
+
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+@dataclass(frozen=True)
+class NormalizationReport:
+    """Summary of what :func:`normalize_pdf_pages` removed.
+
+    Attributes
+    ----------
+    chars_before : int
+        Length of the document text before normalisation.
+    chars_after : int
+        Length of the document text after normalisation.
+    boilerplate_lines_removed : int
+        Number of repeated header/footer and page-number lines dropped.
+    """
+
+    chars_before: int
+    chars_after: int
+    boilerplate_lines_removed: int
+
+    @property
+    def chars_saved(self) -> int:
+        return self.chars_before - self.chars_after
+
+    @property
+    def tokens_saved(self) -> int:
+        """Estimated prompt tokens saved (see :func:`estimate_tokens`)."""
+
+        return self.chars_saved // CHARS_PER_TOKEN
+
+
+# A page-number-shaped token ("3", "3/10", "3 of 10") at either end of a line
+_EDGE_NUMBER = re.compile(r"^\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?\b|\b\d{1,4}(?:\s*(?:of|/)\s*\d{1,4})?$")
+
+
+def _line_key(line: str) -> str:
+    # Collapse whitespace and case, and mask one leading or trailing
+    # page-number-shaped token so that "Week 3" and "Week 4" match.  Digits
+    # elsewhere in the line are kept: lines that differ in them are content.
+    return _EDGE_NUMBER.sub("#", " ".join(line.split()).lower(), count=1)
+
+
+def normalize_pdf_pages(
+    extraction: PdfExtractionResult,
+    *,
+    repeat_fraction: float = 0.5,
+    edge_lines: int = 3,
+) -> tuple[PdfExtractionResult, NormalizationReport]:
+    """Strip repeated headers/footers and tidy whitespace to shrink prompts.
+
+    Lecture slides and course packs repeat the same running headers,
+    footers and page numbers on every page, which costs tokens on every
+    LLM call without adding information.  This pass:
+
+    1. Re-joins words hyphenated across a line break and collapses runs of
+       spaces.
+    2. Counts, for each distinct line near the top or bottom of a page, how
+       many pages it appears on.  Lines must match verbatim apart from one
+       leading or trailing number, so running page numbers match but
+       numbered exercises do not.  Those found on at least
+       ``repeat_fraction`` of the pages are removed, as are edge lines
+       consisting only of a page number.
+    3. Collapses runs of blank lines.
+
+    Only lines outside a page's body are ever removed: pages with no more
+    than ``2 * edge_lines`` non-empty lines, all of which would be edge
+    lines, only lose a page number on their first or last line.
+
+    Parameters
+    ----------
+    extraction : PdfExtractionResult
+        The result of :func:`extract_pdf_pages`.
+    repeat_fraction : float, optional
+        Fraction of pages a line must appear on to count as boilerplate.
+        Defaults to ``0.5``.  Repetition is only detected in documents with
+        at least three pages.
+    edge_lines : int, optional
+        How many non-empty lines at the top and at the bottom of each page
+        are candidates for header/footer removal.  Defaults to ``3``.
+
+    Returns
+    -------
+    tuple[PdfExtractionResult, NormalizationReport]
+        The normalised pages (with a fresh page index) and a report of the
+        characters and estimated tokens saved.
+    """
+
+    pages: list[tuple[int, list[str]]] = []
+    for page_index, page_text in extraction.pages():
+        page_text = _HYPHENATED_BREAK.sub(r"\1\2", page_text)
+        page_text = _SPACE_RUN.sub(" ", page_text)
+        pages.append((page_index, [line.strip() for line in page_text.splitlines()]))
+
+    def edge_positions(lines: list[str]) -> set[int]:
+        non_empty = [i for i, line in enumerate(lines) if line]
+        return set(non_empty[:edge_lines] + non_empty[-edge_lines:])
+
+    def removable(lines: list[str], i: int, edges: set[int], short: bool) -> bool:
+        if i not in edges:
+            return False
+        if short:
+            # Every line of a short page is body; only a bare page number goes
+            return i in (min(edges), max(edges)) and bool(_PAGE_NUMBER_LINE.match(lines[i]))
+        return bool(_PAGE_NUMBER_LINE.match(lines[i]) or _line_key(lines[i]) in repeated)
+
+    # Count each edge line once per page it appears on
+    page_counts: Counter[str] = Counter()
+    for _, lines in pages:
+        page_counts.update({_line_key(lines[i]) for i in edge_positions(lines)})
+    min_pages = max(2, math.ceil(repeat_fraction * len(pages)))
+    repeated = {key for key, count in page_counts.items() if count >= min_pages} if len(pages) >= 3 else set()
+
+    removed = 0
+    cleaned_pages: list[tuple[int, str]] = []
+    for page_index, lines in pages:
+        edges = edge_positions(lines)
+        short = sum(1 for line in lines if line) <= 2 * edge_lines
+        kept: list[str] = []
+        for i, line in enumerate(lines):
+            if removable(lines, i, edges, short):
+                removed += 1
+                continue
+            kept.append(line)
+        page_text = _BLANK_LINE_RUN.sub("\n\n", "\n".join(kept)).strip()
+        if page_text:
+            cleaned_pages.append((page_index, page_text))
+
+    normalized = replace(
+        PdfExtractionResult.from_pages(cleaned_pages),
+        page_seconds=extraction.page_seconds,
+        skipped_pages=extraction.skipped_pages,
+        image_only_pages=extraction.image_only_pages,
+    )
+    report = NormalizationReport(
+        chars_before=len(extraction.text),
+        chars_after=len(normalized.text),
+        boilerplate_lines_removed=removed,
+    )
+    return normalized, report
+
+
+# -----------------------------------------------------------------------------
+# Multi-document ingestion
+# -----------------------------------------------------------------------------
+
+def extract_documents(
+    sources: Mapping[str, PdfSource],
+    *,
+    max_workers: Optional[int] = None,
+    char_budget: Optional[int] = None,
+    page_timeout: Optional[float] = None,
+    cache: Optional[PdfTextCache] = None,
+) -> Dict[str, PdfExtractionResult]:
+    """Extract several PDFs concurrently, one worker process per document.
+
+    PyPDF2 is pure Python, so threads would serialise on the GIL; separate
+    processes let a syllabus, a rubric and a couple of readings be parsed
+    at the same time, making total ingestion time roughly that of the
+    slowest file rather than the sum of all of them.  When there are fewer
+    documents than workers, the spare workers are shared out among the
+    documents for page-level parallelism (see :func:`extract_pdf_pages`),
+    so a single large upload still uses every CPU.
+
+    Parameters
+    ----------
+    sources : Mapping[str, PdfSource]
+        Documents to extract, keyed by a display name (e.g. the file name).
+    max_workers : Optional[int], optional
+        Upper bound on concurrent worker processes.  Defaults to the number
+        of CPUs.
+    char_budget, page_timeout, cache
+        Applied to each document as in :func:`extract_pdf_pages`.  Cache
+        lookups happen up front so cached documents never reach the pool.
+
+    Returns
+    -------
+    Dict[str, PdfExtractionResult]
+        One extraction result per document, in the order of ``sources``.
+    """
+
+    results: Dict[str, PdfExtractionResult] = {}
+    pending: Dict[str, PdfSource] = {}
+    keys: Dict[str, str] = {}
+    for name, source in sources.items():
+        if cache is not None:
+            keys[name] = _extraction_cache_key(source, char_budget=char_budget)
+            cached = cache.get(keys[name])
+            if cached is not None:
+                results[name] = cached
+                continue
+        pending[name] = source
+
+    max_workers = max_workers or os.cpu_count() or 1
+    workers = min(len(pending), max_workers)
+    page_workers = max(1, max_workers // max(len(pending), 1))
+    options: Dict[str, Any] = {"workers": page_workers, "char_budget": char_budget, "page_timeout": page_timeout}
+    extracted: Dict[str, PdfExtractionResult] = {}
+    if workers > 1:
+        try:
+            with ExitStack() as stack:
+                # Send workers a path to memory-map rather than a pickled copy
+                paths = {name: stack.enter_context(_pdf_file_path(source)) for name, source in pending.items()}
+                pool = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+                futures = {name: pool.submit(extract_pdf_pages, path, **options) for name, path in paths.items()}
+                extracted = {name: future.result() for name, future in futures.items()}
+        except (OSError, BrokenProcessPool):
+            # Fall back to extracting in this process, one after the other
+            extracted = {}
+    for name, source in pending.items():
+        if name not in extracted:
+            extracted[name] = extract_pdf_pages(source, **options)
+
+    for name, result in extracted.items():
+        if cache is not None and not result.skipped_pages:
+            cache.put(keys[name], result)
+    results.update(extracted)
+    return {name: results[name] for name in sources}
+
+
+def _fair_shares(lengths: list[int], budget: int) -> list[int]:
+    """Split ``budget`` across items of the given lengths, max-min fairly.
+
+    Items shorter than an equal share keep their full length and the
+    leftover is redistributed among the longer ones, so one huge item can
+    never crowd out the small ones.
+    """
+
+    shares = [0] * len(lengths)
+    remaining = max(budget, 0)
+    order = sorted(range(len(lengths)), key=lengths.__getitem__)
+    for position, i in enumerate(order):
+        shares[i] = min(lengths[i], remaining // (len(order) - position))
+        remaining -= shares[i]
+    return shares
+
+
+def _truncate_text(text: str, limit: int) -> str:
+    """Cut ``text`` to at most ``limit`` characters, preferably at a line break."""
+
+    if len(text) <= limit:
+        return text
+    cut = text.rfind("\n", 0, limit)
+    if cut < limit * 0.8:
+        cut = limit
+    return text[:cut].rstrip()
+
+
+def merge_documents(documents: Mapping[str, str], *, char_budget: Optional[int] = None) -> str:
+    """Merge several documents into a single ``pdf_text`` for the prompts.
+
+    Each document is introduced by a ``=== Document: <name> ===`` header so
+    the model can tell them apart.  With a ``char_budget`` every document
+    gets a fair share of it (see :func:`_fair_shares`): short documents such
+    as a rubric are kept whole and only the long ones are truncated.
+
+    Parameters
+    ----------
+    documents : Mapping[str, str]
+        Document texts keyed by display name, in the order to present them.
+    char_budget : Optional[int], optional
+        Total number of document characters allowed in the merged text,
+        excluding the headers.  ``None`` means no limit.
+
+    Returns
+    -------
+    str
+        The merged text.
+    """
+
+    names = list(documents)
+    texts = [documents[name] for name in names]
+    if char_budget is not None:
+        shares = _fair_shares([len(text) for text in texts], char_budget)
+        texts = [_truncate_text(text, share) for text, share in zip(texts, shares)]
+    return "\n\n".join(f"=== Document: {name} ===\n{text}" for name, text in zip(names, texts))
+
+
+_PARAGRAPH_BREAK = re.compile(r"\n[ \t]*\n")
+
+
+def chunk_text(text: str, *, max_chars: int) -> list[str]:
+    """Split ``text`` into chunks of at most ``max_chars`` characters.
+
+    Chunks end on paragraph boundaries (blank lines, which also separate
+    pages and documents in the extracted text) wherever possible.  A single
+    paragraph longer than ``max_chars`` is split on line breaks, and a
+    single overlong line is cut hard.
+
+    Parameters
+    ----------
+    text : str
+        The text to split.
+    max_chars : int
+        Maximum length of each chunk, at least 1.
+
+    Returns
+    -------
+    list[str]
+        The non-empty chunks in document order.
+    """
+
+    pieces = []
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= max_chars:
+            if paragraph:
+                pieces.append((paragraph, PAGE_SEPARATOR))
+            continue
+        for line in paragraph.split("\n"):
+            for start in range(0, len(line), max_chars):
+                pieces.append((line[start:start + max_chars], "\n"))
+
+    chunks = []
+    current = ""
+    for piece, separator in pieces:
+        if current and len(current) + len(separator) + len(piece) <= max_chars:
+            current += separator + piece
+        else:
+            if current:
+                chunks.append(current)
+            current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+# -----------------------------------------------------------------------------
+# Lexical retrieval
+# -----------------------------------------------------------------------------
+
+# Assignment prompts send at most this many (estimated) document tokens
+RETRIEVAL_TOKEN_BUDGET = 12_000
+# Size of the chunks the retrieval index ranks
+RETRIEVAL_CHUNK_TOKENS = 400
+# Marks the gap between non-adjacent excerpts in a narrowed document
+EXCERPT_SEPARATOR = "\n\n[...]\n\n"
+
+_WORD = re.compile(r"[^\W_]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be been but by can do does for from has have how i if in into is it its "
+    "me my no not of on or our so such that the their them then there these they this to was "
+    "we were what when where which who why will with would you your".split()
+)
+
+
+def _terms(text: str) -> list[str]:
+    """Lower-case word terms of ``text`` without stopwords."""
+
+    return [word for word in _WORD.findall(text.lower()) if word not in _STOPWORDS]
+
+
+class LexicalIndex:
+    """In-memory BM25 index over a list of text chunks.
+
+    Postings are stored term-major in compressed sparse row form: the
+    chunk ids and precomputed BM25 weights of term ``t`` are
+    ``chunk_ids[indptr[t]:indptr[t + 1]]`` and ``weights[...]`` of the same
+    slice.  Scoring a query is then one vectorised scatter-add per query
+    term, with no network access or external service.
+
+    Parameters
+    ----------
+    chunks : list[str]
+        The texts to index; results refer to them by position.
+    k1, b : float, optional
+        The usual BM25 term-frequency saturation and length normalisation
+        parameters.
+    """
+
+    def __init__(self, chunks: list[str], *, k1: float = 1.5, b: float = 0.75) -> None:
+        self.chunks = list(chunks)
+        self.vocabulary: Dict[str, int] = {}
+        term_ids = []
+        lengths = np.zeros(len(self.chunks), dtype=np.float64)
+        for i, chunk in enumerate(self.chunks):
+            ids = [self.vocabulary.setdefault(term, len(self.vocabulary)) for term in _terms(chunk)]
+            term_ids.append(np.asarray(ids, dtype=np.int64))
+            lengths[i] = len(ids)
+
+        num_chunks = len(self.chunks)
+        num_terms = len(self.vocabulary)
+        all_terms = np.concatenate(term_ids) if term_ids else np.zeros(0, dtype=np.int64)
+        all_chunks = np.repeat(np.arange(num_chunks, dtype=np.int64), lengths.astype(np.int64))
+        # Sorting (term, chunk) pairs groups postings by term and counts tf
+        pairs, tf = np.unique(all_terms * max(num_chunks, 1) + all_chunks, return_counts=True)
+        posting_terms = pairs // max(num_chunks, 1)
+        self.chunk_ids = pairs % max(num_chunks, 1)
+        self.indptr = np.zeros(num_terms + 1, dtype=np.int64)
+        np.cumsum(np.bincount(posting_terms, minlength=num_terms), out=self.indptr[1:])
+
+        doc_freq = np.diff(self.indptr)
+        idf = np.log1p((num_chunks - doc_freq + 0.5) / (doc_freq + 0.5))
+        avg_length = lengths.mean() if num_chunks and lengths.any() else 1.0
+        norm = k1 * (1 - b + b * lengths[self.chunk_ids] / avg_length)
+        self.weights = idf[posting_terms] * tf * (k1 + 1) / (tf + norm)
+
+    @classmethod
+    def from_text(cls, text: str, *, chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS) -> "LexicalIndex":
+        """Index ``text`` split by :func:`chunk_text` into chunks of about ``chunk_tokens``."""
+
+        return cls(chunk_text(text, max_chars=chunk_tokens * CHARS_PER_TOKEN))
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def scores(self, query: str) -> np.ndarray:
+        """Return the BM25 score of every chunk for ``query``."""
+
+        scores = np.zeros(len(self.chunks), dtype=np.float64)
+        for term in _terms(query):
+            term_id = self.vocabulary.get(term)
+            if term_id is not None:
+                start, stop = self.indptr[term_id], self.indptr[term_id + 1]
+                # Chunk ids are unique within a posting list, so this is a plain scatter-add
+                scores[self.chunk_ids[start:stop]] += self.weights[start:stop]
+        return scores
+
+    def search(self, query: str, k: Optional[int] = None) -> list[tuple[int, float]]:
+        """Return up to ``k`` ``(chunk index, score)`` pairs matching ``query``, best first."""
+
+        scores = self.scores(query)
+        order = np.argsort(-scores, kind="stable")
+        matches = order[scores[order] > 0]
+        if k is not None:
+            matches = matches[:k]
+        return [(int(i), float(scores[i])) for i in matches]
+
+
+@lru_cache(maxsize=8)
+def _index_for(text: str, chunk_tokens: int) -> LexicalIndex:
+    """Return the (memoised) index of ``text``; phases of one run share it."""
+
+    return LexicalIndex.from_text(text, chunk_tokens=chunk_tokens)
+
+
+def select_relevant_text(
+    text: str,
+    query: str,
+    *,
+    token_budget: int = RETRIEVAL_TOKEN_BUDGET,
+    chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS,
+) -> str:
+    """Return the parts of ``text`` most relevant to ``query`` within a token budget.
+
+    Text that already fits the budget is returned unchanged.  Otherwise it
+    is split into chunks, ranked with a :class:`LexicalIndex`, and the best
+    chunks are taken greedily until the budget is reached; chunks with no
+    matching terms follow in document order, so the budget is still used
+    when the query says little.  The selection is returned in document
+    order, with :data:`EXCERPT_SEPARATOR` marking gaps.
+
+    Parameters
+    ----------
+    text : str
+        The full document text.
+    query : str
+        What the excerpts should be about, e.g. the user's questions and
+        clarifications.
+    token_budget : int, optional
+        Maximum estimated tokens of the result.  Defaults to
+        ``RETRIEVAL_TOKEN_BUDGET``.
+    chunk_tokens : int, optional
+        Approximate size of the ranked chunks.  Defaults to
+        ``RETRIEVAL_CHUNK_TOKENS``.
+
+    Returns
+    -------
+    str
+        The selected excerpts.
+    """
+
+    if estimate_tokens(text) <= token_budget:
+        return text
+    index = _index_for(text, chunk_tokens)
+    ranked = [i for i, _ in index.search(query)]
+    matched = set(ranked)
+    ranked.extend(i for i in range(len(index)) if i not in matched)
+
+    budget_chars = token_budget * CHARS_PER_TOKEN
+    selected = []
+    used = 0
+    for i in ranked:
+        cost = len(index.chunks[i]) + len(EXCERPT_SEPARATOR)
+        if used + cost <= budget_chars:
+            selected.append(i)
+            used += cost
+    selected.sort()
+
+    parts = []
+    for position, i in enumerate(selected):
+        if position:
+            parts.append(PAGE_SEPARATOR if i == selected[position - 1] + 1 else EXCERPT_SEPARATOR)
+        parts.append(index.chunks[i])
+    return "".join(parts)
+
+
+# -----------------------------------------------------------------------------
+# Shared LLM clients
+# -----------------------------------------------------------------------------
+
+# Free-tier default; any model available on OpenRouter can be used instead.
+DEFAULT_MODEL_NAME = "z-ai/glm-4.5-air:free"
+
+_http_limits = httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=120.0)
+_http_client: Optional[httpx.Client] = None
+_chat_clients: Dict[tuple, "ChatOpenRouter"] = {}
+# Async connections belong to the event loop that opened them, so every
+# running loop gets its own async HTTP client and chat clients, dropped
+# together with the loop
+_loop_http_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = (
+    weakref.WeakKeyDictionary()
+)
+_loop_chat_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[tuple, ChatOpenRouter]]" = (
+    weakref.WeakKeyDictionary()
+)
+_client_lock = threading.Lock()
+
+# Set by a thread making hedged calls, see :class:`Hedger`
+_response_tracking = threading.local()
+
+
+def _track_response(response: httpx.Response) -> None:
+    """Response hook of the shared HTTP client: report responses to the thread's tracker."""
+
+    tracker = getattr(_response_tracking, "tracker", None)
+    if tracker is not None:
+        tracker.opened(response)
+
+
+def configure_http_pool(
+    *,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 120.0,
+) -> None:
+    """Set the connection-pool limits used by the shared LLM clients.
+
+    The shared HTTP clients and every cached :class:`ChatOpenRouter` are
+    dropped, so clients handed out afterwards use the new limits.  Clients
+    that callers still hold keep working on the old pool until they are
+    garbage collected.
+
+    Parameters
+    ----------
+    max_connections : int, optional
+        Maximum number of concurrent connections.  Defaults to ``100``.
+    max_keepalive_connections : int, optional
+        Maximum number of idle connections kept open for reuse.  Defaults
+        to ``20``.
+    keepalive_expiry : float, optional
+        Seconds an idle connection is kept before being closed.  Defaults
+        to ``120``.
+    """
+
+    global _http_limits, _http_client
+    with _client_lock:
+        _http_limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        _http_client = None
+        _chat_clients.clear()
+        _loop_http_clients.clear()
+        _loop_chat_clients.clear()
+
+
+def get_chat_client(
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    **kwargs: Any,
+) -> "ChatOpenRouter":
+    """Return a process-wide shared :class:`ChatOpenRouter` for this configuration.
+
+    Building a ``ChatOpenRouter`` per call gives every request its own HTTP
+    client and therefore a fresh TLS handshake with OpenRouter.  Clients
+    returned here are cached by ``(model_name, temperature, kwargs)`` and
+    all of them share one keep-alive connection pool (see
+    :func:`configure_http_pool`), so back-to-back analysis and assignment
+    calls, and calls from concurrent Streamlit sessions, reuse warm
+    connections.  The clients are safe to use from several threads.
+
+    Async connections belong to the event loop that opened them, so a
+    client fetched while a loop is running gets that loop's async HTTP
+    pool (and is cached per loop).  The async call paths of this module
+    switch to the running loop's client (see :func:`_loop_client`), so
+    successive ``asyncio.run(arun_...)`` calls each work on their own loop.
+
+    Parameters
+    ----------
+    model_name : str, optional
+        The model identifier to use on OpenRouter.  Defaults to
+        ``DEFAULT_MODEL_NAME``.
+    temperature : float, optional
+        Sampling temperature.  Defaults to ``0.0``.
+    **kwargs : Any
+        Further keyword arguments for :class:`ChatOpenRouter`; they are
+        part of the cache key.  ``stream_usage`` defaults to ``True`` so
+        streamed responses report token usage too, and ``max_retries`` to
+        ``0`` because retries are handled by :class:`RetryPolicy`.
+
+    Returns
+    -------
+    ChatOpenRouter
+        A shared, ready-to-use chat model.
+    """
+
+    global _http_client
+    # ChatOpenAI stops requesting usage on streams once it is handed an
+    # http_client; TokenUsage needs it on every call, streamed or not
+    kwargs.setdefault("stream_usage", True)
+    # Retries belong to RetryPolicy (see _resilient_call), which honours
+    # Retry-After and feeds the circuit breakers; SDK retries would multiply
+    # every attempt into several requests behind its back
+    kwargs.setdefault("max_retries", 0)
+    # Resolve the endpoint up front so it is part of the key, and a client
+    # rebuilt from another's settings (see _client_settings) is the same one
+    kwargs.setdefault("base_url", os.environ.get("OPENROUTER_BASE_URL") or DEFAULT_OPENROUTER_BASE_URL)
+    key = (model_name, temperature, tuple(sorted((k, repr(v)) for k, v in kwargs.items())))
+    try:
+        loop: Optional[asyncio.AbstractEventLoop] = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = None
+    with _client_lock:
+        clients = _chat_clients if loop is None else _loop_chat_clients.setdefault(loop, {})
+        llm = clients.get(key)
+        if llm is None:
+            if _http_client is None:
+                _http_client = httpx.Client(limits=_http_limits, event_hooks={"response": [_track_response]})
+            http_async_client = None
+            if loop is not None:
+                http_async_client = _loop_http_clients.get(loop)
+                if http_async_client is None:
+                    http_async_client = _loop_http_clients[loop] = httpx.AsyncClient(limits=_http_limits)
+            llm = ChatOpenRouter(
+                model_name=model_name,
+                temperature=temperature,
+                http_client=_http_client,
+                http_async_client=http_async_client,
+                **kwargs,
+            )
+            llm._shared_spec = (model_name, temperature, kwargs)
+            clients[key] = llm
+        return llm
+
+
+def _loop_client(llm: Any) -> Any:
+    """Return the counterpart of a shared client for the running event loop.
+
+    ``llm`` may have been fetched outside the loop, or on another one whose
+    connections cannot be used here.  Models that did not come from
+    :func:`get_chat_client` are returned unchanged.
+    """
+
+    spec = getattr(llm, "_shared_spec", None)
+    if spec is None:
+        return llm
+    model_name, temperature, kwargs = spec
+    return get_chat_client(model_name, temperature, **kwargs)
+
+
+# -----------------------------------------------------------------------------
+# LLM call resilience
+# -----------------------------------------------------------------------------
+
+# Status codes worth retrying: timeouts, rate limits and server-side errors
+_RETRYABLE_STATUSES = frozenset({408, 409, 425, 429, 500, 502, 503, 504, 520, 522, 524, 529})
+
+
+def _status_code(exc: BaseException) -> Optional[int]:
+    """Return the HTTP status carried by an OpenAI/httpx error, if any."""
+
+    status = getattr(exc, "status_code", None)
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+
+def _retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Parse the ``Retry-After`` header of a failed response, in seconds.
+
+    Both forms allowed by RFC 9110 are understood: a number of seconds and
+    an HTTP date.  Returns ``None`` when the header is missing or invalid.
+    """
+
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    """Whether ``exc`` is a transient failure that another attempt may fix."""
+
+    if isinstance(exc, (openai.APIConnectionError, httpx.TransportError, ConnectionError, TimeoutError)):
+        return True
+    return _status_code(exc) in _RETRYABLE_STATUSES
+
+
+def _model_name(llm: Any) -> str:
+    return getattr(llm, "model_name", None) or type(llm).__name__
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised when every candidate model's circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Per-model circuit breaker.
+
+    After ``failure_threshold`` consecutive transient failures the breaker
+    opens and calls to the model are skipped (so they fall through to the
+    next fallback model straight away) for ``reset_timeout`` seconds.  Then
+    a single trial call is let through: success closes the breaker again,
+    failure re-opens it for another ``reset_timeout``.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        """``"closed"``, ``"open"`` or ``"half-open"``."""
+
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return "open"
+            return "half-open"
+
+    def allow(self) -> bool:
+        """Return whether a call may be made now."""
+
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial_running:
+                return False
+            self._trial_running = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+    def release(self) -> None:
+        """Free the trial slot of a call that ended without an outcome (e.g. cancelled)."""
+
+        with self._lock:
+            self._trial_running = False
+
+
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(model_name: str) -> CircuitBreaker:
+    """Return the process-wide :class:`CircuitBreaker` of ``model_name``."""
+
+    with _client_lock:
+        breaker = _circuit_breakers.get(model_name)
+        if breaker is None:
+            breaker = _circuit_breakers[model_name] = CircuitBreaker()
+        return breaker
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """How model calls recover from transient failures.
+
+    Each candidate model (the requested one, then ``fallback_models`` in
+    order) gets up to ``max_attempts`` calls.  Between attempts the call
+    waits for the server's ``Retry-After`` when given, otherwise for a
+    random delay of up to ``base_delay * 2 ** (attempt - 1)`` seconds
+    ("full jitter"), capped at ``max_delay``.  A ``Retry-After`` longer
+    than ``max_delay`` moves on to the next model instead of waiting.
+    """
+
+    max_attempts: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    fallback_models: tuple[str, ...] = ()
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """Default policy, with fallbacks from ``OPENROUTER_FALLBACK_MODELS`` (comma separated)."""
+
+        names = os.environ.get("OPENROUTER_FALLBACK_MODELS", "")
+        return cls(fallback_models=tuple(name.strip() for name in names.split(",") if name.strip()))
+
+    def delay(self, attempt: int, exc: BaseException) -> Optional[float]:
+        """Seconds to wait before retry number ``attempt``, or ``None`` to give up on the model."""
+
+        retry_after = _retry_after_seconds(exc)
+        if retry_after is not None:
+            return retry_after if retry_after <= self.max_delay else None
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+def _retry_policy(options: Mapping[str, Any]) -> Optional[RetryPolicy]:
+    """The run's ``retry_policy``; :meth:`RetryPolicy.from_env` if unset, ``None`` to disable."""
+
+    if "retry_policy" in options:
+        return options["retry_policy"]
+    return RetryPolicy.from_env()
+
+
+# Request-shaping ChatOpenRouter fields carried over to stand-in models
+# (fallbacks, hedges), mapped to the keyword argument that sets them
+_FORWARDED_CLIENT_SETTINGS = {
+    "openai_api_base": "base_url",
+    "max_tokens": "max_tokens",
+    "request_timeout": "timeout",
+    "top_p": "top_p",
+    "frequency_penalty": "frequency_penalty",
+    "presence_penalty": "presence_penalty",
+    "seed": "seed",
+    "stop": "stop",
+    "model_kwargs": "model_kwargs",
+    "extra_body": "extra_body",
+    "default_headers": "default_headers",
+    "stream_usage": "stream_usage",
+    "max_retries": "max_retries",
+}
+
+
+def _client_settings(llm: Any) -> Dict[str, Any]:
+    """Return the :func:`get_chat_client` keyword arguments that reproduce ``llm``'s requests.
+
+    Only settings that differ from the field defaults are returned, so a
+    plain client maps to the same shared client as ``get_chat_client(name,
+    temperature)``.  Models that are not ``ChatOpenAI`` subclasses yield
+    nothing.
+    """
+
+    fields = getattr(type(llm), "model_fields", {})
+    settings: Dict[str, Any] = {}
+    for name, kwarg in _FORWARDED_CLIENT_SETTINGS.items():
+        if name not in fields:
+            continue
+        value = getattr(llm, name, None)
+        if value is None or value == fields[name].get_default(call_default_factory=True):
+            continue
+        settings[kwarg] = value
+    return settings
+
+
+def _candidate_models(llm: ChatOpenRouter, policy: RetryPolicy) -> Iterator[ChatOpenRouter]:
+    """Yield ``llm`` and then the shared clients of the policy's fallback models.
+
+    Fallback clients get ``llm``'s temperature and other request settings
+    (see :func:`_client_settings`), so they answer the same request.
+    """
+
+    yield llm
+    temperature = getattr(llm, "temperature", None)
+    settings = _client_settings(llm)
+    for name in policy.fallback_models:
+        if name != _model_name(llm):
+            yield get_chat_client(name, temperature, **settings)
+
+
+def _resilient_call(llm: ChatOpenRouter, options: Mapping[str, Any], call: Any) -> Any:
+    """Run ``call(model)`` with retries, circuit breakers and model fallback.
+
+    Transient failures (see :func:`_is_retryable`) are retried and then
+    passed on to the next fallback model; any other error is raised
+    straight away.  If every model fails, the last error is raised.
+    """
+
+    policy = _retry_policy(options)
+    if policy is None:
+        return call(llm)
+
+    last_error: Optional[BaseException] = None
+    for model in _candidate_models(llm, policy):
+        breaker = get_circuit_breaker(_model_name(model))
+        for attempt in range(1, policy.max_attempts + 1):
+            if not breaker.allow():
+                break
+            try:
+                result = call(model)
+            except Exception as exc:
+                if not _is_retryable(exc):
+                    # The request was at fault, not the model: it is healthy
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                last_error = exc
+                delay = policy.delay(attempt, exc)
+                if delay is None or attempt == policy.max_attempts:
+                    break
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled or interrupted: don't leave a half-open trial pending
+                breaker.release()
+                raise
+            breaker.record_success()
+            return result
+    if last_error is not None:
+        raise last_error
+    raise CircuitOpenError(f"circuit open for {_model_name(llm)} and all fallback models")
+
+
+async def _aresilient_call(llm: ChatOpenRouter, options: Mapping[str, Any], call: Any) -> Any:
+    """Async version of :func:`_resilient_call`; ``call(model)`` returns an awaitable."""
+
+    policy = _retry_policy(options)
+    if policy is None:
+        return await call(_loop_client(llm))
+
+    last_error: Optional[BaseException] = None
+    for model in _candidate_models(llm, policy):
+        breaker = get_circuit_breaker(_model_name(model))
+        for attempt in range(1, policy.max_attempts + 1):
+            if not breaker.allow():
+                break
+            try:
+                result = await call(_loop_client(model))
+            except Exception as exc:
+                if not _is_retryable(exc):
+                    # The request was at fault, not the model: it is healthy
+                    breaker.record_success()
+                    raise
+                breaker.record_failure()
+                last_error = exc
+                delay = policy.delay(attempt, exc)
+                if delay is None or attempt == policy.max_attempts:
+                    break
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled or interrupted: don't leave a half-open trial pending
+                breaker.release()
+                raise
+            breaker.record_success()
+            return result
+    if last_error is not None:
+        raise last_error
+    raise CircuitOpenError(f"circuit open for {_model_name(llm)} and all fallback models")
+
+
+class _HedgeAborted(Exception):
+    """Raised in a losing hedged request to stop it."""
+
+
+class _AbortableRequests:
+    """The HTTP responses opened by one side of a hedged call.
+
+    The side's thread registers itself via ``_response_tracking``; once the
+    other side has won, :meth:`abort` shuts down the sockets of the open
+    responses, waking a thread blocked waiting for the first token, and
+    makes any response that arrives later fail straight away.
+    """
+
+    def __init__(self) -> None:
+        self._responses: list[httpx.Response] = []
+        self._aborted = False
+        self._lock = threading.Lock()
+
+    def opened(self, response: httpx.Response) -> None:
+        with self._lock:
+            if self._aborted:
+                raise _HedgeAborted("the other hedged request won")
+            self._responses.append(response)
+
+    def abort(self) -> None:
+        with self._lock:
+            self._aborted = True
+            responses, self._responses = self._responses, []
+        for response in responses:
+            network_stream = response.extensions.get("network_stream")
+            sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+            if sock is not None:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+class Hedger:
+    """Hedge slow model calls with a duplicate request to a secondary model.
+
+    Pass one to the ``run_*`` helpers or put it in the run configuration as
+    ``hedger``.  Calls are then streamed; if the first token has not
+    arrived after :meth:`delay` seconds (the ``percentile`` of recently
+    observed first-token latencies, or ``initial_delay`` until
+    ``min_samples`` have been seen), the same request is sent to
+    ``secondary_model``.  Whichever completes first wins and the other is
+    cancelled: async calls cancel the task; sync calls shut down the
+    loser's connection (for clients from :func:`get_chat_client`), or
+    otherwise stop reading its stream at the next chunk.  Streamed calls
+    (:func:`stream_assignment`) race only until the first chunk: the side
+    that produced it is streamed to the caller and the other is cancelled.
+
+    A primary that is abandoned before its first token (because the
+    secondary won, or the call was cancelled) is sampled at the time it was
+    abandoned, a lower bound on its latency; skipping it would drag the
+    percentile down and hedge ever more often.  :meth:`stats` reports how
+    often requests were hedged and which side won.
+    """
+
+    def __init__(
+        self,
+        secondary_model: str,
+        *,
+        percentile: float = 95.0,
+        min_samples: int = 20,
+        initial_delay: float = 10.0,
+        window: int = 200,
+    ) -> None:
+        self.secondary_model = secondary_model
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.requests = 0
+        self.hedged = 0
+        self.primary_wins = 0
+        self.secondary_wins = 0
+        self._first_token_seconds: deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self) -> float:
+        """Seconds to wait for a first token before hedging."""
+
+        with self._lock:
+            if len(self._first_token_seconds) < self.min_samples:
+                return self.initial_delay
+            return float(np.percentile(self._first_token_seconds, self.percentile))
+
+    def stats(self) -> Dict[str, float]:
+        """Return the request, hedge and win counters and the hedge rate."""
+
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+                "primary_wins": self.primary_wins,
+                "secondary_wins": self.secondary_wins,
+            }
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _observe(self, seconds: float) -> None:
+        with self._lock:
+            self._first_token_seconds.append(seconds)
+
+    def _secondary(self, llm: ChatOpenRouter) -> ChatOpenRouter:
+        # Same temperature and request settings, so the hedge asks the same thing
+        return get_chat_client(self.secondary_model, getattr(llm, "temperature", None), **_client_settings(llm))
+
+    def invoke(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> Any:
+        """Call ``llm`` with ``messages``, hedging if it is slow; returns the message."""
+
+        return self._race(llm, messages)[1]
+
+    async def ainvoke(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> Any:
+        """Async version of :meth:`invoke`."""
+
+        return (await self._arace(llm, messages))[1]
+
+    def stream(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> Iterator[Any]:
+        """Stream ``llm``'s reply to ``messages``, hedging if the first chunk is slow."""
+
+        return self._race_stream(llm, messages)[1]
+
+    def _race(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> tuple[ChatOpenRouter, Any]:
+        """Implement :meth:`invoke`; returns the model that answered with its message."""
+
+        self._count("requests")
+        results: "queue.Queue[tuple[str, Any, Optional[BaseException]]]" = queue.Queue()
+        cancel = threading.Event()
+        requests = {"primary": _AbortableRequests(), "secondary": _AbortableRequests()}
+        sample_lock = threading.Lock()
+        sampled = []
+
+        def sample_primary(seconds: float) -> None:
+            # One sample per request: the first token, or a lower bound if it never came
+            with sample_lock:
+                if sampled:
+                    return
+                sampled.append(seconds)
+            self._observe(seconds)
+
+        def run(model: ChatOpenRouter, side: str, first_token: threading.Event) -> None:
+            _response_tracking.tracker = requests[side]
+            start = time.perf_counter()
+            message = None
+            try:
+                stream = model.stream(messages, stream_usage=True)
+                try:
+                    for chunk in stream:
+                        if message is None:
+                            first_token.set()
+                            if side == "primary":
+                                sample_primary(time.perf_counter() - start)
+                        if cancel.is_set():
+                            return
+                        message = chunk if message is None else message + chunk
+                finally:
+                    stream.close()
+                results.put((side, message, None))
+            except Exception as exc:
+                results.put((side, None, exc))
+            finally:
+                first_token.set()
+
+        primary_started = threading.Event()
+        primary_start = time.perf_counter()
+        threading.Thread(target=run, args=(llm, "primary", primary_started), name="hedge-primary", daemon=True).start()
+        if primary_started.wait(self.delay()):
+            _, message, error = results.get()
+            if error is not None:
+                raise error
+            return llm, message if message is not None else AIMessage(content="")
+
+        self._count("hedged")
+        models = {"primary": llm, "secondary": self._secondary(llm)}
+        threading.Thread(
+            target=run, args=(models["secondary"], "secondary", threading.Event()), name="hedge-secondary", daemon=True
+        ).start()
+        errors = {}
+        for _ in range(2):
+            side, message, error = results.get()
+            if error is None:
+                cancel.set()
+                requests["secondary" if side == "primary" else "primary"].abort()
+                if "primary" not in errors:
+                    # A primary aborted before its first token took at least this long
+                    sample_primary(time.perf_counter() - primary_start)
+                self._count(f"{side}_wins")
+                return models[side], message if message is not None else AIMessage(content="")
+            errors[side] = error
+        raise next(iter(errors.values()))
+
+    def _race_stream(
+        self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]
+    ) -> tuple[ChatOpenRouter, Iterator[Any]]:
+        """Implement :meth:`stream`; returns the model that was kept with its chunks.
+
+        Returns once the first chunk has arrived, so failures to start are
+        raised here and can be retried.  Closing the returned iterator
+        early cancels the kept stream as well.
+        """
+
+        self._count("requests")
+        events: "queue.Queue[tuple[str, str, Any]]" = queue.Queue()
+        cancel = {"primary": threading.Event(), "secondary": threading.Event()}
+        requests = {"primary": _AbortableRequests(), "secondary": _AbortableRequests()}
+
+        def run(model: ChatOpenRouter, side: str) -> None:
+            _response_tracking.tracker = requests[side]
+            try:
+                stream = model.stream(messages, stream_usage=True)
+                try:
+                    for chunk in stream:
+                        if cancel[side].is_set():
+                            return
+                        events.put((side, "chunk", chunk))
+                finally:
+                    stream.close()
+                events.put((side, "end", None))
+            except Exception as exc:
+                events.put((side, "error", exc))
+
+        def start(model: ChatOpenRouter, side: str) -> None:
+            threading.Thread(target=run, args=(model, side), name=f"hedge-{side}", daemon=True).start()
+
+        models = {"primary": llm}
+        primary_start = time.perf_counter()
+        start(llm, "primary")
+        errors: Dict[str, BaseException] = {}
+        while True:
+            try:
+                side, kind, payload = events.get(timeout=None if "secondary" in models else self.delay())
+            except queue.Empty:
+                self._count("hedged")
+                models["secondary"] = self._secondary(llm)
+                start(models["secondary"], "secondary")
+                continue
+            if kind != "error":
+                break
+            errors[side] = payload
+            if len(errors) == len(models):
+                raise next(iter(errors.values()))
+
+        # The race is over: keep this side's stream and cancel the other
+        loser = "secondary" if side == "primary" else "primary"
+        cancel[loser].set()
+        requests[loser].abort()
+        if "primary" not in errors:
+            # The primary's first token, or a lower bound if it lost
+            self._observe(time.perf_counter() - primary_start)
+        if "secondary" in models:
+            self._count(f"{side}_wins")
+
+        def chunks(event: tuple[str, str, Any]) -> Iterator[Any]:
+            finished = False
+            try:
+                while True:
+                    event_side, kind, payload = event
+                    if event_side == side:
+                        if kind == "end":
+                            finished = True
+                            return
+                        if kind == "error":
+                            finished = True
+                            raise payload
+                        yield payload
+                    event = events.get()
+            finally:
+                if not finished:
+                    cancel[side].set()
+                    requests[side].abort()
+
+        return models[side], chunks((side, kind, payload))
+
+    async def _arace(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> tuple[ChatOpenRouter, Any]:
+        """Async version of :meth:`_race`."""
+
+        self._count("requests")
+
+        async def run(model: ChatOpenRouter, first_token: Optional[asyncio.Event]) -> Any:
+            start = time.perf_counter()
+            message = None
+            async for chunk in model.astream(messages, stream_usage=True):
+                if message is None and first_token is not None:
+                    first_token.set()
+                    self._observe(time.perf_counter() - start)
+                message = chunk if message is None else message + chunk
+            return message if message is not None else AIMessage(content="")
+
+        primary_started = asyncio.Event()
+        primary_start = time.perf_counter()
+        primary = asyncio.ensure_future(run(llm, primary_started))
+        started = asyncio.ensure_future(primary_started.wait())
+        secondary = None
+        try:
+            done, _ = await asyncio.wait({primary, started}, timeout=self.delay(), return_when=asyncio.FIRST_COMPLETED)
+            if done:
+                return llm, await primary
+
+            self._count("hedged")
+            secondary_llm = self._secondary(llm)
+            secondary = asyncio.ensure_future(run(secondary_llm, None))
+            pending = {primary, secondary}
+            first_error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        self._count("primary_wins" if task is primary else "secondary_wins")
+                        return (llm if task is primary else secondary_llm), task.result()
+                    first_error = first_error or task.exception()
+            raise first_error
+        finally:
+            primary_failed = primary.done() and not primary.cancelled() and primary.exception() is not None
+            if not primary_started.is_set() and not primary_failed:
+                # Lost, or cancelled by the caller, before its first token
+                self._observe(time.perf_counter() - primary_start)
+            for task in (primary, started, secondary):
+                if task is not None:
+                    task.cancel()
+
+
+# -----------------------------------------------------------------------------
+# LLM response cache
+# -----------------------------------------------------------------------------
+
+class LLMResponseCache:
+    """SQLite-backed cache of model responses keyed on the exact request.
+
+    When a whole class submits the same handout and prompt, every request
+    after the first is answered from here instead of paying for another LLM
+    round trip.  Keys are the SHA-256 of the model name, temperature and
+    the exact messages, so any change to the document, questions,
+    clarifications or model is a miss.  Only deterministic requests
+    (temperature ``0``) are cached; see :func:`_invoke_llm`.
+
+    Entries older than ``ttl`` seconds are ignored and purged, and once
+    more than ``max_entries`` are stored the least recently used ones are
+    evicted.  The cache is safe to share between threads and, thanks to
+    SQLite's locking, between processes using the same file.
+
+    Parameters
+    ----------
+    path : Optional[str], optional
+        Database file.  Defaults to ``LLM_CACHE_PATH`` from the environment
+        or a file in the per-user cache directory (see
+        :func:`_user_cache_dir`).
+    ttl : float, optional
+        Lifetime of an entry in seconds.  Defaults to seven days.
+    max_entries : int, optional
+        Maximum number of stored responses.  Defaults to ``1000``.
+    """
+
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        *,
+        ttl: float = 7 * 24 * 3600,
+        max_entries: int = 1000,
+    ) -> None:
+        self.path = path or os.environ.get("LLM_CACHE_PATH") or os.path.join(
+            _user_cache_dir(), "llm_responses.sqlite3"
+        )
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT, content TEXT, created REAL, accessed REAL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+    @staticmethod
+    def key_for(model_name: str, temperature: Optional[float], messages: list[Dict[str, Any]]) -> str:
+        """Return the cache key for a request."""
+
+        payload = json.dumps(
+            {"model": model_name, "temperature": temperature, "messages": messages},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response text for ``key`` or ``None`` on a miss."""
+
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute(
+                "SELECT content FROM responses WHERE key = ? AND created >= ?",
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, model_name: str, content: str) -> None:
+        """Store a response and evict expired and least recently used entries."""
+
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, content, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model_name, content, now, now),
+            )
+            self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        """Remove every entry and reset the hit/miss counters."""
+
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM responses")
+            self.hits = 0
+            self.misses = 0
+
+    def close(self) -> None:
+        """Close the underlying database connection."""
+
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters and the number of stored responses."""
+
+        with self._lock:
+            (entries,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+_default_llm_response_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_response_cache() -> LLMResponseCache:
+    """Return the process-wide :class:`LLMResponseCache`, creating it on first use."""
+
+    global _default_llm_response_cache
+    with _client_lock:
+        if _default_llm_response_cache is None:
+            _default_llm_response_cache = LLMResponseCache()
+        return _default_llm_response_cache
+
+
+# -----------------------------------------------------------------------------
+# Record/replay cassettes
+# -----------------------------------------------------------------------------
+
+class CassetteMissError(LookupError):
+    """Raised when a replaying :class:`Cassette` has no recording for a request."""
+
+
+class Cassette:
+    """Records model calls to a file and plays them back without a network.
+
+    In ``"record"`` mode every model call made by the graph nodes goes out
+    as usual and the request key (see :meth:`LLMResponseCache.key_for`),
+    response text, token usage and wall-clock latency are captured; streamed
+    calls also keep each text delta with its offset from the start of the
+    call.  :meth:`save` writes everything as gzip-compressed JSON.  In
+    ``"replay"`` mode the file is loaded and calls are answered from it,
+    skipping the retry layer and the network entirely, so whole-pipeline
+    runs are deterministic.  With ``simulate_latency`` the recorded timings
+    are slept through (first token and inter-chunk gaps for streams),
+    otherwise replies are instant.
+
+    A request recorded several times (e.g. by a benchmark looping over the
+    same document) is replayed in recording order, wrapping around.  A
+    request that was never recorded raises :class:`CassetteMissError`.
+
+    Activate a cassette with :func:`use_cassette` or by passing it as
+    ``cassette`` in the run configuration.  Calls answered by the
+    :class:`LLMResponseCache` never reach the cassette, so record without a
+    response cache.
+
+    Parameters
+    ----------
+    path : str
+        Cassette file, conventionally ``*.json.gz``.
+    mode : str, optional
+        ``"replay"`` (default) or ``"record"``.  Recording starts empty and
+        replaces the file on :meth:`save`.
+    simulate_latency : bool, optional
+        Replay with the recorded timings.  Defaults to ``False``.
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: str, mode: str = "replay", *, simulate_latency: bool = False) -> None:
+        if mode not in ("record", "replay"):
+            raise ValueError(f"mode must be 'record' or 'replay', not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.simulate_latency = simulate_latency
+        self._interactions: Dict[str, list[Dict[str, Any]]] = {}
+        self._plays: Counter = Counter()
+        self._lock = threading.Lock()
+        if mode == "replay":
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") != self.VERSION:
+                raise ValueError(f"unsupported cassette version {data.get('version')!r} in {path}")
+            for interaction in data["interactions"]:
+                self._interactions.setdefault(interaction.pop("key"), []).append(interaction)
+
+    def __len__(self) -> int:
+        return sum(len(interactions) for interactions in self._interactions.values())
+
+    @staticmethod
+    def _key(llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> str:
+        return LLMResponseCache.key_for(_model_name(llm), getattr(llm, "temperature", None), messages)
+
+    def record(
+        self,
+        llm: ChatOpenRouter,
+        messages: list[Dict[str, Any]],
+        content: str,
+        usage_metadata: Optional[Mapping[str, Any]],
+        latency: float,
+        chunks: Optional[list[tuple[float, str]]] = None,
+        model_name: Optional[str] = None,
+    ) -> None:
+        """Add one call; ``chunks`` are ``(offset_seconds, delta)`` pairs of a stream.
+
+        The call is filed under the request made to ``llm``; ``model_name``
+        names the model that actually answered it, if that was another one
+        (a fallback or a hedge).
+        """
+
+        interaction: Dict[str, Any] = {
+            "model": model_name or _model_name(llm),
+            "content": content,
+            "usage": dict(usage_metadata) if usage_metadata else None,
+            "latency": round(latency, 4),
+        }
+        if chunks is not None:
+            interaction["chunks"] = [[round(offset, 4), delta] for offset, delta in chunks]
+        with self._lock:
+            self._interactions.setdefault(self._key(llm, messages), []).append(interaction)
+
+    def save(self) -> None:
+        """Write the recorded calls to :attr:`path`, replacing the file atomically."""
+
+        with self._lock:
+            interactions = [
+                {"key": key, **interaction}
+                for key, recorded in self._interactions.items()
+                for interaction in recorded
+            ]
+        tmp_path = f"{self.path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump({"version": self.VERSION, "interactions": interactions}, f, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+
+    def lookup(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> Dict[str, Any]:
+        """Return the next recorded interaction for this request."""
+
+        key = self._key(llm, messages)
+        with self._lock:
+            recorded = self._interactions.get(key)
+            if not recorded:
+                raise CassetteMissError(
+                    f"no recording of this {_model_name(llm)} request in {self.path}; "
+                    "record the cassette again"
+                )
+            interaction = recorded[self._plays[key] % len(recorded)]
+            self._plays[key] += 1
+        return interaction
+
+    @staticmethod
+    def _message(interaction: Mapping[str, Any]) -> AIMessage:
+        return AIMessage(
+            content=interaction["content"],
+            usage_metadata=interaction["usage"],
+            response_metadata={"model_name": interaction["model"]},
+        )
+
+    def play(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> AIMessage:
+        """Replay a call as the ``AIMessage`` the model returned."""
+
+        interaction = self.lookup(llm, messages)
+        if self.simulate_latency:
+            time.sleep(interaction["latency"])
+        return self._message(interaction)
+
+    async def aplay(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> AIMessage:
+        """Async version of :meth:`play`."""
+
+        interaction = self.lookup(llm, messages)
+        if self.simulate_latency:
+            await asyncio.sleep(interaction["latency"])
+        return self._message(interaction)
+
+    def play_stream(self, llm: ChatOpenRouter, messages: list[Dict[str, Any]]) -> Iterator[AIMessage]:
+        """Replay a call as stream chunks, the last one carrying the token usage.
+
+        A call recorded without streaming is replayed as a single chunk.
+        """
+
+        interaction = self.lookup(llm, messages)
+        chunks = interaction.get("chunks") or [[interaction["latency"], interaction["content"]]]
+        start = time.perf_counter()
+        for offset, delta in chunks:
+            if self.simulate_latency:
+                time.sleep(max(0.0, offset - (time.perf_counter() - start)))
+            yield AIMessage(content=delta, response_metadata={"model_name": interaction["model"]})
+        if self.simulate_latency:
+            time.sleep(max(0.0, interaction["latency"] - (time.perf_counter() - start)))
+        if interaction["usage"]:
+            yield AIMessage(content="", usage_metadata=interaction["usage"])
+
+
+_default_cassette: Optional[Cassette] = None
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = "replay", *, simulate_latency: bool = False) -> Iterator[Cassette]:
+    """Record or replay every model call made inside the block.
+
+    The cassette applies to all graph runs, including the ``run_*``
+    helpers, from any thread, unless a run configuration names its own
+    ``cassette``.  In record mode the file is written when the block exits.
+
+    Example::
+
+        with use_cassette("pipeline.json.gz", "record"):
+            run_pipeline(pdf_text, questions)
+
+        with use_cassette("pipeline.json.gz", simulate_latency=True):
+            run_pipeline(pdf_text, questions)  # no network
+    """
+
+    global _default_cassette
+    cassette = Cassette(path, mode, simulate_latency=simulate_latency)
+    previous, _default_cassette = _default_cassette, cassette
+    try:
+        yield cassette
+    finally:
+        _default_cassette = previous
+        if mode == "record":
+            cassette.save()
+
+
+def _cassette(options: Mapping[str, Any]) -> Optional[Cassette]:
+    """Return the cassette for a call: the configuration's, else the active one."""
+
+    cassette = options.get("cassette")
+    return cassette if cassette is not None else _default_cassette
+
+
+def _merge_indexed(left: Optional[Dict[int, str]], right: Optional[Dict[int, str]]) -> Dict[int, str]:
+    """State reducer combining indexed outputs from parallel branches."""
+
+    return {**(left or {}), **(right or {})}
+
+
+class ProcessState(TypedDict, total=False):
+    """State type for the LangGraph workflow.
+
+    Fields
+    ------
+    pdf_text : str
+        The full textual content extracted from the uploaded PDF.
+    questions : str
+        User‑provided questions or assignment instructions.
+    clarifications : Optional[str]
+        Clarifications supplied by the user after the analysis phase.
+    analysis : Optional[str]
+        The output of the analysis phase (summary, topics, ambiguities).
+    assignment : Optional[str]
+        The final generated assignment.
+    chunk_summaries : Dict[int, str]
+        Per-chunk notes written by the map step of a long-document
+        analysis, keyed by chunk index.  Merged across parallel branches.
+    outline : list[Dict[str, str]]
+        The section plan of a sectioned assignment: ``kind``, ``heading``
+        and ``brief`` of each section, in order.
+    sections : Dict[int, str]
+        The written sections of a sectioned assignment, keyed by their
+        position in ``outline``.  Merged across parallel branches.
+    """
+
+    pdf_text: str
+    questions: str
+    clarifications: Optional[str]
+    analysis: Optional[str]
+    assignment: Optional[str]
+    chunk_summaries: Annotated[Dict[int, str], _merge_indexed]
+    outline: list[Dict[str, str]]
+    sections: Annotated[Dict[int, str], _merge_indexed]
+
+
+def _node_llm(config: Optional[RunnableConfig], llm: Optional[ChatOpenRouter]) -> ChatOpenRouter:
+    """Resolve the model a node should call.
+
+    Graphs are compiled once and shared, so the model is not baked into
+    them; it travels in ``config["configurable"]["llm"]`` at invocation
+    time.  An explicit ``llm`` argument (handy when calling a node directly)
+    takes precedence.
+    """
+
+    if llm is None:
+        llm = ((config or {}).get("configurable") or {}).get("llm")
+    if llm is None:
+        raise ValueError(
+            "No LLM supplied: invoke the graph with config={'configurable': {'llm': ...}}."
+        )
+    return llm
+
+
+# System prompt instructs the model how to behave during the analysis phase
+_ANALYSIS_SYSTEM_PROMPT = (
+    "You are a specialized AI academic assistant designed to analyse uploaded "
+    "documents and instructions in order to prepare high‑quality assignments. "
+    "During this analysis step you must carefully read the provided PDF "
+    "content and any user questions or instructions. Extract and summarise "
+    "the key topics, definitions, and explicit instructions found in the "
+    "document. Also identify any ambiguous or unclear instructions that "
+    "require clarification. Your output should be structured as follows:\n\n"
+    "1. Summary: A concise summary of the document.\n"
+    "2. Key Topics: A bulleted list of the main topics and subtopics found in the document.\n"
+    "3. Explicit Instructions: Any explicit assignment instructions extracted verbatim from the document.\n"
+    "4. Ambiguities: A list of questions for the user about parts of the document or instructions that are unclear or ambiguous.\n\n"
+    "If there are no ambiguities, write 'None' under the Ambiguities section."
+)
+
+# System prompt for the assignment generation phase
+_ASSIGNMENT_SYSTEM_PROMPT = (
+    "You are a specialized AI academic assistant designed to generate high‑quality "
+    "assignments based on provided documents and user instructions.  Use the "
+    "content extracted from the PDF and any clarifications to create a well‑"
+    "structured assignment suitable for university submission.  Your response "
+    "must adhere to the following format:\n\n"
+    "# Introduction\nProvide a brief overview of the topic and its significance.\n\n"
+    "# Body\nOrganise the main body into logical sections with headings.  Provide "
+    "detailed explanations, analysis and relevant examples derived from the "
+    "source material.\n\n"
+    "# Conclusion\nSummarise the key points discussed and offer any conclusions or "
+    "recommendations based on the analysed content.\n\n"
+    "# References\nIf applicable, list all sources referenced.  Use any citation details "
+    "available in the document (e.g. authors, titles, publication dates) or, "
+    "if none are present, leave this section empty.\n\n"
+    "Ensure the assignment is coherent, logically organised and free from "
+    "plagiarism.  Write in formal academic language."
+)
+
+
+# Opening of the shared document message used by the prefix-stable layout
+_DOCUMENT_PREFIX_INTRO = (
+    "The source document for this conversation follows.  Later messages "
+    "refer to it as the document.\n\n"
+)
+
+
+def _document_message(pdf_text: str) -> Dict[str, Any]:
+    """Return the leading message carrying the document in the prefix-stable layout.
+
+    It depends on nothing but the document, so it is byte-identical across
+    phases and users.  The ``cache_control`` marker asks providers that
+    need an explicit breakpoint (Anthropic, Gemini via OpenRouter) to cache
+    it; providers that cache prefixes automatically ignore it.
+    """
+
+    return {
+        "role": "system",
+        "content": [
+            {
+                "type": "text",
+                "text": _DOCUMENT_PREFIX_INTRO + pdf_text,
+                "cache_control": {"type": "ephemeral"},
+            }
+        ],
+    }
+
+
+def _phase_messages(
+    system_prompt: str,
+    pdf_text: str,
+    request: str,
+    config: Optional[RunnableConfig],
+) -> list[Dict[str, Any]]:
+    """Lay out the messages of one phase.
+
+    By default the phase's system prompt comes first and the document is
+    embedded in the user message ahead of ``request``.  With
+    ``prefix_cache`` set in the run configuration the document moves into
+    a leading message of its own (see :func:`_document_message`), followed
+    by the phase instructions and then the request, so provider-side
+    prompt caching can match the document across calls.
+    """
+
+    options = (config or {}).get("configurable") or {}
+    if options.get("prefix_cache"):
+        return [
+            _document_message(pdf_text),
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": request},
+        ]
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": f"Document Content:\n{pdf_text}\n\n{request}"},
+    ]
+
+
+def _analysis_messages(state: ProcessState, config: Optional[RunnableConfig] = None) -> list[Dict[str, Any]]:
+    """Build the chat messages for the analysis phase."""
+
+    questions = state.get("questions", "")
+    clarifications = state.get("clarifications", "") or ""
+    return _phase_messages(
+        _ANALYSIS_SYSTEM_PROMPT,
+        state.get("pdf_text", ""),
+        f"User Questions/Instructions:\n{questions}\n"
+        f"Existing Clarifications (if any):\n{clarifications}",
+        config,
+    )
+
+
+def _assignment_messages(state: ProcessState, config: Optional[RunnableConfig] = None) -> list[Dict[str, Any]]:
+    """Build the chat messages for the assignment phase.
+
+    Long documents are first narrowed to the relevant excerpts (see
+    :func:`_relevant_text`).  In compact mode (``compact_assignment`` in
+    the run configuration, with an analysis already in the state) the
+    prompt is built by :func:`_compact_assignment_messages` instead.
+    """
+
+    options = (config or {}).get("configurable") or {}
+    if options.get("compact_assignment") and state.get("analysis"):
+        return _compact_assignment_messages(state, config)
+
+    questions = state.get("questions", "")
+    clarifications = state.get("clarifications", "") or ""
+    return _phase_messages(
+        _ASSIGNMENT_SYSTEM_PROMPT,
+        _relevant_text(state, config),
+        f"User Questions/Instructions:\n{questions}\n\n"
+        f"Clarifications (if provided):\n{clarifications}",
+        config,
+    )
+
+
+# Document excerpts sent alongside the analysis in compact assignment mode
+COMPACT_EXCERPT_TOKENS = 3_000
+
+
+def _compact_assignment_messages(state: ProcessState, config: Optional[RunnableConfig] = None) -> list[Dict[str, Any]]:
+    """Build assignment messages from the analysis plus a few source excerpts.
+
+    The analysis already carries the summary, key topics and explicit
+    instructions, so instead of the whole document only the excerpts most
+    relevant to the questions are added, up to ``excerpt_token_budget``
+    (default :data:`COMPACT_EXCERPT_TOKENS`) for detail and quotations.
+    """
+
+    options = (config or {}).get("configurable") or {}
+    questions = state.get("questions", "")
+    clarifications = state.get("clarifications", "") or ""
+    excerpts = select_relevant_text(
+        state.get("pdf_text", "") or "",
+        f"{questions}\n{clarifications}",
+        token_budget=options.get("excerpt_token_budget", COMPACT_EXCERPT_TOKENS),
+    )
+    return [
+        {"role": "system", "content": _ASSIGNMENT_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                f"Document Analysis:\n{state.get('analysis', '')}\n\n"
+                f"Selected Document Excerpts:\n{excerpts}\n\n"
+                f"User Questions/Instructions:\n{questions}\n\n"
+                f"Clarifications (if provided):\n{clarifications}"
+            ),
+        },
+    ]
+
+
+def _relevant_text(state: ProcessState, config: Optional[RunnableConfig]) -> str:
+    """Return ``pdf_text`` narrowed to the excerpts relevant to the questions.
+
+    Uses :func:`select_relevant_text` with the ``retrieval_token_budget``
+    from the run configuration, querying with the questions and
+    clarifications.  The whole text is returned without a budget, and in
+    the prefix-stable layout, whose document message must not vary with
+    the questions.
+    """
+
+    pdf_text = state.get("pdf_text", "") or ""
+    options = (config or {}).get("configurable") or {}
+    budget = options.get("retrieval_token_budget")
+    if budget is None or options.get("prefix_cache"):
+        return pdf_text
+    query = f"{state.get('questions', '')}\n{state.get('clarifications') or ''}"
+    return select_relevant_text(pdf_text, query, token_budget=budget)
+
+
+# Documents above this many (estimated) tokens are analysed map-reduce style
+MAP_REDUCE_MIN_TOKENS = 24_000
+# Target size of each chunk summarised in the map step
+MAP_CHUNK_TOKENS = 6_000
+# Most model calls a single run keeps in flight when it fans out (chunk
+# summaries, sections).  Free-tier models rate limit aggressively, and a
+# burst of 429s would open the shared circuit breaker for everyone.
+MAX_LLM_CONCURRENCY = 4
+
+# System prompt for the map step of a long-document analysis
+_CHUNK_SUMMARY_SYSTEM_PROMPT = (
+    "You are a specialized AI academic assistant reading one section of a "
+    "longer document that is too large to analyse in one pass.  Write concise "
+    "notes on this section only, to be combined later with notes on the other "
+    "sections.  Cover:\n\n"
+    "- Summary: the main points of the section in a few sentences.\n"
+    "- Topics: the topics, subtopics and definitions it introduces.\n"
+    "- Instructions: any explicit assignment instructions, quoted verbatim.\n"
+    "- Unclear: anything ambiguous or unclear in the section.\n\n"
+    "Write 'None' for any part with nothing to report.  Do not invent content "
+    "that is not in the section."
+)
+
+
+def _chunk_summary_messages(chunk: str, index: int, count: int, questions: str) -> list[Dict[str, str]]:
+    """Build the chat messages summarising one chunk in the map step."""
+
+    return [
+        {"role": "system", "content": _CHUNK_SUMMARY_SYSTEM_PROMPT},
+        {
+            "role": "user",
+            "content": (
+                f"Section {index + 1} of {count}:\n{chunk}\n\n"
+                f"User Questions/Instructions (for context):\n{questions}"
+            ),
+        },
+    ]
+
+
+def _reduce_analysis_messages(state: ProcessState) -> list[Dict[str, Any]]:
+    """Build the analysis messages over the combined chunk notes.
+
+    The reduce step uses the regular analysis prompt, so its output has the
+    same Summary / Key Topics / Explicit Instructions / Ambiguities layout
+    as a single-shot analysis.  The notes differ from the document, so the
+    prefix-stable layout does not apply here.
+    """
+
+    summaries = state.get("chunk_summaries") or {}
+    notes = "\n\n".join(
+        f"=== Section {index + 1} of {len(summaries)} (notes) ===\n{summaries[index]}"
+        for index in sorted(summaries)
+    )
+    return _analysis_messages({**state, "pdf_text": notes})
+
+
+def _response_text(response: Any) -> str:
+    return response.content.strip() if hasattr(response, "content") else str(response)
+
+
+@dataclass
+class TokenUsage:
+    """Running totals of the token usage reported by the provider.
+
+    Pass one to the ``run_*`` helpers (it travels as ``usage`` in the run
+    configuration) to see what a run cost and how much of the prompt the
+    provider served from its prompt cache: ``cache_read_tokens`` comes from
+    ``usage_metadata["input_token_details"]["cache_read"]``.  Responses
+    answered by the local :class:`LLMResponseCache` make no call and are
+    not counted.
+    """
+
+    calls: int = 0
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def record(self, usage_metadata: Optional[Mapping[str, Any]]) -> None:
+        """Add one call and its ``usage_metadata`` (if the provider sent any)."""
+
+        usage_metadata = usage_metadata or {}
+        details = usage_metadata.get("input_token_details") or {}
+        with self._lock:
+            self.calls += 1
+            self.input_tokens += usage_metadata.get("input_tokens") or 0
+            self.output_tokens += usage_metadata.get("output_tokens") or 0
+            self.cache_read_tokens += details.get("cache_read") or 0
+
+    @property
+    def cache_hit_ratio(self) -> float:
+        """Fraction of input tokens read from the provider's prompt cache."""
+
+        return self.cache_read_tokens / self.input_tokens if self.input_tokens else 0.0
+
+
+def _call_llm(
+    llm: ChatOpenRouter, messages: list[Dict[str, Any]], options: Mapping[str, Any]
+) -> tuple[str, str]:
+    """Make one model call and record its usage; no caching.
+
+    The call goes through :func:`_resilient_call`, so transient failures
+    are retried and may be answered by a fallback model, and through the
+    configuration's ``hedger`` (a :class:`Hedger`), if any.  An active
+    :class:`Cassette` records the call, or answers it in replay mode.
+
+    Returns
+    -------
+    tuple[str, str]
+        The response text and the name of the model that produced it,
+        which is not ``llm``'s when a fallback or hedge answered.
+    """
+
+    cassette = _cassette(options)
+    hedger: Optional[Hedger] = options.get("hedger")
+    start = time.perf_counter()
+    if cassette is not None and cassette.mode == "replay":
+        response = cassette.play(llm, messages)
+        model_name = response.response_metadata.get("model_name") or _model_name(llm)
+    else:
+        if hedger is not None:
+            model, response = _resilient_call(llm, options, lambda model: hedger._race(model, messages))
+        else:
+            model, response = _resilient_call(llm, options, lambda model: (model, model.invoke(messages)))
+        model_name = _model_name(model)
+    if cassette is not None and cassette.mode == "record":
+        cassette.record(
+            llm, messages, response.content, response.usage_metadata, time.perf_counter() - start,
+            model_name=model_name,
+        )
+    usage: Optional[TokenUsage] = options.get("usage")
+    if usage is not None:
+        usage.record(getattr(response, "usage_metadata", None))
+    return _response_text(response), model_name
+
+
+async def _acall_llm(
+    llm: ChatOpenRouter, messages: list[Dict[str, Any]], options: Mapping[str, Any]
+) -> tuple[str, str]:
+    """Async version of :func:`_call_llm`."""
+
+    cassette = _cassette(options)
+    hedger: Optional[Hedger] = options.get("hedger")
+    start = time.perf_counter()
+    if cassette is not None and cassette.mode == "replay":
+        response = await cassette.aplay(llm, messages)
+        model_name = response.response_metadata.get("model_name") or _model_name(llm)
+    else:
+
+        async def call(model: ChatOpenRouter) -> tuple[ChatOpenRouter, Any]:
+            if hedger is not None:
+                return await hedger._arace(model, messages)
+            return model, await model.ainvoke(messages)
+
+        model, response = await _aresilient_call(llm, options, call)
+        model_name = _model_name(model)
+    if cassette is not None and cassette.mode == "record":
+        cassette.record(
+            llm, messages, response.content, response.usage_metadata, time.perf_counter() - start,
+            model_name=model_name,
+        )
+    usage: Optional[TokenUsage] = options.get("usage")
+    if usage is not None:
+        usage.record(getattr(response, "usage_metadata", None))
+    return _response_text(response), model_name
+
+
+def _cache_slot(
+    llm: ChatOpenRouter,
+    messages: list[Dict[str, Any]],
+    options: Mapping[str, Any],
+) -> Optional[tuple[LLMResponseCache, str, str]]:
+    """Return ``(cache, key, model_name)`` if this call may use the response cache."""
+
+    cache: Optional[LLMResponseCache] = options.get("response_cache")
+    temperature = getattr(llm, "temperature", None)
+    if cache is None or temperature not in (None, 0):
+        return None
+    model_name = _model_name(llm)
+    return cache, LLMResponseCache.key_for(model_name, temperature, messages), model_name
+
+
+def _cache_response(
+    slot: tuple[LLMResponseCache, str, str],
+    llm: ChatOpenRouter,
+    messages: list[Dict[str, Any]],
+    model_name: str,
+    text: str,
+) -> None:
+    """Store ``text`` under the model that produced it.
+
+    A response from a fallback or hedge model is filed under that model's
+    key, never under the requested one, so later requests to the requested
+    model are not answered with another model's output.
+    """
+
+    cache, key, requested = slot
+    if model_name != requested:
+        key = LLMResponseCache.key_for(model_name, getattr(llm, "temperature", None), messages)
+    cache.put(key, model_name, text)
+
+
+def _invoke_llm(
+    llm: ChatOpenRouter,
+    messages: list[Dict[str, Any]],
+    config: Optional[RunnableConfig] = None,
+) -> str:
+    """Call ``llm`` with ``messages`` and return the stripped response text.
+
+    Every model call made by the graph nodes goes through here, so
+    cross-cutting behaviour lives in one place.  If the run configuration
+    carries a ``response_cache`` (an :class:`LLMResponseCache`) and the
+    model runs at temperature ``0``, the response is served from and stored
+    to that cache.  Setting ``bypass_cache`` forces a fresh call, whose
+    result still refreshes the cache entry.  A response from a fallback or
+    hedge model is stored under that model instead (see
+    :func:`_cache_response`).
+    Token usage is added to the configuration's ``usage`` (a
+    :class:`TokenUsage`), if any.
+
+    Transient failures (429s, 5xx, timeouts) are retried with jittered
+    backoff, honouring ``Retry-After``, and then handed to the fallback
+    models, skipping any whose circuit breaker is open.  The configuration's
+    ``retry_policy`` controls this (default :meth:`RetryPolicy.from_env`;
+    ``None`` disables it).
+    """
+
+    options = (config or {}).get("configurable") or {}
+    slot = _cache_slot(llm, messages, options)
+    if slot is None:
+        return _call_llm(llm, messages, options)[0]
+
+    if not options.get("bypass_cache"):
+        cached = slot[0].get(slot[1])
+        if cached is not None:
+            return cached
+    text, model_name = _call_llm(llm, messages, options)
+    _cache_response(slot, llm, messages, model_name, text)
+    return text
+
+
+def _stream_llm(
+    llm: ChatOpenRouter,
+    messages: list[Dict[str, Any]],
+    config: Optional[RunnableConfig] = None,
+) -> Iterator[str]:
+    """Streaming counterpart of :func:`_invoke_llm`, yielding text deltas.
+
+    A cache hit is yielded as a single chunk.  Otherwise the deltas from
+    ``llm.stream`` are passed through as they arrive and the complete,
+    stripped text is stored in the cache once the stream finishes; a stream
+    abandoned part-way is never cached.  Failures before the first chunk
+    are retried like :func:`_invoke_llm`'s; a stream that breaks after
+    text has been yielded raises.  With a ``hedger`` in the configuration
+    the request is hedged until the first chunk (see :class:`Hedger`).
+    Cassettes record the deltas with their timing and replay them as a
+    stream.
+    """
+
+    options = (config or {}).get("configurable") or {}
+    slot = _cache_slot(llm, messages, options)
+    if slot is not None and not options.get("bypass_cache"):
+        cached = slot[0].get(slot[1])
+        if cached is not None:
+            yield cached
+            return
+
+    hedger: Optional[Hedger] = options.get("hedger")
+
+    def open_stream(model: ChatOpenRouter) -> tuple[ChatOpenRouter, Iterator[Any]]:
+        if hedger is not None:
+            return hedger._race_stream(model, messages)
+        # Wait for the first chunk so failures to start are retried too
+        stream = iter(model.stream(messages))
+        first = next(stream, None)
+        return model, stream if first is None else chain([first], stream)
+
+    cassette = _cassette(options)
+    model_name = None
+    # Timed from the request, so offsets and latency include the wait for
+    # the first token
+    start = time.perf_counter()
+    if cassette is not None and cassette.mode == "replay":
+        stream = cassette.play_stream(llm, messages)
+    else:
+        model, stream = _resilient_call(llm, options, open_stream)
+        model_name = _model_name(model)
+
+    parts = []
+    offsets = []
+    usage_metadata = None
+    for chunk in stream:
+        if model_name is None:
+            # Replayed chunks carry the model that answered the recording
+            model_name = getattr(chunk, "response_metadata", {}).get("model_name")
+        delta = chunk.content if hasattr(chunk, "content") else str(chunk)
+        if delta:
+            parts.append(delta)
+            offsets.append(time.perf_counter() - start)
+            yield delta
+        if getattr(chunk, "usage_metadata", None):
+            usage_metadata = add_usage(usage_metadata, chunk.usage_metadata)
+    model_name = model_name or _model_name(llm)
+    if cassette is not None and cassette.mode == "record":
+        cassette.record(
+            llm, messages, "".join(parts), usage_metadata, time.perf_counter() - start,
+            chunks=list(zip(offsets, parts)), model_name=model_name,
+        )
+    usage: Optional[TokenUsage] = options.get("usage")
+    if usage is not None:
+        usage.record(usage_metadata)
+    if slot is not None:
+        _cache_response(slot, llm, messages, model_name, "".join(parts).strip())
+
+
+async def _ainvoke_llm(
+    llm: ChatOpenRouter,
+    messages: list[Dict[str, Any]],
+    config: Optional[RunnableConfig] = None,
+) -> str:
+    """Async counterpart of :func:`_invoke_llm`, built on ``llm.ainvoke``.
+
+    Cache lookups are local SQLite reads and are done inline; only the
+    model call awaits, so cancelling the surrounding task aborts the HTTP
+    request and nothing is written to the cache.
+    """
+
+    options = (config or {}).get("configurable") or {}
+    slot = _cache_slot(llm, messages, options)
+    if slot is None:
+        return (await _acall_llm(llm, messages, options))[0]
+
+    if not options.get("bypass_cache"):
+        cached = slot[0].get(slot[1])
+        if cached is not None:
+            return cached
+    text, model_name = await _acall_llm(llm, messages, options)
+    _cache_response(slot, llm, messages, model_name, text)
+    return text
+
+
+def _analysis_node(
+    state: ProcessState,
+    config: Optional[RunnableConfig] = None,
+    *,
+    llm: Optional[ChatOpenRouter] = None,
+) -> ProcessState:
+    """Perform an analysis of the provided PDF and questions.
+
+    This node instructs the LLM to summarise the document, identify key
+    topics and instructions, and surface any ambiguities or potential
+    clarifications required from the user.  The result is stored on the
+    state's `analysis` field.
+
+    Parameters
+    ----------
+    state : ProcessState
+        The current state passed through the LangGraph workflow.
+    config : Optional[RunnableConfig], optional
+        The run configuration supplied by LangGraph; its ``configurable``
+        mapping carries the ``llm`` to use.
+    llm : Optional[ChatOpenRouter], optional
+        The language model used to perform analysis.  Overrides the one in
+        ``config``.
+
+    Returns
+    -------
+    ProcessState
+        Updated state with an `analysis` field containing the model's
+        response.
+    """
+
+    messages = _analysis_messages(state, config)
+
+    # Invoke the model and capture the analysis text
+    state["analysis"] = _invoke_llm(_node_llm(config, llm), messages, config)
+    return state
+
+
+def _assignment_node(
+    state: ProcessState,
+    config: Optional[RunnableConfig] = None,
+    *,
+    llm: Optional[ChatOpenRouter] = None,
+) -> ProcessState:
+    """Generate the final assignment based on PDF, questions and clarifications.
+
+    This node calls the LLM with instructions to build a structured academic
+    assignment suitable for university submission.  It pulls the PDF text,
+    user questions and any clarifications from the state; if the run
+    configuration sets a ``retrieval_token_budget``, long documents are
+    narrowed to the most relevant excerpts first.  The resulting
+    assignment is stored on the state's `assignment` field.
+
+    Parameters
+    ----------
+    state : ProcessState
+        The current state passed through the LangGraph workflow.
+    config : Optional[RunnableConfig], optional
+        The run configuration supplied by LangGraph; its ``configurable``
+        mapping carries the ``llm`` to use.
+    llm : Optional[ChatOpenRouter], optional
+        The language model used to generate the assignment.  Overrides the
+        one in ``config``.
+
+    Returns
+    -------
+    ProcessState
+        Updated state with an `assignment` field containing the model's
+        generated assignment.
+    """
+
+    messages = _assignment_messages(state, config)
+    state["assignment"] = _invoke_llm(_node_llm(config, llm), messages, config)
+    return state
+
+
+async def _aanalysis_node(
+    state: ProcessState,
+    config: Optional[RunnableConfig] = None,
+    *,
+    llm: Optional[ChatOpenRouter] = None,
+) -> ProcessState:
+    """Async version of :func:`_analysis_node`, used by ``graph.ainvoke``."""
+
+    messages = _analysis_messages(state, config)
+    state["analysis"] = await _ainvoke_llm(_node_llm(config, llm), messages, config)
+    return state
+
+
+async def _aassignment_node(
+    state: ProcessState,
+    config: Optional[RunnableConfig] = None,
+    *,
+    llm: Optional[ChatOpenRouter] = None,
+) -> ProcessState:
+    """Async version of :func:`_assignment_node`, used by ``graph.ainvoke``."""
+
+    messages = _assignment_messages(state, config)
+    state["assignment"] = await _ainvoke_llm(_node_llm(config, llm), messages, config)
+    return state
+
+
+def _route_analysis(state: ProcessState, config: Optional[RunnableConfig] = None) -> Union[str, list[Send]]:
+    """Pick single-shot or map-reduce analysis from the document size.
+
+    Documents up to ``map_reduce_threshold`` estimated tokens (from the run
+    configuration, default :data:`MAP_REDUCE_MIN_TOKENS`) go straight to
+    the ``analysis`` node.  Larger ones are split with :func:`chunk_text`
+    into chunks of about ``map_chunk_tokens`` tokens, and one
+    ``summarise_chunk`` task per chunk is sent so they run in parallel.
+    """
+
+    options = (config or {}).get("configurable") or {}
+    pdf_text = state.get("pdf_text", "") or ""
+    threshold = options.get("map_reduce_threshold", MAP_REDUCE_MIN_TOKENS)
+    if threshold is None or estimate_tokens(pdf_text) <= threshold:
+        return "analysis"
+
+    chunk_chars = options.get("map_chunk_tokens", MAP_CHUNK_TOKENS) * CHARS_PER_TOKEN
+    chunks = chunk_text(pdf_text, max_chars=chunk_chars)
+    questions = state.get("questions", "")
+    return [
+        Send(
+            "summarise_chunk",
+            {"chunk": chunk, "chunk_index": index, "chunk_count": len(chunks), "questions": questions},
+        )
+        for index, chunk in enumerate(chunks)
+    ]
+
+
+def _summarise_chunk_node(task: Dict[str, Any], config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Map step: write notes on one chunk of a long document."""
+
+    messages = _chunk_summary_messages(task["chunk"], task["chunk_index"], task["chunk_count"], task["questions"])
+    return {"chunk_summaries": {task["chunk_index"]: _invoke_llm(_node_llm(config, None), messages, config)}}
+
+
+async def _asummarise_chunk_node(task: Dict[str, Any], config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Async version of :func:`_summarise_chunk_node`."""
+
+    messages = _chunk_summary_messages(task["chunk"], task["chunk_index"], task["chunk_count"], task["questions"])
+    return {"chunk_summaries": {task["chunk_index"]: await _ainvoke_llm(_node_llm(config, None), messages, config)}}
+
+
+def _reduce_analysis_node(state: ProcessState, config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Reduce step: turn the chunk notes into the usual analysis output."""
+
+    messages = _reduce_analysis_messages(state)
+    return {"analysis": _invoke_llm(_node_llm(config, None), messages, config)}
+
+
+async def _areduce_analysis_node(state: ProcessState, config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Async version of :func:`_reduce_analysis_node`."""
+
+    messages = _reduce_analysis_messages(state)
+    return {"analysis": await _ainvoke_llm(_node_llm(config, None), messages, config)}
+
+
+# System prompt for the outline step of sectioned assignment generation
+_OUTLINE_SYSTEM_PROMPT = (
+    "You are a specialized AI academic assistant planning a university "
+    "assignment based on provided documents and user instructions.  Plan "
+    "only the main body: choose 3 to 6 sections that together answer the "
+    "user's questions.  Reply with one section per line in the form\n"
+    "Heading: one sentence on what the section covers\n"
+    "and nothing else.  The Introduction, Conclusion and References are "
+    "planned separately; do not list them."
+)
+
+# System prompt for writing one section of a sectioned assignment
+_SECTION_SYSTEM_PROMPT = (
+    "You are a specialized AI academic assistant writing one section of a "
+    "university assignment.  The other sections are written separately from "
+    "the same outline, so write only the requested section and do not repeat "
+    "material that belongs to another one.  Provide detailed explanations, "
+    "analysis and relevant examples derived from the source material, in "
+    "formal academic language and free from plagiarism.  Do not start with "
+    "the section heading; it is added for you.  Use '###' for any "
+    "subheadings."
+)
+
+# Extra instructions for the fixed sections around the outlined body
+_SECTION_BRIEFS = {
+    "introduction": "Provide a brief overview of the topic and its significance.",
+    "conclusion": (
+        "Summarise the key points discussed and offer any conclusions or "
+        "recommendations based on the analysed content."
+    ),
+    "references": (
+        "List all sources referenced, using any citation details available in "
+        "the document (e.g. authors, titles, publication dates).  If none are "
+        "present, reply with exactly 'None'."
+    ),
+}
+
+# Upper bound on outlined body sections; the prompt asks for 3 to 6
+MAX_OUTLINE_SECTIONS = 6
+
+_OUTLINE_LINE_PREFIX = re.compile(r"^\s*(?:[-*•]|\d+[.)]|#+)\s*")
+
+
+def _outline_messages(state: ProcessState, config: Optional[RunnableConfig] = None) -> list[Dict[str, Any]]:
+    """Build the chat messages for the outline step."""
+
+    questions = state.get("questions", "")
+    clarifications = state.get("clarifications", "") or ""
+    return _phase_messages(
+        _OUTLINE_SYSTEM_PROMPT,
+        _relevant_text(state, config),
+        f"User Questions/Instructions:\n{questions}\n\n"
+        f"Clarifications (if provided):\n{clarifications}",
+        config,
+    )
+
+
+def _parse_outline(text: str) -> list[Dict[str, str]]:
+    """Turn the outline reply into section entries for the whole assignment.
+
+    Each ``Heading: brief`` line becomes a ``{"kind": "body", "heading",
+    "brief"}`` entry (list markers and numbering are ignored).  Lines
+    without a brief, such as "Here is the outline:" preambles or closing
+    remarks, are skipped, and at most ``MAX_OUTLINE_SECTIONS`` entries are
+    kept since every one costs a model call.  The fixed Introduction,
+    Conclusion and References entries are added around them, and a single
+    generic body section is used if the reply contains no usable line.
+    """
+
+    fixed = {"introduction", "body", "conclusion", "references"}
+    body = []
+    for line in text.splitlines():
+        line = _OUTLINE_LINE_PREFIX.sub("", line).strip().strip("*").strip()
+        heading, _, brief = line.partition(":")
+        heading = heading.strip().strip("*").strip()
+        brief = brief.strip().strip("*").strip()
+        if heading and brief and heading.lower() not in fixed:
+            body.append({"kind": "body", "heading": heading, "brief": brief})
+    body = body[:MAX_OUTLINE_SECTIONS]
+    if not body:
+        body = [{"kind": "body", "heading": "Discussion", "brief": "Answer the user's questions in depth."}]
+    return (
+        [{"kind": "introduction", "heading": "Introduction", "brief": _SECTION_BRIEFS["introduction"]}]
+        + body
+        + [
+            {"kind": "conclusion", "heading": "Conclusion", "brief": _SECTION_BRIEFS["conclusion"]},
+            {"kind": "references", "heading": "References", "brief": _SECTION_BRIEFS["references"]},
+        ]
+    )
+
+
+def _section_messages(task: Dict[str, Any], config: Optional[RunnableConfig] = None) -> list[Dict[str, Any]]:
+    """Build the chat messages writing one outlined section.
+
+    Each section sees the whole outline, so it knows what the others
+    cover, and the document narrowed to what is relevant to its own
+    heading and brief.
+    """
+
+    state = task["state"]
+    section = task["section"]
+    outline = "\n".join(
+        f"- {entry['heading']}" + (f": {entry['brief']}" if entry["kind"] == "body" else "")
+        for entry in task["outline"]
+    )
+    query = f"{section['heading']}\n{section['brief']}\n{state.get('questions', '')}"
+    pdf_text = _relevant_text({**state, "questions": query}, config)
+    return _phase_messages(
+        _SECTION_SYSTEM_PROMPT,
+        pdf_text,
+        f"Assignment Outline:\n{outline}\n\n"
+        f"Section to write: {section['heading']}\n"
+        f"What it covers: {section['brief']}\n\n"
+        f"User Questions/Instructions:\n{state.get('questions', '')}\n\n"
+        f"Clarifications (if provided):\n{state.get('clarifications') or ''}",
+        config,
+    )
+
+
+def _section_body(text: str, heading: str) -> str:
+    """Strip a repeated heading from the top of a section reply."""
+
+    first, _, rest = text.partition("\n")
+    if first.startswith("#") and first.lstrip("#").strip().lower() == heading.lower():
+        return rest.strip()
+    return text.strip()
+
+
+def _outline_node(state: ProcessState, config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Plan the assignment: one short call producing the section outline."""
+
+    text = _invoke_llm(_node_llm(config, None), _outline_messages(state, config), config)
+    return {"outline": _parse_outline(text)}
+
+
+async def _aoutline_node(state: ProcessState, config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Async version of :func:`_outline_node`."""
+
+    text = await _ainvoke_llm(_node_llm(config, None), _outline_messages(state, config), config)
+    return {"outline": _parse_outline(text)}
+
+
+def _route_sections(state: ProcessState) -> list[Send]:
+    """Fan out one ``write_section`` task per outlined section."""
+
+    outline = state.get("outline") or []
+    base = {key: state.get(key) for key in ("pdf_text", "questions", "clarifications")}
+    return [
+        Send("write_section", {"index": index, "section": section, "outline": outline, "state": base})
+        for index, section in enumerate(outline)
+    ]
+
+
+def _write_section_node(task: Dict[str, Any], config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Write one section of the outline."""
+
+    text = _invoke_llm(_node_llm(config, None), _section_messages(task, config), config)
+    return {"sections": {task["index"]: _section_body(text, task["section"]["heading"])}}
+
+
+async def _awrite_section_node(task: Dict[str, Any], config: Optional[RunnableConfig] = None) -> ProcessState:
+    """Async version of :func:`_write_section_node`."""
+
+    text = await _ainvoke_llm(_node_llm(config, None), _section_messages(task, config), config)
+    return {"sections": {task["index"]: _section_body(text, task["section"]["heading"])}}
+
+
+def _stitch_sections_node(state: ProcessState) -> ProcessState:
+    """Assemble the written sections into the usual assignment Markdown.
+
+    The result follows the format of the single-call prompt: ``#``
+    Introduction, Body (with a ``##`` heading per outlined section),
+    Conclusion and References, the last left empty when the document has
+    no citation details.
+    """
+
+    sections = state.get("sections") or {}
+    intro, body, conclusion, references = [], [], [], []
+    for index, entry in enumerate(state.get("outline") or []):
+        text = sections.get(index, "")
+        if entry["kind"] == "introduction":
+            intro.append(text)
+        elif entry["kind"] == "body":
+            body.append(f"## {entry['heading']}\n{text}")
+        elif entry["kind"] == "conclusion":
+            conclusion.append(text)
+        elif text.strip().rstrip(".").lower() != "none":
+            references.append(text)
+
+    parts = [
+        "# Introduction\n" + "\n\n".join(intro),
+        "# Body\n" + "\n\n".join(body),
+        "# Conclusion\n" + "\n\n".join(conclusion),
+        "# References\n" + "\n\n".join(references),
+    ]
+    return {"assignment": "\n\n".join(part.strip() for part in parts)}
+
+
+def _add_analysis_nodes(builder: StateGraph) -> tuple[str, ...]:
+    """Add the analysis nodes, entered from START, and return the exit nodes."""
+
+    builder.add_node("analysis", RunnableLambda(_analysis_node, afunc=_aanalysis_node))
+    builder.add_node("summarise_chunk", RunnableLambda(_summarise_chunk_node, afunc=_asummarise_chunk_node))
+    builder.add_node("reduce_analysis", RunnableLambda(_reduce_analysis_node, afunc=_areduce_analysis_node))
+    builder.add_conditional_edges(START, _route_analysis, ["analysis", "summarise_chunk"])
+    builder.add_edge("summarise_chunk", "reduce_analysis")
+    return ("analysis", "reduce_analysis")
+
+
+@lru_cache(maxsize=None)
+def _build_analysis_graph():
+    """Build (once) the LangGraph for the analysis phase.
+
+    Short documents go through a single node (`analysis`) that processes
+    the document and instructions and populates the `analysis` field of the
+    state.  Documents above the map-reduce threshold (see
+    :func:`_route_analysis`) are instead split into chunks that are
+    summarised in parallel (`summarise_chunk`) and then combined into the
+    same analysis format (`reduce_analysis`).
+
+    The graph does not capture a model: the LLM is passed at invocation
+    time through ``config["configurable"]["llm"]``, so the compiled graph
+    is cached and shared by every call and thread.  Every node has a sync
+    and an async implementation, so the graph supports both ``invoke``
+    and ``ainvoke``.
+
+    Returns
+    -------
+    langgraph.graph.Graph
+        A compiled graph ready to be invoked.
+    """
+
+    builder = StateGraph(ProcessState)
+    _add_analysis_nodes(builder)
+    return builder.compile()
+
+
+@lru_cache(maxsize=None)
+def _build_assignment_graph():
+    """Build (once) the LangGraph for the assignment generation phase.
+
+    This graph has a single node (`assignment`) that takes the state (with
+    pdf_text, questions and optional clarifications) and writes the generated
+    assignment into the `assignment` field.  Like the analysis graph it is
+    compiled once and receives its LLM at invocation time.
+
+    Returns
+    -------
+    langgraph.graph.Graph
+        A compiled graph ready to be invoked.
+    """
+
+    builder = StateGraph(ProcessState)
+    builder.add_node("assignment", RunnableLambda(_assignment_node, afunc=_aassignment_node))
+    builder.set_entry_point("assignment")
+    return builder.compile()
+
+
+@lru_cache(maxsize=None)
+def _build_sectioned_assignment_graph():
+    """Build (once) the outline-then-sections LangGraph for assignments.
+
+    Instead of one long completion, an `outline` node plans the body
+    sections in a short call, a `write_section` task per section (sent with
+    LangGraph's ``Send``) writes them all in parallel, and `stitch_sections`
+    assembles them into the same Markdown format as
+    :func:`_build_assignment_graph`.  Wall-clock time is then roughly the
+    outline call plus the slowest section.
+
+    Returns
+    -------
+    langgraph.graph.Graph
+        A compiled graph ready to be invoked.
+    """
+
+    builder = StateGraph(ProcessState)
+    builder.add_node("outline", RunnableLambda(_outline_node, afunc=_aoutline_node))
+    builder.add_node("write_section", RunnableLambda(_write_section_node, afunc=_awrite_section_node))
+    builder.add_node("stitch_sections", _stitch_sections_node)
+    builder.add_edge(START, "outline")
+    builder.add_conditional_edges("outline", _route_sections, ["write_section"])
+    builder.add_edge("write_section", "stitch_sections")
+    return builder.compile()
+
+
+@lru_cache(maxsize=None)
+def _build_pipeline_graph():
+    """Build (once) the combined analysis → assignment LangGraph.
+
+    The analysis nodes are those of :func:`_build_analysis_graph`; whichever
+    of them finishes the analysis hands the shared state straight to the
+    `assignment` node, so one invocation produces both outputs.  Combined
+    with the ``compact_assignment`` option the assignment prompt is built
+    from the analysis rather than the whole document.
+
+    Returns
+    -------
+    langgraph.graph.Graph
+        A compiled graph ready to be invoked.
+    """
+
+    builder = StateGraph(ProcessState)
+    analysis_exits = _add_analysis_nodes(builder)
+    builder.add_node("assignment", RunnableLambda(_assignment_node, afunc=_aassignment_node))
+    for node in analysis_exits:
+        builder.add_edge(node, "assignment")
+    return builder.compile()
+
+
+def _llm_config(llm: ChatOpenRouter, *, max_concurrency: Optional[int] = None, **options: Any) -> RunnableConfig:
+    """Build the run configuration that hands ``llm`` (and options) to the nodes.
+
+    ``options`` are placed next to the model in ``config["configurable"]``
+    and are read by :func:`_invoke_llm`, e.g. ``response_cache`` and
+    ``bypass_cache``.  ``max_concurrency`` caps how many nodes (and so
+    model calls) LangGraph runs at once when a step fans out.
+    """
+
+    config: RunnableConfig = {"configurable": {"llm": llm, **options}}
+    if max_concurrency is not None:
+        config["max_concurrency"] = max_concurrency
+    return config
+
+
+def run_analysis(
+    pdf_text: str,
+    questions: str,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    bypass_cache: bool = False,
+    map_reduce_threshold: Optional[int] = MAP_REDUCE_MIN_TOKENS,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+    hedger: Optional[Hedger] = None,
+    max_concurrency: Optional[int] = MAX_LLM_CONCURRENCY,
+) -> str:
+    """Run the analysis phase and return the analysis output.
+
+    This helper function wraps the analysis graph, fetches the shared LLM
+    client (see :func:`get_chat_client`) and invokes the graph with the
+    provided PDF text and user questions.
+
+    Parameters
+    ----------
+    pdf_text : str
+        The full text extracted from a PDF.
+    questions : str
+        User‑provided questions or assignment instructions.
+    model_name : str, optional
+        The model identifier to use on OpenRouter.  Defaults to
+        ``DEFAULT_MODEL_NAME``, a free-tier model.  You can choose any other
+        model supported by OpenRouter, e.g. ``"anthropic/claude-3-7-sonnet"``.
+    temperature : float, optional
+        Sampling temperature for the LLM.  Defaults to 0.0 for deterministic
+        output.
+    cache : Optional[LLMResponseCache], optional
+        Response cache to consult before calling the model.  Only used at
+        temperature 0.  Defaults to ``None`` (no caching).
+    bypass_cache : bool, optional
+        Skip the cache lookup and always call the model; the fresh response
+        still replaces the cached one.  Defaults to ``False``.
+    map_reduce_threshold : Optional[int], optional
+        Documents longer than this many estimated tokens are analysed in
+        chunks that are summarised in parallel and then combined.  Defaults
+        to ``MAP_REDUCE_MIN_TOKENS``; ``None`` always uses a single call.
+    prefix_cache : bool, optional
+        Use the prefix-stable message layout: the document is sent first,
+        in a message shared by both phases and by every user of the same
+        document, so the provider's prompt cache can serve it.  Defaults
+        to ``False``.
+    usage : Optional[TokenUsage], optional
+        Accumulates the provider-reported token usage of the call,
+        including prompt-cache reads.  Defaults to ``None``.
+    hedger : Optional[Hedger], optional
+        Hedges slow calls with a duplicate request to a secondary model.
+        Defaults to ``None`` (no hedging).
+    max_concurrency : Optional[int], optional
+        Maximum number of model calls in flight when a long document is
+        analysed map-reduce style.  Defaults to ``MAX_LLM_CONCURRENCY``;
+        ``None`` means no limit.
+
+    Returns
+    -------
+    str
+        The analysis output containing summary, key topics, explicit
+        instructions and any detected ambiguities.
+    """
+
+    llm = get_chat_client(model_name, temperature)
+    graph = _build_analysis_graph()
+    initial_state: ProcessState = {
+        "pdf_text": pdf_text,
+        "questions": questions,
+        "clarifications": None,
+        "analysis": None,
+        "assignment": None,
+    }
+    result_state = graph.invoke(
+        initial_state,
+        config=_llm_config(
+            llm,
+            response_cache=cache,
+            bypass_cache=bypass_cache,
+            map_reduce_threshold=map_reduce_threshold,
+            prefix_cache=prefix_cache,
+            usage=usage,
+            hedger=hedger,
+            max_concurrency=max_concurrency,
+        ),
+    )
+    return result_state.get("analysis", "") or ""
+
+
+def run_assignment(
+    pdf_text: str,
+    questions: str,
+    clarifications: Optional[str] = None,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    bypass_cache: bool = False,
+    retrieval_token_budget: Optional[int] = RETRIEVAL_TOKEN_BUDGET,
+    sectioned: bool = False,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+    hedger: Optional[Hedger] = None,
+    max_concurrency: Optional[int] = MAX_LLM_CONCURRENCY,
+) -> str:
+    """Run the assignment generation phase and return the assignment output.
+
+    This helper function wraps the assignment graph, fetches the shared LLM
+    client (see :func:`get_chat_client`) and invokes the graph with the
+    provided PDF text, questions and optional clarifications.
+
+    Parameters
+    ----------
+    pdf_text : str
+        The full text extracted from a PDF.
+    questions : str
+        User‑provided questions or assignment instructions.
+    clarifications : Optional[str], optional
+        Additional clarifications provided by the user after reviewing the
+        analysis.  Defaults to ``None``.
+    model_name : str, optional
+        The model identifier to use on OpenRouter.  Defaults to
+        ``DEFAULT_MODEL_NAME``.
+    temperature : float, optional
+        Sampling temperature for the LLM.  Defaults to 0.0 for deterministic
+        output.
+    cache : Optional[LLMResponseCache], optional
+        Response cache to consult before calling the model.  Only used at
+        temperature 0.  Defaults to ``None`` (no caching).
+    bypass_cache : bool, optional
+        Skip the cache lookup and always call the model; the fresh response
+        still replaces the cached one.  Defaults to ``False``.
+    retrieval_token_budget : Optional[int], optional
+        Maximum estimated tokens of document text to send.  Longer
+        documents are narrowed to the excerpts most relevant to the
+        questions and clarifications (see :func:`select_relevant_text`).
+        Defaults to ``RETRIEVAL_TOKEN_BUDGET``; ``None`` always sends the
+        whole document.
+    sectioned : bool, optional
+        Generate the assignment outline-first: a short call plans the body
+        sections, which are then written in parallel and stitched together
+        (see :func:`_build_sectioned_assignment_graph`).  Faster for long
+        assignments.  Defaults to ``False`` (one call).
+    prefix_cache : bool, optional
+        Use the prefix-stable message layout: the document is sent first,
+        in a message shared by both phases and by every user of the same
+        document, so the provider's prompt cache can serve it.  Defaults
+        to ``False``.
+    usage : Optional[TokenUsage], optional
+        Accumulates the provider-reported token usage of the call,
+        including prompt-cache reads.  Defaults to ``None``.
+    hedger : Optional[Hedger], optional
+        Hedges slow calls with a duplicate request to a secondary model.
+        Defaults to ``None`` (no hedging).
+    max_concurrency : Optional[int], optional
+        Maximum number of model calls in flight when sections are written
+        in parallel (``sectioned``).  Defaults to ``MAX_LLM_CONCURRENCY``;
+        ``None`` means no limit.
+
+    Returns
+    -------
+    str
+        A complete academic assignment conforming to the structure defined in
+        the system prompt.
+    """
+
+    llm = get_chat_client(model_name, temperature)
+    graph = _build_sectioned_assignment_graph() if sectioned else _build_assignment_graph()
+    initial_state: ProcessState = {
+        "pdf_text": pdf_text,
+        "questions": questions,
+        "clarifications": clarifications,
+        "analysis": None,
+        "assignment": None,
+    }
+    result_state = graph.invoke(
+        initial_state,
+        config=_llm_config(
+            llm,
+            response_cache=cache,
+            bypass_cache=bypass_cache,
+            retrieval_token_budget=retrieval_token_budget,
+            prefix_cache=prefix_cache,
+            usage=usage,
+            hedger=hedger,
+            max_concurrency=max_concurrency,
+        ),
+    )
+    return result_state.get("assignment", "") or ""
+
+
+class PipelineResult(NamedTuple):
+    """Outputs of :func:`run_pipeline`."""
+
+    analysis: str
+    assignment: str
+
+
+def run_pipeline(
+    pdf_text: str,
+    questions: str,
+    clarifications: Optional[str] = None,
+    *,
+    compact: bool = True,
+    excerpt_token_budget: int = COMPACT_EXCERPT_TOKENS,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    bypass_cache: bool = False,
+    map_reduce_threshold: Optional[int] = MAP_REDUCE_MIN_TOKENS,
+    retrieval_token_budget: Optional[int] = RETRIEVAL_TOKEN_BUDGET,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+    hedger: Optional[Hedger] = None,
+    max_concurrency: Optional[int] = MAX_LLM_CONCURRENCY,
+) -> PipelineResult:
+    """Run analysis and assignment generation in one graph invocation.
+
+    Use this when the clarifications are known up front.  The combined
+    graph (see :func:`_build_pipeline_graph`) passes the analysis on in
+    the shared state; in compact mode the assignment prompt then contains
+    the analysis plus the excerpts most relevant to the questions instead
+    of the whole document, which makes the second call a fraction of the
+    size.
+
+    Parameters
+    ----------
+    pdf_text, questions, clarifications
+        As for :func:`run_assignment`.
+    compact : bool, optional
+        Build the assignment prompt from the analysis and selected excerpts.
+        Defaults to ``True``; ``False`` sends the document as
+        :func:`run_assignment` does.
+    excerpt_token_budget : int, optional
+        Estimated tokens of document excerpts sent in compact mode.
+        Defaults to ``COMPACT_EXCERPT_TOKENS``.
+    model_name, temperature, cache, bypass_cache, map_reduce_threshold,
+    retrieval_token_budget, prefix_cache, usage, hedger, max_concurrency
+        As for :func:`run_analysis` and :func:`run_assignment`.
+
+    Returns
+    -------
+    PipelineResult
+        The analysis and the generated assignment.
+    """
+
+    llm = get_chat_client(model_name, temperature)
+    graph = _build_pipeline_graph()
+    initial_state: ProcessState = {
+        "pdf_text": pdf_text,
+        "questions": questions,
+        "clarifications": clarifications,
+        "analysis": None,
+        "assignment": None,
+    }
+    result_state = graph.invoke(
+        initial_state,
+        config=_llm_config(
+            llm,
+            response_cache=cache,
+            bypass_cache=bypass_cache,
+            map_reduce_threshold=map_reduce_threshold,
+            retrieval_token_budget=retrieval_token_budget,
+            compact_assignment=compact,
+            excerpt_token_budget=excerpt_token_budget,
+            prefix_cache=prefix_cache,
+            usage=usage,
+            hedger=hedger,
+            max_concurrency=max_concurrency,
+        ),
+    )
+    return PipelineResult(result_state.get("analysis", "") or "", result_state.get("assignment", "") or "")
+
+
+async def _wait_for(awaitable: Any, timeout: Optional[float]) -> Any:
+    """Await ``awaitable`` for at most ``timeout`` seconds.
+
+    Like ``asyncio.wait_for``, but always raises the builtin
+    :class:`TimeoutError`; before Python 3.11 ``asyncio.wait_for`` raises
+    ``asyncio.TimeoutError``, which is a different class.
+    """
+
+    try:
+        return await asyncio.wait_for(awaitable, timeout)
+    except asyncio.TimeoutError as exc:
+        raise TimeoutError(f"no result within {timeout:g}s") from exc
+
+
+async def arun_analysis(
+    pdf_text: str,
+    questions: str,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    bypass_cache: bool = False,
+    map_reduce_threshold: Optional[int] = MAP_REDUCE_MIN_TOKENS,
+    timeout: Optional[float] = None,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+    hedger: Optional[Hedger] = None,
+    max_concurrency: Optional[int] = MAX_LLM_CONCURRENCY,
+) -> str:
+    """Async version of :func:`run_analysis`, built on ``graph.ainvoke``.
+
+    The model is called with ``ainvoke`` on the shared async HTTP pool, so
+    one event loop can keep many analyses in flight without a thread per
+    request.  Cancelling the awaiting task cancels the underlying request.
+
+    Parameters
+    ----------
+    pdf_text, questions, model_name, temperature, cache, bypass_cache,
+    map_reduce_threshold, prefix_cache, usage, hedger, max_concurrency
+        As for :func:`run_analysis`.
+    timeout : Optional[float], optional
+        Maximum number of seconds to wait for the result.  On expiry the
+        request is cancelled and :class:`TimeoutError` is raised.  Defaults
+        to ``None`` (no limit).
+
+    Returns
+    -------
+    str
+        The analysis output.
+    """
+
+    llm = get_chat_client(model_name, temperature)
+    graph = _build_analysis_graph()
+    initial_state: ProcessState = {
+        "pdf_text": pdf_text,
+        "questions": questions,
+        "clarifications": None,
+        "analysis": None,
+        "assignment": None,
+    }
+    result_state = await _wait_for(
+        graph.ainvoke(
+            initial_state,
+            config=_llm_config(
+                llm,
+                response_cache=cache,
+                bypass_cache=bypass_cache,
+                map_reduce_threshold=map_reduce_threshold,
+                prefix_cache=prefix_cache,
+                usage=usage,
+                hedger=hedger,
+                max_concurrency=max_concurrency,
+            ),
+        ),
+        timeout,
+    )
+    return result_state.get("analysis", "") or ""
+
+
+async def arun_assignment(
+    pdf_text: str,
+    questions: str,
+    clarifications: Optional[str] = None,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    bypass_cache: bool = False,
+    retrieval_token_budget: Optional[int] = RETRIEVAL_TOKEN_BUDGET,
+    sectioned: bool = False,
+    timeout: Optional[float] = None,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+    hedger: Optional[Hedger] = None,
+    max_concurrency: Optional[int] = MAX_LLM_CONCURRENCY,
+) -> str:
+    """Async version of :func:`run_assignment`, built on ``graph.ainvoke``.
+
+    Parameters
+    ----------
+    pdf_text, questions, clarifications, model_name, temperature, cache,
+    bypass_cache, retrieval_token_budget, sectioned, prefix_cache, usage,
+    hedger, max_concurrency
+        As for :func:`run_assignment`.
+    timeout : Optional[float], optional
+        Maximum number of seconds to wait for the result.  On expiry the
+        request is cancelled and :class:`TimeoutError` is raised.  Defaults
+        to ``None`` (no limit).
+
+    Returns
+    -------
+    str
+        The generated assignment.
+    """
+
+    llm = get_chat_client(model_name, temperature)
+    graph = _build_sectioned_assignment_graph() if sectioned else _build_assignment_graph()
+    initial_state: ProcessState = {
+        "pdf_text": pdf_text,
+        "questions": questions,
+        "clarifications": clarifications,
         "analysis": None,
         "assignment": None,
     }
-    result_state = graph.invoke(initial_state)
+    result_state = await _wait_for(
+        graph.ainvoke(
+            initial_state,
+            config=_llm_config(
+                llm,
+                response_cache=cache,
+                bypass_cache=bypass_cache,
+                retrieval_token_budget=retrieval_token_budget,
+                prefix_cache=prefix_cache,
+                usage=usage,
+                hedger=hedger,
+                max_concurrency=max_concurrency,
+            ),
+        ),
+        timeout,
+    )
     return result_state.get("assignment", "") or ""
 
+
+def stream_assignment(
+    pdf_text: str,
+    questions: str,
+    clarifications: Optional[str] = None,
+    *,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    bypass_cache: bool = False,
+    retrieval_token_budget: Optional[int] = RETRIEVAL_TOKEN_BUDGET,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+    hedger: Optional[Hedger] = None,
+) -> Iterator[str]:
+    """Generate the assignment like :func:`run_assignment`, yielding text as it arrives.
+
+    The prompt is identical to the one built by the assignment graph, but
+    the model is called with ``stream`` so callers can render tokens
+    immediately instead of waiting for the whole response.  Joining the
+    yielded deltas gives the full assignment (before stripping).  Caching
+    follows :func:`run_assignment`: a cached response is yielded in one
+    piece, and a fresh one is stored only once the stream completes.
+
+    Parameters
+    ----------
+    pdf_text, questions, clarifications, model_name, temperature, cache,
+    bypass_cache, retrieval_token_budget, prefix_cache, usage
+        As for :func:`run_assignment`.
+    hedger : Optional[Hedger], optional
+        Hedges a slow first chunk with a duplicate request to a secondary
+        model; the first side to produce a chunk is streamed and the other
+        is cancelled.  Defaults to ``None`` (no hedging).
+
+    Yields
+    ------
+    str
+        Successive pieces of the generated assignment.
+    """
+
+    llm = get_chat_client(model_name, temperature)
+    state: ProcessState = {
+        "pdf_text": pdf_text,
+        "questions": questions,
+        "clarifications": clarifications,
+    }
+    config = _llm_config(
+        llm,
+        response_cache=cache,
+        bypass_cache=bypass_cache,
+        retrieval_token_budget=retrieval_token_budget,
+        prefix_cache=prefix_cache,
+        usage=usage,
+        hedger=hedger,
+    )
+    yield from _stream_llm(llm, _assignment_messages(state, config), config)
+
+
+# -----------------------------------------------------------------------------
+# Batch generation
+# -----------------------------------------------------------------------------
+
+class _TokenBucket:
+    """Thread-safe token bucket spacing requests to ``rate`` per second.
+
+    Up to ``capacity`` requests may start back to back; after that each
+    :meth:`acquire` waits for a token to refill.  :meth:`pause` empties the
+    bucket and blocks every caller for a while, which is how a 429 from one
+    worker slows down all of them.
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a request may be sent."""
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    wait = self._blocked_until - now
+                else:
+                    if self.rate == math.inf:
+                        self._tokens = self.capacity
+                    else:
+                        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Hold back every caller for ``seconds`` and drop any saved-up burst."""
+
+        with self._lock:
+            now = time.monotonic()
+            self._blocked_until = max(self._blocked_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = max(now, self._blocked_until)
+
+
+class BatchResult(NamedTuple):
+    """Outcome of one job of :func:`run_assignment_batch`.
+
+    Exactly one of ``assignment`` and ``error`` is set.  ``index`` is the
+    job's position in the input, since results arrive in completion order.
+    """
+
+    index: int
+    job: Mapping[str, Any]
+    assignment: Optional[str] = None
+    error: Optional[BaseException] = None
+    attempts: int = 1
+    seconds: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def run_assignment_batch(
+    jobs: Iterable[Mapping[str, Any]],
+    *,
+    max_concurrency: int = 4,
+    requests_per_minute: Optional[float] = None,
+    max_retries: int = 4,
+    model_name: str = DEFAULT_MODEL_NAME,
+    temperature: float = 0.0,
+    cache: Optional[LLMResponseCache] = None,
+    retrieval_token_budget: Optional[int] = RETRIEVAL_TOKEN_BUDGET,
+    prefix_cache: bool = False,
+    usage: Optional[TokenUsage] = None,
+) -> Iterator[BatchResult]:
+    """Generate many assignments concurrently, yielding results as they finish.
+
+    Each job is a mapping with the :func:`run_assignment` arguments
+    ``pdf_text``, ``questions`` and optionally ``clarifications``.  Jobs run
+    on at most ``max_concurrency`` worker threads over the shared client
+    and HTTP pool, and every request first takes a token from a bucket
+    refilled at ``requests_per_minute``.
+
+    The client used here has its own retries (and the per-call
+    :class:`RetryPolicy`) disabled so rate limiting is handled in one
+    place: a 429 response pauses the whole bucket for the server's
+    ``Retry-After`` (or an exponential backoff when absent) and the job is
+    retried, up to ``max_retries`` times.  Any other failure,
+    or running out of retries, is returned as that job's
+    :class:`BatchResult` instead of aborting the batch.
+
+    Parameters
+    ----------
+    jobs : Iterable[Mapping[str, Any]]
+        The assignments to generate.
+    max_concurrency : int, optional
+        Maximum number of requests in flight.  Defaults to ``4``.
+    requests_per_minute : Optional[float], optional
+        Sustained request rate; the first ``max_concurrency`` requests may
+        start together.  Defaults to ``None`` (no limit besides 429s).
+    max_retries : int, optional
+        Retries per job after a 429.  Defaults to ``4``.
+    model_name, temperature, cache, retrieval_token_budget, prefix_cache, usage
+        As for :func:`run_assignment`.
+
+    Yields
+    ------
+    BatchResult
+        One result per job, in completion order.
+    """
+
+    llm = get_chat_client(model_name, temperature, max_retries=0)
+    graph = _build_assignment_graph()
+    config = _llm_config(
+        llm,
+        response_cache=cache,
+        retrieval_token_budget=retrieval_token_budget,
+        prefix_cache=prefix_cache,
+        usage=usage,
+        retry_policy=None,
+    )
+    rate = requests_per_minute / 60.0 if requests_per_minute else math.inf
+    bucket = _TokenBucket(rate, max(1, max_concurrency))
+
+    def run_job(index: int, job: Mapping[str, Any]) -> BatchResult:
+        start = time.perf_counter()
+        state: ProcessState = {
+            "pdf_text": job.get("pdf_text", ""),
+            "questions": job.get("questions", ""),
+            "clarifications": job.get("clarifications"),
+            "analysis": None,
+            "assignment": None,
+        }
+        attempt = 0
+        while True:
+            attempt += 1
+            bucket.acquire()
+            try:
+                result_state = graph.invoke(dict(state), config=config)
+            except Exception as exc:
+                if _status_code(exc) != 429 or attempt > max_retries:
+                    return BatchResult(
+                        index, job, error=exc, attempts=attempt, seconds=time.perf_counter() - start
+                    )
+                delay = _retry_after_seconds(exc)
+                bucket.pause(delay if delay is not None else min(60.0, 2.0 ** attempt))
+                continue
+            return BatchResult(
+                index,
+                job,
+                assignment=result_state.get("assignment", "") or "",
+                attempts=attempt,
+                seconds=time.perf_counter() - start,
+            )
+
+    executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency), thread_name_prefix="assignment-batch")
+    try:
+        futures = [executor.submit(run_job, index, job) for index, job in enumerate(jobs)]
+        for future in as_completed(futures):
+            yield future.result()
+    finally:
+        # If the caller stops iterating early, drop the jobs not yet started
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 # -----------------------------------------------------------------------------
 # ODT Generation - NEW FUNCTIONALITY
 # -----------------------------------------------------------------------------
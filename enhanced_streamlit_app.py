@@ -23,6 +23,15 @@ import tempfile
 
 import enhanced_agent as agent  # Import our enhanced agent module
 
+# Upper bound on the amount of document text sent to the model, shared by
+# all uploaded files.  Roughly 100k tokens; anything beyond this would not
+# fit the model's context anyway and is not worth extracting.
+MAX_PDF_CHARS = 400_000
+
+# Malformed PDFs can make a single page take tens of seconds to parse; such
+# pages are skipped rather than allowed to stall the whole upload.
+PAGE_TIMEOUT_SECONDS = 10.0
+
 
 def main() -> None:
     """Main entry point for the enhanced Streamlit app."""
@@ -54,11 +63,11 @@ def main() -> None:
     
     with col1:
         # File uploader for PDFs
-        uploaded_file = st.file_uploader(
-            "📎 Upload a PDF document", 
-            type=["pdf"], 
-            accept_multiple_files=False,
-            help="Select a PDF file containing the source material for your assignment"
+        uploaded_files = st.file_uploader(
+            "📎 Upload PDF documents",
+            type=["pdf"],
+            accept_multiple_files=True,
+            help="Select one or more PDF files (e.g. syllabus, rubric, readings) containing the source material for your assignment"
         )
         
         questions = st.text_area(
@@ -68,26 +77,85 @@ def main() -> None:
             help="Provide specific instructions, questions, or requirements for the assignment"
         )
 
+        reuse_cached = st.checkbox(
+            "♻️ Reuse cached responses for identical requests",
+            value=True,
+            help="Identical documents and instructions are answered instantly from a local cache. "
+                 "Untick to always ask the model for a fresh response."
+        )
+
     with col2:
         st.info(
             "**How it works:**\n\n"
-            "1. 📤 Upload your PDF document\n"
+            "1. 📤 Upload your PDF document(s)\n"
             "2. 🔍 Review the analysis\n"
             "3. ✏️ Add clarifications if needed\n"
             "4. 📄 Generate your assignment\n"
             "5. 💾 Download in PDF or ODT format"
         )
 
-    if uploaded_file is not None:
-        # Extract text only when a new file is uploaded
-        if st.session_state.get("uploaded_filename") != uploaded_file.name:
-            with st.spinner("📖 Extracting text from PDF..."):
-                pdf_bytes = uploaded_file.getvalue()
-                pdf_text = agent.extract_pdf_text(pdf_bytes)
-                st.session_state["pdf_text"] = pdf_text
+    if uploaded_files:
+        # Extract text only when the set of uploaded files changes
+        upload_key = tuple((f.name, f.size) for f in uploaded_files)
+        if st.session_state.get("uploaded_files") != upload_key:
+            with st.spinner(f"📖 Extracting text from {len(uploaded_files)} PDF(s)..."):
+                # UploadedFile is a BytesIO over the upload's bytes, and
+                # getvalue() hands back that same object without copying it
+                # as long as nothing has written to the file.  (getbuffer()
+                # would force BytesIO to unshare, i.e. copy, the data.)  The
+                # extractor then reads those bytes in place.
+                sources = {}
+                for f in uploaded_files:
+                    name = f.name
+                    while name in sources:
+                        name = f"{name} (copy)"
+                    sources[name] = f.getvalue()
+                # Files are extracted concurrently, so ingestion takes about
+                # as long as the slowest file rather than the sum of all.
+                extractions = agent.extract_documents(
+                    sources,
+                    char_budget=MAX_PDF_CHARS,
+                    page_timeout=PAGE_TIMEOUT_SECONDS,
+                    cache=agent.get_pdf_text_cache(),
+                )
+                chars_saved = tokens_saved = 0
+                for name, extraction in extractions.items():
+                    # Drop repeated headers/footers and page numbers before
+                    # the text reaches the model; they cost tokens on every
+                    # call.
+                    extractions[name], report = agent.normalize_pdf_pages(extraction)
+                    chars_saved += report.chars_saved
+                    tokens_saved += report.tokens_saved
+                    if extraction.looks_scanned:
+                        st.warning(
+                            f"🖼️ {name}: {len(extraction.image_only_pages)} page(s) contain only "
+                            "images and no text layer. This looks like a scanned document; "
+                            "run it through OCR first, or the analysis will have little to work with."
+                        )
+                    if extraction.skipped_pages:
+                        skipped = ", ".join(str(i + 1) for i in extraction.skipped_pages)
+                        st.warning(
+                            f"⚠️ {name}: skipped page(s) {skipped} because text extraction "
+                            f"took longer than {PAGE_TIMEOUT_SECONDS:g}s per page. "
+                            "The PDF may be malformed."
+                        )
+                # Keep the page index alongside the text so later steps can
+                # map passages back to their source pages.
+                st.session_state["pdf_extraction"] = extractions
+                # Every document gets a fair share of the prompt budget so
+                # one long reading can't crowd out a short rubric.
+                st.session_state["pdf_text"] = agent.merge_documents(
+                    {name: extraction.text for name, extraction in extractions.items()},
+                    char_budget=MAX_PDF_CHARS,
+                )
                 st.session_state["analysis_result"] = None
-                st.session_state["uploaded_filename"] = uploaded_file.name
-                st.success(f"✅ Successfully loaded: {uploaded_file.name}")
+                st.session_state["uploaded_files"] = upload_key
+                st.success(f"✅ Successfully loaded: {', '.join(extractions)}")
+                if chars_saved:
+                    st.caption(
+                        f"🧹 Removed {chars_saved:,} characters of repeated headers, "
+                        f"footers and whitespace (~{tokens_saved:,} tokens per request)."
+                    )
 
         # Analysis section
         st.markdown("---")
@@ -99,6 +167,8 @@ def main() -> None:
                 analysis = agent.run_analysis(
                     st.session_state["pdf_text"] or "",
                     questions,
+                    cache=agent.get_llm_response_cache(),
+                    bypass_cache=not reuse_cached,
                 )
                 st.session_state["analysis_result"] = analysis
                 st.success("✅ Analysis completed!")
@@ -135,15 +205,20 @@ def main() -> None:
             Storing the assignment in `st.session_state` ensures that it
             persists across reruns triggered by subsequent user input.
             """
-            with st.spinner("🤖 Generating your assignment..."):
-                assignment = agent.run_assignment(
+            # Render tokens as they arrive instead of behind a spinner;
+            # write_stream returns the full text once the stream ends.
+            assignment = st.write_stream(
+                agent.stream_assignment(
                     st.session_state["pdf_text"] or "",
                     questions,
                     clarifications,
+                    cache=agent.get_llm_response_cache(),
+                    bypass_cache=not reuse_cached,
                 )
-                # Persist the generated assignment so it survives re-runs
-                st.session_state["generated_assignment"] = assignment
-                st.success("🎉 Assignment generated successfully!")
+            )
+            # Persist the generated assignment so it survives re-runs
+            st.session_state["generated_assignment"] = assignment.strip()
+            st.success("🎉 Assignment generated successfully!")
 
         # If we've already generated an assignment, display it and allow file export
         if st.session_state.get("generated_assignment"):
@@ -291,7 +366,7 @@ def main() -> None:
                 - ❌ Layout may vary between applications
                 """)
 
-    elif uploaded_file is None:
+    elif not uploaded_files:
         st.info("📤 Please upload a PDF document to begin the analysis process.")
 
 
@@ -0,0 +1,136 @@
+"""
+loadtest_pipeline.py
+====================
+
+Offline load test of the whole pipeline against the mock OpenRouter server.
+
+Every simulated user uploads a synthetic PDF and runs extraction, analysis,
+assignment generation and the ODT and PDF exports, the same path the
+Streamlit app takes.  The LLM calls go over HTTP to
+``mock_openrouter_server.py`` (started in-process unless ``--base-url`` is
+given), so the numbers include the real client stack, connection pool and
+retry layer, but no API key, network or token cost.
+
+Run it with ``python loadtest_pipeline.py [--users N] [--concurrency N]
+[--latency S] [--tokens-per-second N] [--error-rate P]``.  Add ``--record
+run.json.gz`` to capture the model traffic in a cassette, and ``--replay
+run.json.gz [--simulate-latency]`` to rerun exactly the same traffic
+without any server (see ``enhanced_agent.use_cassette``).
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+import numpy as np
+
+import mock_openrouter_server
+from benchmark_pdf_extraction import build_encrypted_pdf
+
+
+def run_user(agent, pdf_bytes: bytes, user: int, out_dir: str) -> dict:
+    """Run one upload-to-export session and return its per-stage timings."""
+
+    timings = {}
+    start = time.perf_counter()
+    text = agent.extract_pdf_pages(pdf_bytes).text
+    timings["extract"] = time.perf_counter() - start
+
+    questions = f"Q{user}: Discuss the main themes of the document."
+    stage = time.perf_counter()
+    agent.run_analysis(text, questions)
+    timings["analysis"] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    assignment = agent.run_assignment(text, questions)
+    timings["assignment"] = time.perf_counter() - stage
+
+    stage = time.perf_counter()
+    details = ("Load Test", f"REG-{user:04d}", "Dr. Mock", "Fall", "Offline University", assignment)
+    agent.create_assignment_odt(*details, filename=os.path.join(out_dir, f"user{user}.odt"))
+    agent.create_assignment_pdf(*details, filename=os.path.join(out_dir, f"user{user}.pdf"))
+    timings["export"] = time.perf_counter() - stage
+
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--users", type=int, default=20, help="pipeline runs (default: 20)")
+    parser.add_argument("--concurrency", type=int, default=4, help="simultaneous users (default: 4)")
+    parser.add_argument("--pages", type=int, default=20, help="pages per synthetic PDF (default: 20)")
+    parser.add_argument("--base-url", help="use a running server instead of starting one")
+    parser.add_argument("--latency", type=float, default=0.2, help="mock seconds to first token (default: 0.2)")
+    parser.add_argument("--tokens-per-second", type=float, default=500.0, help="mock token rate (default: 500)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="mock fraction of 429s (default: 0)")
+    cassette = parser.add_mutually_exclusive_group()
+    cassette.add_argument("--record", metavar="PATH", help="record the model calls to a cassette")
+    cassette.add_argument("--replay", metavar="PATH", help="replay a recorded cassette, no server")
+    parser.add_argument("--simulate-latency", action="store_true", help="replay with the recorded timings")
+    args = parser.parse_args()
+
+    server = (
+        nullcontext()
+        if args.base_url or args.replay
+        else mock_openrouter_server.serve(
+            latency=args.latency,
+            tokens_per_second=args.tokens_per_second,
+            error_rate=args.error_rate,
+            retry_after=0.1,
+            seed=0,
+        )
+    )
+    with server as mock:
+        # The client reads these when it is created, so set them before the
+        # agent hands out its first shared client
+        if mock is not None:
+            os.environ["OPENROUTER_BASE_URL"] = mock.base_url
+        elif args.base_url:
+            os.environ["OPENROUTER_BASE_URL"] = args.base_url
+        os.environ.setdefault("OPENROUTER_API_KEY", "offline-load-test")
+        import enhanced_agent as agent
+
+        if args.record or args.replay:
+            mode = "record" if args.record else "replay"
+            recorder = agent.use_cassette(args.record or args.replay, mode, simulate_latency=args.simulate_latency)
+            target = f"cassette {args.record or args.replay} ({mode})"
+        else:
+            recorder = nullcontext()
+            target = os.environ["OPENROUTER_BASE_URL"]
+
+        pdf_bytes = build_encrypted_pdf(args.pages)
+        print(f"🚀 {args.users} users, {args.concurrency} at a time, against {target}")
+
+        failures = 0
+        results = []
+        with recorder, tempfile.TemporaryDirectory() as out_dir, ThreadPoolExecutor(args.concurrency) as pool:
+            start = time.perf_counter()
+            futures = [pool.submit(run_user, agent, pdf_bytes, user, out_dir) for user in range(args.users)]
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as exc:
+                    failures += 1
+                    print(f"❌ {type(exc).__name__}: {exc}")
+            elapsed = time.perf_counter() - start
+
+    print("=" * 60)
+    print(f"{'stage':<12}{'p50 s':>10}{'p95 s':>10}{'p99 s':>10}")
+    for stage in ("extract", "analysis", "assignment", "export", "total"):
+        values = [result[stage] for result in results]
+        if values:
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            print(f"{stage:<12}{p50:>10.3f}{p95:>10.3f}{p99:>10.3f}")
+    print("=" * 60)
+    print(f"✅ {len(results)} completed, {failures} failed in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.2f} pipelines/s)")
+    if mock is not None:
+        print(f"📊 Mock server: {mock.counters}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+mock_openrouter_server.py
+=========================
+
+A local stand-in for the OpenRouter chat-completions API, built on the
+standard library only, for offline end-to-end tests and benchmarks.
+
+It answers ``POST .../chat/completions`` like OpenRouter does, with plain
+JSON responses or Server-Sent Events when the request sets ``stream``, and
+reports token usage.  The replies are generated text in the Markdown
+layout the assignment prompt asks for, so the export stages have something
+realistic to format.  Latency to the first token, token rate and injected
+errors are configurable.
+
+Run it with ``python mock_openrouter_server.py [--port N] [--latency S]
+[--tokens-per-second N] [--error-rate P] [--error-status CODE]`` and point
+the agent at it::
+
+    export OPENROUTER_BASE_URL=http://127.0.0.1:8999/api/v1
+
+or start it in-process with :func:`serve`.
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, Optional
+
+_WORDS = (
+    "analysis framework evidence theory method structure concept context research "
+    "argument model process outcome principle system source example approach factor"
+).split()
+
+
+@dataclass
+class MockSettings:
+    """Behaviour of the mock server.
+
+    Attributes
+    ----------
+    latency : float
+        Seconds before the first token (or the whole non-streamed reply).
+    tokens_per_second : float
+        Generation speed; ``0`` sends all tokens at once.
+    completion_tokens : int
+        Approximate number of tokens (words) per reply.
+    error_rate : float
+        Probability in ``[0, 1]`` that a request fails with ``error_status``.
+    error_status : int
+        HTTP status of injected errors.
+    retry_after : Optional[float]
+        ``Retry-After`` header sent with injected 429s.
+    seed : Optional[int]
+        Seed for error injection, for reproducible runs.
+    """
+
+    latency: float = 0.2
+    tokens_per_second: float = 200.0
+    completion_tokens: int = 300
+    error_rate: float = 0.0
+    error_status: int = 429
+    retry_after: Optional[float] = 1.0
+    seed: Optional[int] = None
+
+
+def _estimate_tokens(messages: Any) -> int:
+    """Roughly four characters per token, like the agent's own estimate."""
+
+    return max(1, len(json.dumps(messages, ensure_ascii=False)) // 4)
+
+
+def _reply_tokens(count: int) -> list[str]:
+    """Return ``count`` words of assignment-shaped Markdown, split as stream tokens."""
+
+    sections = ["# Introduction\n", "# Body\n## Discussion\n", "# Conclusion\n", "# References\n"]
+    per_section = max(1, count // len(sections))
+    tokens = []
+    for section in sections:
+        tokens.append(section)
+        for i in range(per_section):
+            word = _WORDS[(len(tokens) + i) % len(_WORDS)]
+            tokens.append(("" if i == 0 else " ") + word)
+        tokens.append(".\n\n")
+    return tokens
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "_MockServer"
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002 - stdlib signature
+        pass
+
+    def _send_json(self, status: int, payload: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # noqa: N802 - stdlib naming
+        if self.path.rstrip("/").endswith("/models"):
+            self._send_json(200, {"data": [{"id": "mock/model", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "not found", "code": 404}})
+
+    def do_POST(self) -> None:  # noqa: N802 - stdlib naming
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "invalid JSON", "code": 400}})
+            return
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "not found", "code": 404}})
+            return
+
+        settings = self.server.settings
+        self.server.count("requests")
+        if self.server.should_fail():
+            self.server.count("errors")
+            headers = {}
+            if settings.error_status == 429 and settings.retry_after is not None:
+                headers["Retry-After"] = f"{settings.retry_after:g}"
+            message = "Rate limit exceeded" if settings.error_status == 429 else "Injected upstream error"
+            time.sleep(settings.latency)
+            self._send_json(
+                settings.error_status,
+                {"error": {"message": message, "code": settings.error_status}},
+                headers,
+            )
+            return
+
+        model = request.get("model", "mock/model")
+        tokens = _reply_tokens(settings.completion_tokens)
+        usage = {
+            "prompt_tokens": _estimate_tokens(request.get("messages", [])),
+            "completion_tokens": len(tokens),
+            "total_tokens": 0,
+            "prompt_tokens_details": {"cached_tokens": 0},
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        if request.get("stream"):
+            include_usage = bool((request.get("stream_options") or {}).get("include_usage"))
+            self._stream(completion_id, model, tokens, usage if include_usage else None)
+            return
+
+        time.sleep(settings.latency)
+        if settings.tokens_per_second > 0:
+            time.sleep(len(tokens) / settings.tokens_per_second)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        })
+
+    def _stream(self, completion_id: str, model: str, tokens: list[str], usage: Optional[Dict[str, Any]]) -> None:
+        """Send ``tokens`` as chat.completion.chunk Server-Sent Events.
+
+        Like OpenRouter, the headers and a keep-alive comment go out straight
+        away and the first token follows after ``latency``.
+        """
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(choices: list[Dict[str, Any]], **extra: Any) -> None:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": choices,
+                **extra,
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        interval = 1.0 / self.server.settings.tokens_per_second if self.server.settings.tokens_per_second > 0 else 0.0
+        try:
+            self.wfile.write(b": OPENROUTER PROCESSING\n\n")
+            self.wfile.flush()
+            time.sleep(self.server.settings.latency)
+            event([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}])
+            for token in tokens:
+                event([{"index": 0, "delta": {"content": token}, "finish_reason": None}])
+                if interval:
+                    time.sleep(interval)
+            event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if usage is not None:
+                event([], usage=usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled the stream (e.g. a hedged request lost)
+            self.server.count("cancelled")
+
+
+class _MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple[str, int], settings: MockSettings) -> None:
+        super().__init__(address, _Handler)
+        self.settings = settings
+        self.counters = {"requests": 0, "errors": 0, "cancelled": 0}
+        self._random = random.Random(settings.seed)
+        self._lock = threading.Lock()
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def should_fail(self) -> bool:
+        with self._lock:
+            return self._random.random() < self.settings.error_rate
+
+
+@contextmanager
+def serve(host: str = "127.0.0.1", port: int = 0, **settings: Any) -> Iterator[_MockServer]:
+    """Run the mock server in a background thread for the duration of the block.
+
+    ``settings`` are :class:`MockSettings` fields.  The yielded server has a
+    ``base_url`` attribute (suitable for ``OPENROUTER_BASE_URL``), mutable
+    ``settings`` and request ``counters``.
+    """
+
+    server = _MockServer((host, port), MockSettings(**settings))
+    server.base_url = f"http://{host}:{server.server_address[1]}/api/v1"
+    thread = threading.Thread(target=server.serve_forever, name="mock-openrouter", daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8999)
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds to first token (default: 0.2)")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="0 for instant (default: 200)")
+    parser.add_argument("--completion-tokens", type=int, default=300, help="tokens per reply (default: 300)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of failed requests (default: 0)")
+    parser.add_argument("--error-status", type=int, default=429, help="status of injected errors (default: 429)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After of injected 429s (default: 1)")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    settings = {key: value for key, value in vars(args).items() if key not in ("host", "port")}
+    with serve(args.host, args.port, **settings) as server:
+        print(f"🧪 Mock OpenRouter listening on {server.base_url}")
+        print(f"   export OPENROUTER_BASE_URL={server.base_url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            print(f"\n📊 {server.counters}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,884 @@
+"""
+test_llm_pipeline.py
+====================
+
+Tests for the LLM layer of the enhanced agent: shared clients, the
+LangGraph workflows and the helpers around model calls.  No request ever
+reaches OpenRouter; a dummy API key is set so clients can be constructed.
+"""
+
+import asyncio
+import os
+import tempfile
+import threading
+import time
+
+import httpx
+import openai
+
+os.environ.setdefault("OPENROUTER_API_KEY", "test-key")
+
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+import enhanced_agent as agent
+import mock_openrouter_server
+
+
+class AsyncSleepChatModel(FakeListChatModel):
+    """Fake model whose async calls await ``sleep`` seconds and record cancellation."""
+
+    cancelled: int = 0
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        try:
+            await asyncio.sleep(self.sleep or 0)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        message = AIMessage(content=self.responses[0])
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class RateLimitedError(Exception):
+    """Stand-in for openai.RateLimitError: a 429 with a Retry-After header."""
+
+    status_code = 429
+
+    def __init__(self, retry_after="0.1"):
+        super().__init__("rate limited")
+        self.response = httpx.Response(429, headers={"retry-after": retry_after})
+
+
+class ScriptedChatModel(FakeListChatModel):
+    """Fake model that raises the queued error for prompts containing a marker."""
+
+    failures: dict = {}
+
+    def _call(self, messages, *args, **kwargs):
+        prompt = messages[-1].content
+        for marker, errors in self.failures.items():
+            if marker in prompt and errors:
+                raise errors.pop(0)
+        return "Assignment for " + prompt.split("User Questions/Instructions:\n")[1].split("\n")[0]
+
+
+class EchoChatModel(FakeListChatModel):
+    """Fake model that answers with the first line of the prompt, slowly."""
+
+    prompts: list = []
+
+    def _call(self, messages, *args, **kwargs):
+        time.sleep(self.sleep or 0)
+        self.prompts.append(messages[-1].content)
+        return "Notes on " + messages[-1].content.split("\n")[0]
+
+
+class ConcurrencyTrackingChatModel(FakeListChatModel):
+    """Fake model that sleeps and records the most calls in flight at once."""
+
+    active: int = 0
+    peak: int = 0
+    lock: object = None
+
+    def _call(self, messages, *args, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.sleep or 0)
+        with self.lock:
+            self.active -= 1
+        return self.responses[0]
+
+
+class UsageReportingChatModel(FakeListChatModel):
+    """Fake model that keeps its prompts and reports prompt-cache reads."""
+
+    prompts: list = []
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.prompts.append(messages)
+        cache_read = 80 if len(self.prompts) > 1 else 0
+        message = AIMessage(
+            content=self.responses[0],
+            usage_metadata={
+                "input_tokens": 100,
+                "output_tokens": 10,
+                "total_tokens": 110,
+                "input_token_details": {"cache_read": cache_read},
+            },
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+class SectionWriterChatModel(FakeListChatModel):
+    """Fake model that answers outline and section prompts, slowly."""
+
+    def _call(self, messages, *args, **kwargs):
+        time.sleep(self.sleep or 0)
+        if messages[0].content == agent._OUTLINE_SYSTEM_PROMPT:
+            return (
+                "Here is the proposed outline:\n"
+                "1. Cell Structure: parts of the cell\n- **Energy**: how cells get energy\nIntroduction: skip\n"
+                "Let me know if you need changes."
+            )
+        heading = messages[-1].content.split("Section to write: ")[1].split("\n")[0]
+        if heading == "References":
+            return "None"
+        return f"## {heading}\nText for {heading}."
+
+
+class FlakyChatModel(FakeListChatModel):
+    """Fake named model that raises its queued errors before answering."""
+
+    model_name: str = "test/flaky"
+    errors: list = []
+    calls: int = 0
+
+    def _call(self, messages, *args, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return self.responses[0]
+
+
+def make_state(**overrides):
+    state = {
+        "pdf_text": "Photosynthesis converts light into chemical energy.",
+        "questions": "Explain photosynthesis.",
+        "clarifications": None,
+        "analysis": None,
+        "assignment": None,
+    }
+    state.update(overrides)
+    return state
+
+
+def test_chat_clients_are_shared():
+    """Clients are cached per configuration and share one HTTP pool."""
+
+    agent.configure_http_pool(max_connections=8, max_keepalive_connections=4)
+    first = agent.get_chat_client("test/model-a", 0.0)
+    assert agent.get_chat_client("test/model-a", 0.0) is first
+    other = agent.get_chat_client("test/model-a", 0.7)
+    assert other is not first
+    assert other.http_client is first.http_client
+    assert agent.get_chat_client("test/model-a", 0.0, max_tokens=10) is not first
+
+    agent.configure_http_pool()
+    assert agent.get_chat_client("test/model-a", 0.0) is not first
+
+
+def test_graphs_are_compiled_once_and_take_llm_at_invocation():
+    """The compiled graphs are shared; each call brings its own model."""
+
+    assert agent._build_analysis_graph() is agent._build_analysis_graph()
+    assert agent._build_assignment_graph() is agent._build_assignment_graph()
+
+    first = FakeListChatModel(responses=["  Summary from model one  "])
+    second = FakeListChatModel(responses=["# Introduction\nFrom model two"])
+    graph = agent._build_analysis_graph()
+    assert graph.invoke(make_state(), config=agent._llm_config(first))["analysis"] == "Summary from model one"
+    result = agent._build_assignment_graph().invoke(make_state(), config=agent._llm_config(second))
+    assert result["assignment"] == "# Introduction\nFrom model two"
+
+
+def test_response_cache_hits_bypass_and_eviction():
+    """Identical requests are answered from the cache unless bypassed."""
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = agent.LLMResponseCache(os.path.join(tmp_dir, "llm.sqlite3"), max_entries=2)
+        llm = FakeListChatModel(responses=["first", "second", "third"])
+        graph = agent._build_analysis_graph()
+
+        def analyse(**options):
+            config = agent._llm_config(llm, response_cache=cache, **options)
+            return graph.invoke(make_state(), config=config)["analysis"]
+
+        assert analyse() == "first"
+        assert analyse() == "first"
+        assert (cache.hits, cache.misses) == (1, 1)
+        assert analyse(bypass_cache=True) == "second"
+        assert analyse() == "second"
+
+        for i in range(3):
+            cache.put(f"key-{i}", "test/model", f"value-{i}")
+        assert cache.stats()["entries"] == 2
+        assert cache.get("key-0") is None
+        assert cache.get("key-2") == "value-2"
+
+        cache.ttl = -1
+        assert cache.get("key-2") is None
+        cache.close()
+
+
+def test_streamed_assignment_matches_graph_and_is_cached():
+    """Streaming yields deltas of the same prompt the graph sends, then caches it."""
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = agent.LLMResponseCache(os.path.join(tmp_dir, "llm.sqlite3"))
+        llm = FakeListChatModel(responses=["# Introduction\nStreamed body "])
+        config = agent._llm_config(llm, response_cache=cache)
+        messages = agent._assignment_messages(make_state())
+
+        deltas = list(agent._stream_llm(llm, messages, config))
+        assert len(deltas) > 1
+        assert "".join(deltas) == "# Introduction\nStreamed body "
+
+        # The graph builds the same prompt, so it is answered from the cache
+        result = agent._build_assignment_graph().invoke(make_state(), config=config)
+        assert result["assignment"] == "# Introduction\nStreamed body"
+        assert list(agent._stream_llm(llm, messages, config)) == ["# Introduction\nStreamed body"]
+        assert cache.hits == 2
+        cache.close()
+
+
+def test_async_runs_share_one_loop_with_timeouts():
+    """arun_* use ainvoke, so many calls overlap on one loop and can time out."""
+
+    slow = AsyncSleepChatModel(responses=["  Async assignment  "], sleep=0.2)
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: slow
+    try:
+        async def main():
+            start = time.perf_counter()
+            results = await asyncio.gather(
+                *(agent.arun_assignment("text", f"Question {i}") for i in range(50))
+            )
+            elapsed = time.perf_counter() - start
+            analysis = await agent.arun_analysis("text", "Question")
+            try:
+                await agent.arun_assignment("text", "Question", timeout=0.05)
+            except TimeoutError:
+                timed_out = True
+            else:
+                timed_out = False
+            return results, elapsed, analysis, timed_out
+
+        results, elapsed, analysis, timed_out = asyncio.run(main())
+    finally:
+        agent.get_chat_client = original
+
+    assert results == ["Async assignment"] * 50
+    assert elapsed < 2.0
+    assert analysis == "Async assignment"
+    assert timed_out and slow.cancelled == 1
+
+
+def test_assignment_batch_rate_limits_and_reports_errors():
+    """Batches are throttled, back off on 429 and return per-job errors."""
+
+    model = ScriptedChatModel(
+        responses=["unused"],
+        failures={"Job 2": [RateLimitedError()], "Job 4": [ValueError("bad document")]},
+    )
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: model
+    try:
+        jobs = [{"pdf_text": "text", "questions": f"Job {i}"} for i in range(6)]
+        start = time.perf_counter()
+        results = list(agent.run_assignment_batch(jobs, max_concurrency=3, requests_per_minute=600))
+        elapsed = time.perf_counter() - start
+    finally:
+        agent.get_chat_client = original
+
+    assert sorted(r.index for r in results) == list(range(6))
+    by_index = {r.index: r for r in results}
+    assert by_index[2].ok and by_index[2].attempts == 2
+    assert by_index[2].assignment == "Assignment for Job 2"
+    assert not by_index[4].ok and isinstance(by_index[4].error, ValueError)
+    # 3 burst requests, then 4 more at 10/s, plus the 0.1 s Retry-After pause
+    assert elapsed >= 0.35
+
+    assert agent._retry_after_seconds(RateLimitedError("2")) == 2.0
+    assert agent._retry_after_seconds(RateLimitedError("Wed, 21 Oct 2015 07:28:00 GMT")) == 0.0
+
+
+def test_long_documents_are_analysed_map_reduce():
+    """Large documents are chunked, summarised in parallel and reduced."""
+
+    paragraphs = [f"Paragraph {i}: " + "word " * 200 for i in range(12)]
+    pdf_text = "\n\n".join(paragraphs)
+    chunks = agent.chunk_text(pdf_text, max_chars=2500)
+    assert len(chunks) == 6 and all(len(chunk) <= 2500 for chunk in chunks)
+    assert "\n\n".join(chunks) == "\n\n".join(p.strip() for p in paragraphs)
+
+    graph = agent._build_analysis_graph()
+    model = EchoChatModel(responses=["unused"], prompts=[], sleep=0.2)
+    config = agent._llm_config(model, map_reduce_threshold=1000, map_chunk_tokens=625)
+    start = time.perf_counter()
+    analysis = graph.invoke(make_state(pdf_text=pdf_text), config=config)["analysis"]
+    elapsed = time.perf_counter() - start
+
+    assert len(model.prompts) == 7
+    assert elapsed < 6 * 0.2
+    reduce_prompt = model.prompts[-1]
+    assert analysis == "Notes on Document Content:"
+    assert [f"Notes on Section {i} of 6:" in reduce_prompt for i in range(1, 7)] == [True] * 6
+    assert reduce_prompt.index("Section 1 of 6 (notes)") < reduce_prompt.index("Section 6 of 6 (notes)")
+
+    model.prompts = []
+    result = asyncio.run(graph.ainvoke(make_state(pdf_text=pdf_text), config=config))
+    assert result["analysis"] == analysis and len(model.prompts) == 7
+
+    model.prompts = []
+    config = agent._llm_config(model, map_reduce_threshold=None)
+    graph.invoke(make_state(pdf_text=pdf_text), config=config)
+    assert len(model.prompts) == 1 and "Paragraph 11" in model.prompts[0]
+
+
+def test_map_reduce_fan_out_is_capped():
+    """Chunk summaries and sections never put more than max_concurrency calls in flight."""
+
+    pdf_text = "\n\n".join(f"Paragraph {i}: " + "word " * 2000 for i in range(12))
+    model = ConcurrencyTrackingChatModel(responses=["Notes"], sleep=0.1, lock=threading.Lock())
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: model
+    try:
+        agent.run_analysis(pdf_text, "Summarise.", map_reduce_threshold=1)
+        assert model.peak == agent.MAX_LLM_CONCURRENCY
+
+        model.peak = 0
+        asyncio.run(agent.arun_analysis(pdf_text, "Summarise.", map_reduce_threshold=1, max_concurrency=2))
+        assert model.peak == 2
+
+        # Sections written in parallel share the same cap
+        model.peak = 0
+        agent.run_assignment("text", "Explain.", sectioned=True, max_concurrency=2)
+        assert model.peak == 2
+    finally:
+        agent.get_chat_client = original
+
+
+def test_lexical_index_narrows_the_assignment_prompt():
+    """BM25 ranks chunks by relevance and the prompt keeps only the best ones."""
+
+    index = agent.LexicalIndex([
+        "Photosynthesis turns light energy into chemical energy in chlorophyll.",
+        "Mitosis and meiosis are the two kinds of cell division.",
+        "Light travels as waves and as photons; light bends in lenses.",
+        "The economy of the ancient world.",
+    ])
+    assert [i for i, _ in index.search("How does light drive photosynthesis?")] == [0, 2]
+    assert index.search("quantum chromodynamics") == []
+    assert index.indptr[-1] == len(index.chunk_ids) == len(index.weights)
+
+    chapters = [f"Chapter {i}. " + f"Generic filler text about topic{i}. " * 60 for i in range(20)]
+    chapters[13] = "Chapter 13. Photosynthesis in chloroplasts. " + "Filler sentence. " * 100
+    pdf_text = "\n\n".join(chapters)
+    excerpt = agent.select_relevant_text(pdf_text, "Explain photosynthesis", token_budget=1000)
+    assert agent.estimate_tokens(excerpt) <= 1000
+    assert excerpt.startswith("Chapter 13. Photosynthesis") or "[...]\n\nChapter 13. Photosynthesis" in excerpt
+    assert agent.select_relevant_text("short text", "anything", token_budget=1000) == "short text"
+
+    model = EchoChatModel(responses=["unused"], prompts=[])
+    state = make_state(pdf_text=pdf_text, questions="Explain photosynthesis")
+    config = agent._llm_config(model, retrieval_token_budget=1000)
+    agent._build_assignment_graph().invoke(state, config=config)
+    assert "Chapter 13. Photosynthesis" in model.prompts[0]
+    assert len(model.prompts[0]) < len(pdf_text) // 5
+
+    agent._build_assignment_graph().invoke(state, config=agent._llm_config(model))
+    assert pdf_text in model.prompts[1]
+
+
+def test_prefix_stable_layout_and_usage_reporting():
+    """With prefix_cache the document leads every prompt, byte for byte."""
+
+    pdf_text = "\n\n".join(f"Chapter {i}. " + "Filler text. " * 200 for i in range(10))
+    model = UsageReportingChatModel(responses=["Output"], prompts=[])
+    usage = agent.TokenUsage()
+    config = agent._llm_config(model, prefix_cache=True, retrieval_token_budget=500, usage=usage)
+    agent._build_analysis_graph().invoke(make_state(pdf_text=pdf_text), config=config)
+    agent._build_assignment_graph().invoke(
+        make_state(pdf_text=pdf_text, questions="Other questions", clarifications="Be brief"),
+        config=config,
+    )
+
+    analysis_prompt, assignment_prompt = model.prompts
+    assert analysis_prompt[0].content == assignment_prompt[0].content
+    assert pdf_text in analysis_prompt[0].content[0]["text"]
+    assert analysis_prompt[1].content == agent._ANALYSIS_SYSTEM_PROMPT
+    assert assignment_prompt[1].content == agent._ASSIGNMENT_SYSTEM_PROMPT
+    assert pdf_text not in assignment_prompt[2].content
+    assert "Other questions" in assignment_prompt[2].content
+
+    assert (usage.calls, usage.input_tokens, usage.output_tokens) == (2, 200, 20)
+    assert usage.cache_read_tokens == 80 and usage.cache_hit_ratio == 0.4
+
+    default_layout = agent._analysis_messages(make_state(pdf_text=pdf_text))
+    assert default_layout[0]["content"] == agent._ANALYSIS_SYSTEM_PROMPT
+    assert default_layout[1]["content"].startswith("Document Content:\n" + pdf_text)
+
+
+def test_compact_pipeline_reuses_the_analysis():
+    """The combined graph feeds the analysis and a few excerpts to the assignment."""
+
+    chapters = [f"Chapter {i}. " + f"Generic filler about topic{i}. " * 80 for i in range(12)]
+    chapters[7] = "Chapter 7. Enzymes lower activation energy. " + "Filler. " * 150
+    pdf_text = "\n\n".join(chapters)
+    model = UsageReportingChatModel(responses=["Summary: enzymes"], prompts=[])
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: model
+    try:
+        result = agent.run_pipeline(pdf_text, "Explain how enzymes work", excerpt_token_budget=500)
+    finally:
+        agent.get_chat_client = original
+
+    assert result == agent.PipelineResult("Summary: enzymes", "Summary: enzymes")
+    analysis_prompt, assignment_prompt = (messages[-1].content for messages in model.prompts)
+    assert pdf_text in analysis_prompt
+    assert assignment_prompt.startswith("Document Analysis:\nSummary: enzymes")
+    assert "Chapter 7. Enzymes lower activation energy." in assignment_prompt
+    assert len(assignment_prompt) < len(pdf_text) // 5
+
+    model.prompts = []
+    state = make_state(pdf_text=pdf_text)
+    agent._build_pipeline_graph().invoke(state, config=agent._llm_config(model, retrieval_token_budget=None))
+    assert pdf_text in model.prompts[1][-1].content
+
+
+def test_sectioned_assignment_writes_sections_in_parallel():
+    """An outline call is followed by concurrent section calls and a stitch."""
+
+    model = SectionWriterChatModel(responses=["unused"], sleep=0.2)
+    graph = agent._build_sectioned_assignment_graph()
+    start = time.perf_counter()
+    result = graph.invoke(make_state(), config=agent._llm_config(model))
+    elapsed = time.perf_counter() - start
+
+    assert [entry["heading"] for entry in result["outline"]] == [
+        "Introduction", "Cell Structure", "Energy", "Conclusion", "References",
+    ]
+    assert result["assignment"] == (
+        "# Introduction\nText for Introduction.\n\n"
+        "# Body\n## Cell Structure\nText for Cell Structure.\n\n## Energy\nText for Energy.\n\n"
+        "# Conclusion\nText for Conclusion.\n\n"
+        "# References"
+    )
+    # One outline call, then five sections that overlap instead of queueing
+    assert elapsed < 0.2 * 4
+
+    async_result = asyncio.run(graph.ainvoke(make_state(), config=agent._llm_config(model)))
+    assert async_result["assignment"] == result["assignment"]
+
+    outline = agent._parse_outline("\n".join(f"Topic {i}: brief {i}" for i in range(10)))
+    assert len(outline) == agent.MAX_OUTLINE_SECTIONS + 3
+
+
+def test_retries_circuit_breaker_and_fallback_models():
+    """Transient failures are retried, then routed to fallbacks past open breakers."""
+
+    agent._circuit_breakers.clear()
+    server_error = httpx.HTTPStatusError(
+        "unavailable", request=httpx.Request("POST", "http://test"), response=httpx.Response(503)
+    )
+    primary = FlakyChatModel(responses=["from primary"], errors=[RateLimitedError("0"), RateLimitedError("0")])
+    fallback = FlakyChatModel(responses=["from fallback"], model_name="test/fallback")
+    policy = agent.RetryPolicy(max_attempts=3, base_delay=0.001, fallback_models=("test/fallback",))
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda name, *args, **kwargs: fallback
+    try:
+        config = agent._llm_config(primary, retry_policy=policy)
+        messages = agent._analysis_messages(make_state())
+        assert agent._invoke_llm(primary, messages, config) == "from primary"
+        assert primary.calls == 3
+
+        primary.errors = [server_error] * 3
+        assert agent._invoke_llm(primary, messages, config) == "from fallback"
+        assert primary.calls == 6 and fallback.calls == 1
+
+        # Two more failures reach the threshold of 5 and open the breaker
+        primary.errors = [server_error] * 2
+        policy_two = agent.RetryPolicy(max_attempts=2, base_delay=0.001, fallback_models=("test/fallback",))
+        agent._invoke_llm(primary, messages, agent._llm_config(primary, retry_policy=policy_two))
+        assert agent.get_circuit_breaker("test/flaky").state == "open"
+        assert asyncio.run(agent._ainvoke_llm(primary, messages, config)) == "from fallback"
+        assert primary.calls == 8 and fallback.calls == 3
+
+        agent.get_circuit_breaker("test/flaky").reset_timeout = 0
+        assert agent.get_circuit_breaker("test/flaky").state == "half-open"
+        assert agent._invoke_llm(primary, messages, config) == "from primary"
+        assert agent.get_circuit_breaker("test/flaky").state == "closed"
+
+        primary.errors = [ValueError("bad request")]
+        try:
+            agent._invoke_llm(primary, messages, config)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("non-transient errors must not be retried")
+        assert primary.calls == 10 and fallback.calls == 3
+
+        # A cancelled half-open trial must not leave the breaker stuck
+        breaker = agent.get_circuit_breaker("test/flaky")
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        assert breaker.state == "half-open"
+
+        async def hang(model):
+            await asyncio.sleep(1)
+
+        try:
+            asyncio.run(asyncio.wait_for(agent._aresilient_call(primary, {"retry_policy": policy}, hang), 0.05))
+        except asyncio.TimeoutError:
+            pass
+        assert breaker.allow()
+    finally:
+        agent.get_chat_client = original
+        agent._circuit_breakers.clear()
+
+    assert agent.RetryPolicy(max_delay=1).delay(1, RateLimitedError("60")) is None
+    assert 0 <= agent.RetryPolicy(base_delay=2).delay(3, server_error) <= 8
+
+
+def test_fallback_answers_are_cached_under_the_fallback_model():
+    """A fallback's answer never lands in the primary model's cache entry."""
+
+    agent._circuit_breakers.clear()
+    server_error = httpx.HTTPStatusError(
+        "unavailable", request=httpx.Request("POST", "http://test"), response=httpx.Response(503)
+    )
+    primary = FlakyChatModel(responses=["from primary"], errors=[server_error])
+    fallback = FlakyChatModel(responses=["from fallback"], model_name="test/fallback")
+    policy = agent.RetryPolicy(max_attempts=1, fallback_models=("test/fallback",))
+    messages = agent._analysis_messages(make_state())
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda name, *args, **kwargs: fallback
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = agent.LLMResponseCache(os.path.join(tmp_dir, "cache.sqlite3"))
+            cassette = agent.Cassette(os.path.join(tmp_dir, "calls.json.gz"), "record")
+            config = agent._llm_config(primary, response_cache=cache, retry_policy=policy, cassette=cassette)
+            assert agent._invoke_llm(primary, messages, config) == "from fallback"
+            assert cache.get(cache.key_for("test/flaky", None, messages)) is None
+            assert cache.get(cache.key_for("test/fallback", None, messages)) == "from fallback"
+            assert cassette.lookup(primary, messages)["model"] == "test/fallback"
+
+            # The next request to the primary is a miss and reaches it
+            assert agent._invoke_llm(primary, messages, config) == "from primary"
+    finally:
+        agent.get_chat_client = original
+        agent._circuit_breakers.clear()
+
+
+def test_fallback_clients_keep_the_primary_settings():
+    """Fallback models are asked with the primary's endpoint and request settings."""
+
+    primary = agent.get_chat_client("test/primary", 0.0, max_tokens=77, base_url="http://localhost:9/v1")
+    policy = agent.RetryPolicy(fallback_models=("test/fallback",))
+    _, fallback = agent._candidate_models(primary, policy)
+    assert fallback.model_name == "test/fallback"
+    assert (fallback.max_tokens, fallback.openai_api_base, fallback.temperature) == (77, "http://localhost:9/v1", 0.0)
+    assert fallback is agent.get_chat_client("test/fallback", 0.0, max_tokens=77, base_url="http://localhost:9/v1")
+
+    plain = agent.get_chat_client("test/primary")
+    assert agent.get_chat_client("test/primary", **agent._client_settings(plain)) is plain
+
+
+def test_hedged_requests_race_a_secondary_model():
+    """Slow first tokens trigger a duplicate request; the faster answer wins."""
+
+    slow = FakeListChatModel(responses=["slow"], sleep=0.3)
+    fast = FakeListChatModel(responses=["fast"])
+    hedger = agent.Hedger("test/secondary", initial_delay=0.05)
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: fast
+    try:
+        messages = agent._analysis_messages(make_state())
+        config = agent._llm_config(slow, hedger=hedger, retry_policy=None)
+        start = time.perf_counter()
+        assert agent._invoke_llm(slow, messages, config) == "fast"
+        assert time.perf_counter() - start < 0.3
+        assert asyncio.run(agent._ainvoke_llm(slow, messages, config)) == "fast"
+
+        config = agent._llm_config(fast, hedger=hedger, retry_policy=None)
+        assert agent._invoke_llm(fast, messages, config) == "fast"
+    finally:
+        agent.get_chat_client = original
+
+    assert hedger.stats() == {
+        "requests": 3, "hedged": 2, "hedge_rate": 2 / 3, "primary_wins": 0, "secondary_wins": 2,
+    }
+
+    # Over HTTP the loser's connection is shut down while it still waits for
+    # its first token, and hedged calls still report token usage
+    with mock_openrouter_server.serve(latency=2.0) as slow_server, \
+            mock_openrouter_server.serve(latency=0, tokens_per_second=0) as fast_server:
+        slow = agent.get_chat_client("mock/slow", base_url=slow_server.base_url)
+        fast = agent.get_chat_client("mock/fast", base_url=fast_server.base_url)
+        hedger = agent.Hedger("mock/fast", initial_delay=0.1)
+        usage = agent.TokenUsage()
+        agent.get_chat_client = lambda *args, **kwargs: fast
+        try:
+            config = agent._llm_config(slow, hedger=hedger, usage=usage, retry_policy=None)
+            assert agent._invoke_llm(slow, messages, config).startswith("# Introduction")
+        finally:
+            agent.get_chat_client = original
+        deadline = time.monotonic() + 0.5
+        while any(thread.name == "hedge-primary" for thread in threading.enumerate()):
+            assert time.monotonic() < deadline, "the losing request kept waiting for its first token"
+            time.sleep(0.01)
+        assert usage.calls == 1 and usage.input_tokens > 0
+
+    hedger = agent.Hedger("test/secondary", min_samples=4, percentile=50)
+    for seconds in (0.1, 0.2, 0.3, 0.4):
+        hedger._observe(seconds)
+    assert abs(hedger.delay() - 0.25) < 1e-9
+
+
+def test_streamed_calls_are_hedged_until_the_first_chunk():
+    """A slow first chunk is hedged; the side that streams first is kept."""
+
+    slow = FakeListChatModel(responses=["slow"], sleep=0.3)
+    fast = FakeListChatModel(responses=["fast answer"], sleep=0.01)
+    hedger = agent.Hedger("test/secondary", initial_delay=0.05)
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: fast
+    try:
+        messages = agent._assignment_messages(make_state())
+        start = time.perf_counter()
+        deltas = list(agent._stream_llm(slow, messages, agent._llm_config(slow, hedger=hedger, retry_policy=None)))
+        assert "".join(deltas) == "fast answer" and len(deltas) > 1
+        assert time.perf_counter() - start < 0.3
+
+        assert "".join(agent.stream_assignment("Some text", "A question", hedger=hedger)) == "fast answer"
+    finally:
+        agent.get_chat_client = original
+    assert hedger.stats() == {
+        "requests": 2, "hedged": 1, "hedge_rate": 0.5, "primary_wins": 0, "secondary_wins": 1,
+    }
+
+    # Over HTTP the losing stream's connection is shut down
+    with mock_openrouter_server.serve(latency=2.0) as slow_server, \
+            mock_openrouter_server.serve(latency=0) as fast_server:
+        slow = agent.get_chat_client("mock/slow", base_url=slow_server.base_url)
+        fast = agent.get_chat_client("mock/fast", base_url=fast_server.base_url)
+        hedger = agent.Hedger("mock/fast", initial_delay=0.1)
+        usage = agent.TokenUsage()
+        agent.get_chat_client = lambda *args, **kwargs: fast
+        try:
+            config = agent._llm_config(slow, hedger=hedger, usage=usage, retry_policy=None)
+            assert "".join(agent._stream_llm(slow, messages, config)).startswith("# Introduction")
+        finally:
+            agent.get_chat_client = original
+        deadline = time.monotonic() + 0.5
+        while any(thread.name == "hedge-primary" for thread in threading.enumerate()):
+            assert time.monotonic() < deadline, "the losing stream kept waiting for its first token"
+            time.sleep(0.01)
+        assert usage.calls == 1 and usage.output_tokens > 0
+        assert hedger.stats()["secondary_wins"] == 1
+
+
+def test_hedge_delay_holds_up_under_a_slow_primary():
+    """Abandoned primaries are sampled, so the hedge delay recovers instead of collapsing."""
+
+    slow = FakeListChatModel(responses=["slow"], sleep=0.5)
+    secondary = FakeListChatModel(responses=["fast"], sleep=0.05)
+    hedger = agent.Hedger("test/secondary", min_samples=2, window=6)
+    # Earlier, the primary answered instantly
+    hedger._observe(0.001)
+    hedger._observe(0.001)
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: secondary
+    try:
+        messages = agent._analysis_messages(make_state())
+        for _ in range(4):
+            assert asyncio.run(hedger.ainvoke(slow, messages)).content == "fast"
+    finally:
+        agent.get_chat_client = original
+
+    # Each lost primary ran for at least the secondary's ~0.2s
+    assert hedger.delay() > 0.1
+    assert hedger.stats()["secondary_wins"] == 4
+
+
+def test_hedge_wins_are_cached_under_the_secondary_model():
+    """A hedge won by the secondary is cached as the secondary's answer."""
+
+    slow = FlakyChatModel(responses=["slow"], sleep=0.3, model_name="test/slow")
+    fast = FlakyChatModel(responses=["fast"], model_name="test/secondary")
+    hedger = agent.Hedger("test/secondary", initial_delay=0.05)
+    messages = agent._analysis_messages(make_state())
+    original = agent.get_chat_client
+    agent.get_chat_client = lambda *args, **kwargs: fast
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            cache = agent.LLMResponseCache(os.path.join(tmp_dir, "cache.sqlite3"))
+            config = agent._llm_config(slow, hedger=hedger, response_cache=cache, retry_policy=None)
+            assert agent._invoke_llm(slow, messages, config) == "fast"
+            assert cache.get(cache.key_for("test/slow", None, messages)) is None
+            assert cache.get(cache.key_for("test/secondary", None, messages)) == "fast"
+
+            cache.clear()
+            assert asyncio.run(agent._ainvoke_llm(slow, messages, config)) == "fast"
+            assert cache.get(cache.key_for("test/slow", None, messages)) is None
+    finally:
+        agent.get_chat_client = original
+
+    # The hedge goes out with the primary's request settings
+    primary = agent.get_chat_client("test/primary", 0.0, max_tokens=42, base_url="http://localhost:9/v1")
+    secondary = hedger._secondary(primary)
+    assert (secondary.model_name, secondary.max_tokens, secondary.openai_api_base) == (
+        "test/secondary", 42, "http://localhost:9/v1",
+    )
+
+
+def test_mock_openrouter_server_speaks_chat_completions():
+    """The bundled mock answers the real client, streamed or not, and injects errors."""
+
+    with mock_openrouter_server.serve(latency=0, tokens_per_second=0, completion_tokens=40) as server:
+        llm = agent.get_chat_client("mock/model", base_url=server.base_url, max_retries=0)
+        reply = llm.invoke("Hello")
+        assert reply.content.startswith("# Introduction")
+        assert reply.usage_metadata["output_tokens"] > 0
+
+        chunks = list(llm.stream("Hello"))
+        assert "".join(chunk.content for chunk in chunks) == reply.content
+        assert sum((chunk.usage_metadata or {}).get("output_tokens", 0) for chunk in chunks) > 0
+
+        usage = agent.TokenUsage()
+        config = agent._llm_config(llm, usage=usage, retry_policy=None)
+        assert "".join(agent._stream_llm(llm, agent._assignment_messages(make_state()), config))
+        assert usage.calls == 1 and usage.input_tokens > 0 and usage.output_tokens > 0
+
+        server.settings.error_rate = 1.0
+        server.settings.error_status = 503
+        try:
+            llm.invoke("Hello")
+        except openai.InternalServerError as exc:
+            assert agent._is_retryable(exc)
+        else:
+            raise AssertionError("the injected 503 was not raised")
+        assert server.counters == {"requests": 4, "errors": 1, "cancelled": 0}
+
+        # Shared clients leave retrying to the RetryPolicy: one request per attempt
+        llm = agent.get_chat_client("mock/model", base_url=server.base_url)
+        config = agent._llm_config(llm, retry_policy=agent.RetryPolicy(max_attempts=2, base_delay=0.001))
+        try:
+            agent._invoke_llm(llm, [{"role": "user", "content": "Hello"}], config)
+        except openai.InternalServerError:
+            pass
+        assert server.counters["requests"] == 6
+        agent._circuit_breakers.clear()
+
+
+def test_shared_clients_survive_successive_event_loops():
+    """Each asyncio.run gets async connections of its own, not the first loop's."""
+
+    original = os.environ.get("OPENROUTER_BASE_URL")
+    with mock_openrouter_server.serve(latency=0, tokens_per_second=0) as server:
+        os.environ["OPENROUTER_BASE_URL"] = server.base_url
+        try:
+            for _ in range(2):
+                assignment = asyncio.run(
+                    agent.arun_assignment("Photosynthesis notes", "Explain photosynthesis", retrieval_token_budget=None)
+                )
+                assert assignment.startswith("# Introduction")
+        finally:
+            if original is None:
+                os.environ.pop("OPENROUTER_BASE_URL", None)
+            else:
+                os.environ["OPENROUTER_BASE_URL"] = original
+        assert server.counters["errors"] == 0 and server.counters["requests"] == 2
+
+
+def test_cassette_records_and_replays_calls_and_streams():
+    """A recorded pipeline replays offline, streamed chunks and timing included."""
+
+    state = make_state()
+    messages = [{"role": "user", "content": "Stream a reply."}]
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "run.json.gz")
+        llm = FakeListChatModel(responses=["Analysis text", "Assignment text"], sleep=0.01)
+        with agent.use_cassette(path, "record") as cassette:
+            result = agent._build_pipeline_graph().invoke(state, config=agent._llm_config(llm, retry_policy=None))
+            streamed = list(agent._stream_llm(llm, messages, agent._llm_config(llm, retry_policy=None)))
+        assert len(cassette) == 3 and os.path.getsize(path) > 0
+
+        offline = FakeListChatModel(responses=[])  # any real call fails
+        with agent.use_cassette(path):
+            replayed = agent._build_pipeline_graph().invoke(state, config=agent._llm_config(offline))
+            assert list(agent._stream_llm(offline, messages, agent._llm_config(offline))) == streamed
+        assert (replayed["analysis"], replayed["assignment"]) == (result["analysis"], result["assignment"])
+
+        cassette = agent.Cassette(path, simulate_latency=True)
+        config = agent._llm_config(offline, cassette=cassette)
+        start = time.perf_counter()
+        assert "".join(agent._stream_llm(offline, messages, config)) == "".join(streamed)
+        assert time.perf_counter() - start >= 0.01 * len(streamed) * 0.8
+
+        # The wait for the first token is recorded and replayed too
+        def first_token_wait(llm, config):
+            start = time.perf_counter()
+            stream = agent._stream_llm(llm, messages, config)
+            next(stream)
+            wait = time.perf_counter() - start
+            list(stream)  # finish, so the call is recorded
+            return wait
+
+        path = os.path.join(tmp, "first_token.json.gz")
+        with mock_openrouter_server.serve(latency=0.3, tokens_per_second=0) as server:
+            llm = agent.get_chat_client("mock/model", base_url=server.base_url)
+            with agent.use_cassette(path, "record"):
+                recorded_wait = first_token_wait(llm, agent._llm_config(llm, retry_policy=None))
+        with agent.use_cassette(path, simulate_latency=True):  # the server is gone
+            replayed_wait = first_token_wait(llm, agent._llm_config(llm, retry_policy=None))
+        assert recorded_wait >= 0.3 * 0.8 and abs(replayed_wait - recorded_wait) < 0.15
+
+        try:
+            agent._invoke_llm(offline, [{"role": "user", "content": "never recorded"}], config)
+        except agent.CassetteMissError:
+            pass
+        else:
+            raise AssertionError("an unrecorded request was answered")
+
+
+if __name__ == "__main__":
+    print("🚀 LLM Pipeline Test Suite")
+    print("=" * 60)
+    test_chat_clients_are_shared()
+    print("✅ Shared chat clients: PASSED")
+    test_graphs_are_compiled_once_and_take_llm_at_invocation()
+    print("✅ Cached graphs: PASSED")
+    test_response_cache_hits_bypass_and_eviction()
+    print("✅ Response cache: PASSED")
+    test_streamed_assignment_matches_graph_and_is_cached()
+    print("✅ Streaming assignment: PASSED")
+    test_async_runs_share_one_loop_with_timeouts()
+    print("✅ Async API: PASSED")
+    test_assignment_batch_rate_limits_and_reports_errors()
+    print("✅ Batch generation: PASSED")
+    test_long_documents_are_analysed_map_reduce()
+    print("✅ Map-reduce analysis: PASSED")
+    test_map_reduce_fan_out_is_capped()
+    print("✅ Fan-out concurrency cap: PASSED")
+    test_lexical_index_narrows_the_assignment_prompt()
+    print("✅ Lexical retrieval: PASSED")
+    test_prefix_stable_layout_and_usage_reporting()
+    print("✅ Prefix-stable layout: PASSED")
+    test_compact_pipeline_reuses_the_analysis()
+    print("✅ Compact pipeline: PASSED")
+    test_sectioned_assignment_writes_sections_in_parallel()
+    print("✅ Sectioned assignment: PASSED")
+    test_retries_circuit_breaker_and_fallback_models()
+    print("✅ Retries and fallbacks: PASSED")
+    test_fallback_answers_are_cached_under_the_fallback_model()
+    print("✅ Fallback answers cached per model: PASSED")
+    test_fallback_clients_keep_the_primary_settings()
+    print("✅ Fallback client settings: PASSED")
+    test_hedged_requests_race_a_secondary_model()
+    print("✅ Hedged requests: PASSED")
+    test_streamed_calls_are_hedged_until_the_first_chunk()
+    print("✅ Hedged streaming: PASSED")
+    test_hedge_delay_holds_up_under_a_slow_primary()
+    print("✅ Hedge delay under a slow primary: PASSED")
+    test_hedge_wins_are_cached_under_the_secondary_model()
+    print("✅ Hedge wins cached per model: PASSED")
+    test_mock_openrouter_server_speaks_chat_completions()
+    print("✅ Mock OpenRouter server: PASSED")
+    test_shared_clients_survive_successive_event_loops()
+    print("✅ Async clients per event loop: PASSED")
+    test_cassette_records_and_replays_calls_and_streams()
+    print("✅ Record/replay cassettes: PASSED")
@@ -0,0 +1,404 @@
+"""
+test_pdf_extraction.py
+======================
+
+Tests for the PDF text extraction helpers in the enhanced agent.
+The PDFs used here are generated on the fly with PyPDF2 so the tests do
+not depend on any sample files or on network access.
+"""
+
+import os
+import tempfile
+import time
+from io import BytesIO
+
+import enhanced_agent
+
+from PyPDF2 import PageObject, PdfWriter
+from PyPDF2.generic import DecodedStreamObject, DictionaryObject, NameObject
+
+from enhanced_agent import (
+    PdfExtractionResult,
+    PdfTextCache,
+    extract_documents,
+    extract_pdf_pages,
+    extract_pdf_text,
+    iter_pdf_pages,
+    merge_documents,
+    normalize_pdf_pages,
+)
+
+
+def make_pdf(pages, *, encrypt=False, compact=False):
+    """Build a PDF with one page per entry of ``pages`` containing that text.
+
+    ``None`` entries become image-only pages (vector drawing, no fonts), as
+    in a scanned document.  ``compact`` drops the optional whitespace around
+    delimiters (``BT/F1 12 Tf``), as some PDF writers do.
+    """
+
+    writer = PdfWriter()
+    font = writer._add_object(DictionaryObject({
+        NameObject("/Type"): NameObject("/Font"),
+        NameObject("/Subtype"): NameObject("/Type1"),
+        NameObject("/BaseFont"): NameObject("/Helvetica"),
+    }))
+    for page_text in pages:
+        page = PageObject.create_blank_page(None, 612, 792)
+        if page_text is None:
+            stream = DecodedStreamObject()
+            stream.set_data(b"q 0.5 g 72 72 468 648 re f Q")
+            page[NameObject("/Contents")] = writer._add_object(stream)
+            writer.add_page(page)
+            continue
+        operators = ["BT/F1 12 Tf 72 720 Td 14 TL" if compact else "BT /F1 12 Tf 72 720 Td 14 TL"]
+        for line in page_text.split("\n"):
+            escaped = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            operators.append(f"({escaped})Tj T*" if compact else f"({escaped}) Tj T*")
+        operators.append(" ET" if compact else "ET")
+        stream = DecodedStreamObject()
+        stream.set_data(("" if compact else "\n").join(operators).encode("latin-1"))
+        page[NameObject("/Contents")] = writer._add_object(stream)
+        page[NameObject("/Resources")] = DictionaryObject({
+            NameObject("/Font"): DictionaryObject({NameObject("/F1"): font}),
+        })
+        writer.add_page(page)
+    if encrypt:
+        writer.encrypt(user_password="", owner_password="owner")
+    buffer = BytesIO()
+    writer.write(buffer)
+    return buffer.getvalue()
+
+
+SAMPLE_PAGES = [f"Chapter {i}\nThe quick brown fox {i} jumps." for i in range(12)]
+
+
+def test_serial_extraction():
+    """All pages come back in order, separated by blank lines."""
+
+    text = extract_pdf_text(make_pdf(SAMPLE_PAGES), workers=1)
+    chunks = text.split("\n\n")
+    assert len(chunks) == len(SAMPLE_PAGES)
+    for i, chunk in enumerate(chunks):
+        assert f"Chapter {i}" in chunk
+        assert f"fox {i} jumps" in chunk
+
+
+def test_parallel_matches_serial():
+    """The process pool path returns exactly the serial text."""
+
+    pdf_data = make_pdf(SAMPLE_PAGES)
+    serial = extract_pdf_text(pdf_data, workers=1)
+    parallel = extract_pdf_text(pdf_data, workers=3, parallel_min_pages=1)
+    assert parallel == serial
+
+
+def test_large_budget_uses_pool():
+    """A budget worth many pages is extracted in parallel and trimmed to the serial text."""
+
+    pdf_data = make_pdf(["\n".join(f"Page {i} line {j} " + "x" * 50 for j in range(40)) for i in range(12)])
+    budget = 5 * enhanced_agent.CHARS_PER_PAGE_ESTIMATE + 7
+    pools = []
+    original = enhanced_agent.ProcessPoolExecutor
+
+    class CountingPool(original):
+        def __init__(self, *args, **kwargs):
+            pools.append(self)
+            super().__init__(*args, **kwargs)
+
+    enhanced_agent.ProcessPoolExecutor = CountingPool
+    try:
+        parallel = extract_pdf_pages(pdf_data, workers=2, parallel_min_pages=4, char_budget=budget)
+        small = extract_pdf_pages(pdf_data, workers=2, parallel_min_pages=4, char_budget=100)
+    finally:
+        enhanced_agent.ProcessPoolExecutor = original
+
+    assert len(pools) == 1
+    serial = extract_pdf_pages(pdf_data, workers=1, char_budget=budget)
+    assert parallel == serial
+    assert sum(parallel.page_lengths) == budget
+    assert small == extract_pdf_pages(pdf_data, workers=1, char_budget=100)
+
+
+def test_iter_pdf_pages_range_and_budget():
+    """The iterator honours page ranges and stops at the character budget."""
+
+    pdf_data = make_pdf(SAMPLE_PAGES)
+    indices = [i for i, _ in iter_pdf_pages(pdf_data, start=3, stop=6)]
+    assert indices == [3, 4, 5]
+
+    page_len = len(next(iter_pdf_pages(pdf_data))[1])
+    budget = page_len * 2 + 5
+    pages = list(iter_pdf_pages(pdf_data, char_budget=budget))
+    assert [i for i, _ in pages] == [0, 1, 2]
+    assert sum(len(t) for _, t in pages) == budget
+    assert len(pages[-1][1]) == 5
+
+
+def test_page_offset_index():
+    """Page offsets and lengths slice every page back out of the joined text."""
+
+    pdf_data = make_pdf(SAMPLE_PAGES[:3] + [""] + SAMPLE_PAGES[3:6])
+    result = extract_pdf_pages(pdf_data, workers=1)
+    assert result.text == extract_pdf_text(pdf_data, workers=1)
+    assert list(result.page_numbers) == [0, 1, 2, 4, 5, 6]
+    assert list(result.pages()) == list(iter_pdf_pages(pdf_data))
+    for i, (page_index, page_text) in enumerate(result.pages()):
+        assert result.page_at(result.page_offsets[i]) == page_index
+        assert result.page_at(result.page_offsets[i] + len(page_text) - 1) == page_index
+
+
+def test_normalize_strips_boilerplate():
+    """Repeated headers, footers and page numbers are removed; prose is kept."""
+
+    topics = ["arrays", "stacks", "queues", "trees", "graphs", "heaps"]
+    pages = [
+        (i, f"CS101 Lecture Notes - Week {i}\nRecur-\nsion   applied to {topic}.\n\n\n\n{i + 1}")
+        for i, topic in enumerate(topics)
+    ]
+    # One body line per page: with the default three edge lines the whole
+    # page would count as body and be left alone
+    normalized, report = normalize_pdf_pages(PdfExtractionResult.from_pages(pages), edge_lines=1)
+    assert len(normalized) == 6
+    assert normalized.page_text(2) == "Recursion applied to queues."
+    assert report.boilerplate_lines_removed == 12
+    assert report.chars_saved == len(PdfExtractionResult.from_pages(pages).text) - len(normalized.text)
+    assert report.tokens_saved > 0
+
+
+def test_normalize_keeps_numbered_exercises():
+    """Pages that differ only in their numbers are content, not boilerplate."""
+
+    pages = [
+        (i, f"Problem {n}\nCompute the integral of x^{n} from 0 to {n}.\nShow every step.\nWorth {n} points\n{n}")
+        for i, n in enumerate(range(1, 9))
+    ]
+    extraction = PdfExtractionResult.from_pages(pages)
+    normalized, report = normalize_pdf_pages(extraction)
+    assert len(normalized) == 8
+    assert normalized.page_text(2) == "Problem 3\nCompute the integral of x^3 from 0 to 3.\nShow every step.\nWorth 3 points"
+    assert report.boilerplate_lines_removed == 8
+
+    sample = extract_pdf_pages(make_pdf(SAMPLE_PAGES), workers=1)
+    normalized_sample = normalize_pdf_pages(sample)[0]
+    assert [text for _, text in normalized_sample.pages()] == [text.strip() for _, text in sample.pages()]
+
+    # Long pages lose running headers that differ in a trailing number, but
+    # never body lines that differ in the middle
+    body = "\n".join(f"Step {{0}} of the {topic} method." for topic in ("first", "second", "third", "fourth", "last"))
+    pages = [(i, f"Chapter 2 - Integration {i + 1}\n{body.format(i)}\nPage {i + 1}") for i in range(6)]
+    normalized, report = normalize_pdf_pages(PdfExtractionResult.from_pages(pages))
+    assert report.boilerplate_lines_removed == 12
+    assert normalized.page_text(0) == body.format(0)
+
+
+def test_encrypted_pdf_page_range():
+    """Encrypted PDFs are decrypted once and honour an explicit page range."""
+
+    pdf_data = make_pdf(SAMPLE_PAGES, encrypt=True)
+    assert extract_pdf_text(pdf_data, workers=1) == extract_pdf_text(make_pdf(SAMPLE_PAGES), workers=1)
+    text = extract_pdf_text(pdf_data, workers=1, start=2, stop=4)
+    assert "Chapter 2" in text and "Chapter 3" in text
+    assert "Chapter 1\n" not in text and "Chapter 4" not in text
+
+
+def test_page_timeout_skips_slow_pages():
+    """Pages that exceed the per-page budget are skipped and reported."""
+
+    original = PageObject.extract_text
+
+    def slow_on_page_three(page, *args, **kwargs):
+        text = original(page, *args, **kwargs)
+        if "Chapter 3\n" in text:
+            time.sleep(1.0)
+        return text
+
+    PageObject.extract_text = slow_on_page_three
+    try:
+        result = extract_pdf_pages(make_pdf(SAMPLE_PAGES[:6]), workers=1, page_timeout=0.2)
+    finally:
+        PageObject.extract_text = original
+
+    assert result.skipped_pages == (3,)
+    assert list(result.page_numbers) == [0, 1, 2, 4, 5]
+    assert sorted(result.page_seconds) == list(range(6))
+    assert result.slowest_pages(1)[0][0] == 3
+
+    # The image-only check parses the page's resources and content stream,
+    # so it runs under the watchdog too
+    original_check = enhanced_agent._is_image_only
+
+    def slow_check(page):
+        if b"Chapter 1)" in page.get_contents().get_data():
+            time.sleep(1.0)
+        return original_check(page)
+
+    enhanced_agent._is_image_only = slow_check
+    try:
+        result = extract_pdf_pages(make_pdf(SAMPLE_PAGES[:3]), workers=1, page_timeout=0.2)
+    finally:
+        enhanced_agent._is_image_only = original_check
+
+    assert result.skipped_pages == (1,)
+    assert list(result.page_numbers) == [0, 2]
+
+
+def test_image_only_pages_are_not_extracted():
+    """Pages without a text layer are detected and never sent to extract_text."""
+
+    calls = []
+    original = PageObject.extract_text
+
+    def counting_extract_text(page, *args, **kwargs):
+        calls.append(page)
+        return original(page, *args, **kwargs)
+
+    PageObject.extract_text = counting_extract_text
+    try:
+        result = extract_pdf_pages(make_pdf([None, SAMPLE_PAGES[1], None, None]), workers=1)
+    finally:
+        PageObject.extract_text = original
+
+    assert len(calls) == 1
+    assert result.image_only_pages == (0, 2, 3)
+    assert list(result.page_numbers) == [1]
+    assert result.looks_scanned
+    assert not extract_pdf_pages(make_pdf(SAMPLE_PAGES[:3]), workers=1).looks_scanned
+
+    compact = extract_pdf_pages(make_pdf(["Hello compact world"], compact=True), workers=1)
+    assert compact.image_only_pages == ()
+    assert "Hello compact world" in compact.text
+
+
+def test_buffer_and_path_sources():
+    """Buffers and file paths are accepted and read without a bytes copy."""
+
+    pdf_data = make_pdf(SAMPLE_PAGES)
+    expected = extract_pdf_text(pdf_data, workers=1)
+    assert extract_pdf_text(memoryview(pdf_data), workers=1) == expected
+    assert extract_pdf_text(bytearray(pdf_data), workers=1) == expected
+    assert extract_pdf_text(BytesIO(pdf_data).getbuffer(), workers=1) == expected
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "source.pdf")
+        with open(path, "wb") as f:
+            f.write(pdf_data)
+        assert extract_pdf_text(path, workers=1) == expected
+        assert extract_pdf_text(path, workers=2, parallel_min_pages=1) == expected
+        assert PdfTextCache.key_for(path) == PdfTextCache.key_for(pdf_data)
+
+
+def test_extract_and_merge_documents():
+    """Several documents are extracted concurrently and merged fairly."""
+
+    sources = {
+        "syllabus.pdf": make_pdf(SAMPLE_PAGES[:2]),
+        "rubric.pdf": memoryview(make_pdf(["Rubric: clarity 50%, depth 50%"])),
+        "reading.pdf": make_pdf(SAMPLE_PAGES),
+    }
+    results = extract_documents(sources, max_workers=2)
+    assert list(results) == list(sources)
+    for name, source in sources.items():
+        assert results[name] == extract_pdf_pages(source, workers=1)
+
+    texts = {"rubric": "R" * 100, "reading": "A" * 5000, "notes": "N" * 300}
+    merged = merge_documents(texts, char_budget=1000)
+    assert "=== Document: rubric ===\n" + "R" * 100 + "\n" in merged
+    assert "N" * 300 in merged
+    assert merged.count("A") == 600
+
+
+def test_single_document_gets_page_workers():
+    """A lone upload is extracted with page-level parallelism, not one worker."""
+
+    pdf_data = make_pdf([f"Page {i} of a long course pack." for i in range(enhanced_agent.PARALLEL_MIN_PAGES)])
+    pools = []
+    original = enhanced_agent.ProcessPoolExecutor
+
+    class CountingPool(original):
+        def __init__(self, *args, **kwargs):
+            pools.append(kwargs.get("max_workers"))
+            super().__init__(*args, **kwargs)
+
+    enhanced_agent.ProcessPoolExecutor = CountingPool
+    try:
+        results = extract_documents({"pack.pdf": pdf_data}, max_workers=2)
+    finally:
+        enhanced_agent.ProcessPoolExecutor = original
+
+    assert pools == [2]
+    assert results["pack.pdf"] == extract_pdf_pages(pdf_data, workers=1)
+
+
+def test_pdf_text_cache_hits_and_eviction():
+    """Repeated extractions are served from the cache; old entries are evicted."""
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = PdfTextCache(cache_dir)
+        pdf_data = make_pdf(SAMPLE_PAGES)
+        first = extract_pdf_pages(pdf_data, workers=1, cache=cache)
+        second = extract_pdf_pages(pdf_data, workers=1, cache=cache)
+        assert first == second
+        assert (cache.hits, cache.misses) == (1, 1)
+
+        entry_size = cache.stats()["bytes"]
+        # Random hex barely compresses, so each entry is a few KiB on disk
+        older, newer = os.urandom(2000).hex(), os.urandom(2000).hex()
+        small = PdfTextCache(cache_dir, max_bytes=entry_size + 3000)
+        small.put("older", PdfExtractionResult.from_pages([(0, older)]))
+        os.utime(os.path.join(cache_dir, "older" + PdfTextCache._SUFFIX), (0, 0))
+        small.put("newer", PdfExtractionResult.from_pages([(0, newer)]))
+        assert small.get("older") is None
+        assert small.get("newer").text == newer
+
+
+def test_pdf_text_cache_defaults_to_private_user_dir():
+    """Without an explicit directory the cache lives in a 0700 per-user folder."""
+
+    saved = {name: os.environ.pop(name, None) for name in ("XDG_CACHE_HOME", "PDF_TEXT_CACHE_DIR")}
+    try:
+        with tempfile.TemporaryDirectory() as cache_home:
+            os.environ["XDG_CACHE_HOME"] = cache_home
+            cache = PdfTextCache()
+            assert cache.directory.startswith(cache_home)
+            assert os.stat(cache.directory).st_mode & 0o777 == 0o700
+    finally:
+        for name, value in saved.items():
+            os.environ.pop(name, None)
+            if value is not None:
+                os.environ[name] = value
+
+
+if __name__ == "__main__":
+    print("🚀 PDF Extraction Test Suite")
+    print("=" * 60)
+    test_serial_extraction()
+    print("✅ Serial extraction: PASSED")
+    test_parallel_matches_serial()
+    print("✅ Parallel extraction: PASSED")
+    test_large_budget_uses_pool()
+    print("✅ Budgeted parallel extraction: PASSED")
+    test_iter_pdf_pages_range_and_budget()
+    print("✅ Page iterator: PASSED")
+    test_page_offset_index()
+    print("✅ Page offset index: PASSED")
+    test_normalize_strips_boilerplate()
+    print("✅ Boilerplate normalisation: PASSED")
+    test_normalize_keeps_numbered_exercises()
+    print("✅ Numbered exercises kept: PASSED")
+    test_encrypted_pdf_page_range()
+    print("✅ Encrypted page range: PASSED")
+    test_page_timeout_skips_slow_pages()
+    print("✅ Per-page watchdog: PASSED")
+    test_image_only_pages_are_not_extracted()
+    print("✅ Image-only page detection: PASSED")
+    test_buffer_and_path_sources()
+    print("✅ Buffer and path sources: PASSED")
+    test_extract_and_merge_documents()
+    print("✅ Multi-document ingestion: PASSED")
+    test_single_document_gets_page_workers()
+    print("✅ Single-document page workers: PASSED")
+    test_pdf_text_cache_hits_and_eviction()
+    print("✅ Extraction cache: PASSED")
+    test_pdf_text_cache_defaults_to_private_user_dir()
+    print("✅ Private cache directory: PASSED")